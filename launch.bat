@@ -1,4 +1,5 @@
 @echo off
+START "animatediff worker" .\venv\Scripts\python -m animatediff worker
 SET "cmd=.\venv\Scripts\uvicorn server:app  --reload --host 0.0.0.0 --port 7860"
 CALL %cmd%
 PAUSE
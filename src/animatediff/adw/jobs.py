@@ -0,0 +1,175 @@
+import functools
+import json
+import sqlite3
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from animatediff.adw.schema import TPipeline, TStatusEnum, TSubtask
+from animatediff.consts import path_mgr
+
+# a RUNNING job whose worker has not reported for this many seconds is taken to be orphaned
+LEASE_SECONDS = 60.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    pid INTEGER PRIMARY KEY AUTOINCREMENT,
+    status TEXT NOT NULL,
+    params TEXT NOT NULL,
+    completed REAL NOT NULL DEFAULT 0,
+    total INTEGER NOT NULL DEFAULT 100,
+    subtasks TEXT NOT NULL DEFAULT '[]',
+    video_path TEXT NOT NULL DEFAULT '',
+    interrupt INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    heartbeat_at REAL,
+    preview BLOB,
+    preview_step INTEGER NOT NULL DEFAULT -1,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, pid);
+"""
+
+
+class JobQueue:
+
+    """Durable render queue shared by the api process and the gpu workers."""
+
+    def __init__(self, db_path: Path = path_mgr.jobs_db):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        with self.connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+
+    @contextmanager
+    def connect(self):
+        # autocommit; claim() opens its own write transaction
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def enqueue(self, params: dict) -> int:
+        with self.connect() as conn:
+            cur = conn.execute(
+                "INSERT INTO jobs (status, params, created_at) VALUES (?, ?, ?)",
+                (TStatusEnum.PENDING.value, json.dumps(params), time.time()),
+            )
+            return cur.lastrowid
+
+    def claim(self, worker: str) -> tuple[int, dict] | None:
+        """Take the oldest pending job, or None if the queue is empty."""
+        with self.connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    "SELECT pid, params FROM jobs WHERE status = ? ORDER BY pid LIMIT 1",
+                    (TStatusEnum.PENDING.value,),
+                ).fetchone()
+                if row is None:
+                    conn.execute("COMMIT")
+                    return None
+                now = time.time()
+                conn.execute(
+                    "UPDATE jobs SET status = ?, worker = ?, started_at = ?, heartbeat_at = ? WHERE pid = ?",
+                    (TStatusEnum.RUNNING.value, worker, now, now, row["pid"]),
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return row["pid"], json.loads(row["params"])
+
+    def update_progress(self, pid: int, completed: float, subtasks: list[dict]):
+        """Store the progress of a job, which also renews the lease of the worker running it."""
+        with self.connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET completed = ?, subtasks = ?, heartbeat_at = ? WHERE pid = ?",
+                (completed, json.dumps(subtasks), time.time(), pid),
+            )
+
+    def update_preview(self, pid: int, step: int, preview: bytes):
+        with self.connect() as conn:
+            conn.execute("UPDATE jobs SET preview = ?, preview_step = ? WHERE pid = ?", (preview, step, pid))
+
+    def get_preview(self, pid: int) -> bytes | None:
+        with self.connect() as conn:
+            row = conn.execute("SELECT preview FROM jobs WHERE pid = ?", (pid,)).fetchone()
+            return row["preview"] if row else None
+
+    def finish(self, pid: int, status: TStatusEnum, video_path: str = ""):
+        # the interrupt flag stays set, it tells an interrupted job from one that failed
+        with self.connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, video_path = ?, finished_at = ? WHERE pid = ?",
+                (status.value, video_path, time.time(), pid),
+            )
+            if status == TStatusEnum.SUCCESS:
+                conn.execute("UPDATE jobs SET completed = total WHERE pid = ?", (pid,))
+
+    def request_interrupt(self, pid: int) -> bool:
+        with self.connect() as conn:
+            cur = conn.execute(
+                "UPDATE jobs SET interrupt = 1 WHERE pid = ? AND status IN (?, ?)",
+                (pid, TStatusEnum.PENDING.value, TStatusEnum.RUNNING.value),
+            )
+            # pending jobs never reach a worker, so cancel them right here
+            conn.execute(
+                "UPDATE jobs SET status = ?, finished_at = ? WHERE pid = ? AND status = ?",
+                (TStatusEnum.ERROR.value, time.time(), pid, TStatusEnum.PENDING.value),
+            )
+            return cur.rowcount > 0
+
+    def is_interrupt_requested(self, pid: int) -> bool:
+        with self.connect() as conn:
+            row = conn.execute("SELECT interrupt FROM jobs WHERE pid = ?", (pid,)).fetchone()
+            return bool(row and row["interrupt"])
+
+    def requeue_orphans(self, lease: float = LEASE_SECONDS) -> int:
+        """Put jobs left RUNNING by a worker that stopped reporting back in the queue.
+
+        Goes by the heartbeat rather than the worker name, so a restarted worker never takes over a job another
+        worker with the same name is still rendering.
+        """
+        with self.connect() as conn:
+            cur = conn.execute(
+                "UPDATE jobs SET status = ?, started_at = NULL, heartbeat_at = NULL, completed = 0"
+                " WHERE status = ? AND (heartbeat_at IS NULL OR heartbeat_at < ?)",
+                (TStatusEnum.PENDING.value, TStatusEnum.RUNNING.value, time.time() - lease),
+            )
+            return cur.rowcount
+
+    def count_pending(self) -> int:
+        with self.connect() as conn:
+            row = conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status IN (?, ?)",
+                (TStatusEnum.PENDING.value, TStatusEnum.RUNNING.value),
+            ).fetchone()
+            return row[0]
+
+    def get(self, pid: int) -> TPipeline | None:
+        with self.connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE pid = ?", (pid,)).fetchone()
+        if row is None:
+            return None
+        return TPipeline(
+            pid=row["pid"],
+            status=TStatusEnum(row["status"]),
+            completed=row["completed"],
+            total=row["total"],
+            subtasks=[TSubtask(**s) for s in json.loads(row["subtasks"])],
+            video_path=row["video_path"],
+            interrupt_processing=bool(row["interrupt"]),
+            processing_interrupted=bool(row["interrupt"]),
+            preview_step=row["preview_step"],
+        )
+
+
+@functools.lru_cache(maxsize=1)
+def get_job_queue() -> JobQueue:
+    return JobQueue(path_mgr.jobs_db)
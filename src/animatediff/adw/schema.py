@@ -28,6 +28,7 @@ class TPipeline(PtBaseModel):
     video_path: str = ""
     interrupt_processing: bool = False
     processing_interrupted: bool = True
+    preview_step: int = -1
 
 
 def lora_arr():
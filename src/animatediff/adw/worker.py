@@ -0,0 +1,96 @@
+import logging
+import os
+import socket
+import threading
+import time
+
+from animatediff.adw.jobs import JobQueue, get_job_queue
+from animatediff.adw.schema import TStatusEnum
+from animatediff.adw.service import TParamsRenderVideo, sub_render_video
+from animatediff.globals import GPipeline, pipeline_queue, set_global_pipeline
+
+logger = logging.getLogger(__name__)
+
+
+def default_worker_name(device: str) -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{device}"
+
+
+class ProgressReporter(threading.Thread):
+
+    """Mirror the in-process progress bars into the job db, and db interrupts back into the pipeline."""
+
+    def __init__(self, queue: JobQueue, pipeline: GPipeline, interval: float = 1.0):
+        super().__init__(daemon=True)
+        self.queue = queue
+        self.pipeline = pipeline
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.preview_step = -1
+
+    def report(self):
+        pbar = self.pipeline.progress_bar
+        subtasks = pbar.status if pbar else []
+        self.queue.update_progress(self.pipeline.pid, self.pipeline.pipeline.completed, subtasks)
+        preview_step, preview = self.pipeline.preview_step, self.pipeline.preview
+        if preview is not None and preview_step != self.preview_step:
+            self.queue.update_preview(self.pipeline.pid, preview_step, preview)
+            self.preview_step = preview_step
+        if self.queue.is_interrupt_requested(self.pipeline.pid):
+            self.pipeline.interrupt_current_processing()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.report()
+            except Exception:
+                logger.warning("failed to report progress", exc_info=True)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.report()
+
+
+def run_job(queue: JobQueue, pid: int, params: dict):
+    data = TParamsRenderVideo(**params)
+    pipeline = set_global_pipeline(pid)
+    reporter = ProgressReporter(queue, pipeline)
+    reporter.start()
+    try:
+        sub_render_video(data, pid)
+    finally:
+        reporter.stop()
+        pipeline_queue.remove(pipeline)
+
+    status = pipeline.pipeline.status
+    if status != TStatusEnum.SUCCESS:
+        # anything that did not finish cleanly (including interrupts) is an error for the api
+        status = TStatusEnum.ERROR
+    queue.finish(pid, status, str(pipeline.pipeline.video_path))
+    logger.info(f"job {pid} finished with {status.value}")
+
+
+def run_worker(name: str, poll_interval: float = 1.0, once: bool = False):
+    queue = get_job_queue()
+    logger.info(f"worker {name} waiting for jobs in {queue.db_path}")
+    while True:
+        # also picks up the jobs of workers that died while this one kept running
+        requeued = queue.requeue_orphans()
+        if requeued:
+            logger.info(f"worker {name} requeued {requeued} orphaned jobs")
+        job = queue.claim(name)
+        if job is None:
+            if once:
+                return
+            time.sleep(poll_interval)
+            continue
+        pid, params = job
+        logger.info(f"worker {name} picked up job {pid}")
+        try:
+            run_job(queue, pid, params)
+        except Exception:
+            # a job that fails before or outside generate() must not take the worker down with it,
+            # or it would be requeued as an orphan and crash the next worker as well
+            logger.exception(f"job {pid} failed")
+            queue.finish(pid, TStatusEnum.ERROR)
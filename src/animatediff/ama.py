@@ -15,6 +15,7 @@ from animatediff import get_dir
 from animatediff.consts import CONST_CONTROLNET, CONST_PROJECT_FILE, ensure_project_dirs, path_mgr
 from animatediff.schema import TIPAdapterMap, TProjectSetting
 from animatediff.settings import get_project_setting
+from animatediff.utils.frame_store import get_frame_store
 from animatediff.utils.tagger import get_labels
 from animatediff.utils.torch_compact import get_torch_device
 from animatediff.utils.util import (
@@ -71,11 +72,12 @@ def ama_init(
 
     fps = 16
     extract_frames(input_video_path, fps, input_frames_dir, aspect_ratio, -1, 0, size_of_short_edge, False)
+    frame_store = get_frame_store(project_dir)
     for p in [
         controlnet_dir / CONST_CONTROLNET.controlnet_tile,
         controlnet_dir / CONST_CONTROLNET.controlnet_ip2p,
     ]:
-        shutil.copytree(input_frames_dir, p, dirs_exist_ok=True)
+        frame_store.link_tree(input_frames_dir, p)
 
     black_list = []
 
@@ -439,12 +441,13 @@ def ama_mask(
 
         logger.info(f"mask from [{mask_token}] are output to {fg_dir}")
 
+        frame_store = get_frame_store(project_dir)
         if not is_img2img:
-            shutil.copytree(fg_masked_dir, fg_dir / "00_controlnet_image/controlnet_tile", dirs_exist_ok=True)
+            frame_store.link_tree(fg_masked_dir, fg_dir / "00_controlnet_image/controlnet_tile")
         else:
-            shutil.copytree(fg_masked_dir, fg_dir / "00_controlnet_image/controlnet_openpose", dirs_exist_ok=True)
+            frame_store.link_tree(fg_masked_dir, fg_dir / "00_controlnet_image/controlnet_openpose")
 
-        shutil.copytree(fg_masked_dir, fg_dir / "00_controlnet_image/controlnet_ip2p", dirs_exist_ok=True)
+        frame_store.link_tree(fg_masked_dir, fg_dir / "00_controlnet_image/controlnet_ip2p")
 
         if crop_size_hw:
             if crop_size_hw[0] == 0 or crop_size_hw[1] == 0:
@@ -474,12 +477,13 @@ def ama_mask(
 
     logger.info(f"background are output to {bg_dir}")
 
+    frame_store = get_frame_store(project_dir)
     if not is_img2img:
-        shutil.copytree(bg_inpaint_dir, bg_dir / "00_controlnet_image/controlnet_tile", dirs_exist_ok=True)
+        frame_store.link_tree(bg_inpaint_dir, bg_dir / "00_controlnet_image/controlnet_tile")
     else:
-        shutil.copytree(bg_inpaint_dir, bg_dir / "00_controlnet_image/controlnet_openpose", dirs_exist_ok=True)
+        frame_store.link_tree(bg_inpaint_dir, bg_dir / "00_controlnet_image/controlnet_openpose")
 
-    shutil.copytree(bg_inpaint_dir, bg_dir / "00_controlnet_image/controlnet_ip2p", dirs_exist_ok=True)
+    frame_store.link_tree(bg_inpaint_dir, bg_dir / "00_controlnet_image/controlnet_ip2p")
 
     output_list.append((bg_dir, None))
 
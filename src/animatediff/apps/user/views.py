@@ -1,20 +1,19 @@
 import os
 from pathlib import Path
 
-from fastapi import APIRouter, BackgroundTasks, Request
+from fastapi import APIRouter, Request
 from fastapi.responses import FileResponse, Response
 
 from animatediff.adw.contrib import PtBaseModel
 from animatediff.adw.exceptions import raise_unless
+from animatediff.adw.jobs import get_job_queue
 from animatediff.adw.schema import TPerformance, TPipeline, TPreset, TStatusEnum
 from animatediff.adw.service import (
     TParamsRenderVideo,
     get_projects,
-    sub_render_video,
 )
 from animatediff.adw.utils import get_models_endswith
 from animatediff.consts import path_mgr
-from animatediff.globals import GPipeline, g, get_pipeline_by_id, pipeline_queue, set_global_pipeline
 
 bp = APIRouter(prefix="")
 
@@ -113,33 +112,26 @@ def validate_data(data: TParamsRenderVideo):
     # motion loras
 
 
-def serialize_pipeline(p: GPipeline):
+def serialize_pipeline(p: TPipeline):
     return {
         "pid": p.pid,
-        "status": p.pipeline.status,
-        "completed": p.pipeline.completed,
-        "total": p.pipeline.total,
-        "subtasks": p.pipeline.subtasks,
-        "videoPath": p.pipeline.video_path,
+        "status": p.status,
+        "completed": p.completed,
+        "total": p.total,
+        "subtasks": p.subtasks,
+        "videoPath": p.video_path,
+        "previewStep": p.preview_step,
     }
 
 
 @bp.post("/api/pipeline/submit")
-def render_submit(
-        data: TParamsRenderVideo,
-        background_tasks: BackgroundTasks,
-):
+def render_submit(data: TParamsRenderVideo):
     validate_data(data)
-    pending_or_running_pipelines = list(
-        filter(lambda x: x.pipeline.status in [TStatusEnum.PENDING, TStatusEnum.RUNNING], pipeline_queue)
-    )
-    if pending_or_running_pipelines:
-        return pending_or_running_pipelines[-1]
-    pid = len(pipeline_queue) + 1
-    pipeline = set_global_pipeline(pid)
-    background_tasks.add_task(sub_render_video, data, pid)
+    queue = get_job_queue()
+    pid = queue.enqueue(data.model_dump(mode="json"))
     return {
-        "pipeline": serialize_pipeline(pipeline),
+        "pipeline": serialize_pipeline(queue.get(pid)),
+        "queued": queue.count_pending(),
     }
 
 
@@ -148,46 +140,24 @@ class TTasksStatusData(PtBaseModel):
 
 
 @bp.post("/api/pipeline/status")
-async def render_status(data: TTasksStatusData) -> TPipeline | dict:
-    pipeline = get_pipeline_by_id(data.pid)
+def render_status(data: TTasksStatusData) -> TPipeline | dict:
+    pipeline = get_job_queue().get(data.pid)
     if not pipeline:
         return {}
-    pbar = pipeline.progress_bar
-    return TPipeline(
-        pid=pipeline.pid,
-        status=pipeline.pipeline.status,
-        video_path=str(pipeline.pipeline.video_path),
-        completed=pipeline.pipeline.completed,
-        total=pipeline.pipeline.total,
-        interrupt_processing=pipeline.interrupt_processing,
-        processing_interrupted=pipeline.processing_interrupted(),
-        subtasks=[
-            {
-                "description": p.desc,
-                "total": p.total,
-                "completed": p.n,
-            }
-            for p in [
-                pbar.pbar_config,
-                pbar.pbar_preprocess_image,
-                pbar.pbar_image_2_image,
-                pbar.pbar_load_model,
-                pbar.pbar_animate,
-                pbar.pbar_unload_models,
-                pbar.pbar_make_video,
-            ]
-        ],
-    )
+    return pipeline
 
 
-class TTasksStatusData(PtBaseModel):
-    pid: int
+@bp.get("/api/pipeline/{pid}/preview")
+def render_preview(pid: int):
+    preview = get_job_queue().get_preview(pid)
+    if not preview:
+        return Response(status_code=404)
+    return Response(content=preview, media_type="image/webp", headers={"Cache-Control": "no-store"})
 
 
 @bp.post("/api/pipeline/interrupt")
 def render_interrupt(data: TTasksStatusData):
-    pipeline = get_pipeline_by_id(data.pid)
-    pipeline.interrupt_current_processing()
+    get_job_queue().request_interrupt(data.pid)
     return {}
 
 
@@ -22,6 +22,7 @@ from animatediff.generate import (
     create_us_pipeline,
     img2img_preprocess,
     load_controlnet_models,
+    merge_project_loras,
     region_preprocess,
     run_inference,
     run_upscale,
@@ -30,11 +31,22 @@ from animatediff.generate import (
     wild_card_conversion,
 )
 from animatediff.globals import g
-from animatediff.pipelines import load_text_embeddings
-from animatediff.settings import CKPT_EXTENSIONS, InferenceConfig, get_infer_config, get_project_setting
+from animatediff.ip_adapter import clear_image_encoders
+from animatediff.pipelines import load_text_embeddings, pick_context_schedule
+from animatediff.pipelines.pool import PipelinePool, get_pipeline_key
+from animatediff.settings import (
+    CKPT_EXTENSIONS,
+    InferenceConfig,
+    PipelinePoolConfig,
+    get_infer_config,
+    get_project_setting,
+)
 from animatediff.utils.civitai2config import generate_config_from_civitai_info
+from animatediff.utils.frame_store import get_frame_store
 from animatediff.utils.model import checkpoint_to_pipeline, fix_checkpoint_if_needed, get_base_model
 from animatediff.utils.pipeline import send_to_device
+from animatediff.utils.stage_handoff import get_active_handoff
+from animatediff.utils.torch_compact import is_oom
 from animatediff.utils.util import (
     is_sdxl_checkpoint,
     is_v2_motion_module,
@@ -106,8 +118,9 @@ cli.add_typer(stylize, name="stylize")
 cli.add_typer(ama, name="ama")
 
 # mildly cursed globals to allow for reuse of the pipeline if we're being called as a module
+pool_config = PipelinePoolConfig()
+pipeline_pool = PipelinePool(max_pipelines=pool_config.max_pipelines, max_bytes=int(pool_config.max_gb * 1024**3))
 g_pipeline: Optional[DiffusionPipeline] = None
-last_model_path: Optional[Path] = None
 
 
 def version_callback(value: bool):
@@ -165,6 +178,14 @@ def generate(
         logger.warning("For motion module v1, the maximum value of context is 24. Set to 24")
         context = 24
 
+    context_schedule = project_setting.context_schedule
+    if context_schedule == "auto":
+        # run_inference hands stride + 1 to the pipeline
+        context_schedule = pick_context_schedule(
+            project_setting.steps, length, context, stride + 1, overlap, project_setting.context_min_coverage
+        )
+        logger.info(f"auto context schedule: {context_schedule}")
+
     # turn the device string into a torch.device
     torch_device: torch.device = torch.device(device)
 
@@ -187,6 +208,9 @@ def generate(
     pbar.update(10)
     g.pipeline.pipeline.completed = 20
 
+    # set when stylize runs its passes back to back in this process
+    handoff = get_active_handoff()
+
     controlnet_image_map, controlnet_type_map, controlnet_ref_map = controlnet_preprocess(
         project_dir,
         save_dir,
@@ -196,6 +220,7 @@ def generate(
         length,
         device,
         is_sdxl,
+        handoff=handoff,
     )
     pbar.pbar_preprocess_image.update(90)
     pbar.pbar_image_2_image.update(50)
@@ -206,24 +231,30 @@ def generate(
         width,
         height,
         length,
+        handoff=handoff,
     )
     pbar.pbar_image_2_image.update(50)
+    if handoff is not None:
+        # the preprocessed maps hold what is needed, don't keep the previous pass's frames through denoising
+        handoff.release()
 
     # beware the pipeline
     global g_pipeline
-    global last_model_path
     pbar.pbar_load_model.update(20)
-    if g_pipeline is None or last_model_path != path_mgr.checkpoints / project_setting.checkpoint:
-        g_pipeline = create_pipeline(
+    g_pipeline, is_warm = pipeline_pool.get(
+        get_pipeline_key(project_setting, length, is_sdxl),
+        lambda: create_pipeline(
             base_model=base_model_path,
             project_setting=project_setting,
             infer_config=infer_config,
             video_length=length,
             is_sdxl=is_sdxl,
-        )
-        last_model_path = path_mgr.checkpoints / project_setting.checkpoint
-    else:
+            device=torch_device,
+        ),
+    )
+    if is_warm:
         logger.info("Pipeline already loaded, skipping initialization")
+        merge_project_loras(g_pipeline, project_setting, is_sdxl=is_sdxl)
         # reload TIs; create_pipeline does this for us, but they may have changed
         # since load time if we're being called from another package
         load_text_embeddings(g_pipeline, is_sdxl=is_sdxl)
@@ -294,37 +325,48 @@ def generate(
             logger.info(f"Generation seed: {seed}")
 
             # pgr.update_phrase(1, "Step 05/08: Run Interference...")
-            output = run_inference(
-                pipeline=g_pipeline,
-                n_prompt=n_prompt,
-                seed=seed,
-                steps=project_setting.steps,
-                guidance_scale=project_setting.guidance_scale,
-                unet_batch_size=project_setting.unet_batch_size,
-                width=width,
-                height=height,
-                duration=length,
-                idx=gen_num,
-                out_dir=save_dir,
-                context_frames=context,
-                context_overlap=overlap,
-                context_stride=stride,
-                clip_skip=project_setting.clip_skip,
-                controlnet_map=project_setting.controlnet_map,
-                controlnet_image_map=controlnet_image_map,
-                controlnet_type_map=controlnet_type_map,
-                controlnet_ref_map=controlnet_ref_map,
-                no_frames=no_frames,
-                img2img_map=img2img_map,
-                ip_adapter_config_map=ip_adapter_config_map,
-                region_list=region_list,
-                region_condi_list=region_condi_list,
-                output_map=project_setting.output,
-                is_single_prompt_mode=project_setting.is_single_prompt_mode,
-                is_sdxl=is_sdxl,
-                apply_lcm_lora=project_setting.apply_lcm_lora,
-                gradual_latent_map=project_setting.gradual_latent_hires_fix_map,
-            )
+            try:
+                output = run_inference(
+                    pipeline=g_pipeline,
+                    n_prompt=n_prompt,
+                    seed=seed,
+                    steps=project_setting.steps,
+                    guidance_scale=project_setting.guidance_scale,
+                    unet_batch_size=project_setting.unet_batch_size,
+                    width=width,
+                    height=height,
+                    duration=length,
+                    idx=gen_num,
+                    out_dir=save_dir,
+                    context_frames=context,
+                    context_overlap=overlap,
+                    context_stride=stride,
+                    context_schedule=context_schedule,
+                    clip_skip=project_setting.clip_skip,
+                    controlnet_map=project_setting.controlnet_map,
+                    controlnet_image_map=controlnet_image_map,
+                    controlnet_type_map=controlnet_type_map,
+                    controlnet_ref_map=controlnet_ref_map,
+                    no_frames=no_frames,
+                    img2img_map=img2img_map,
+                    ip_adapter_config_map=ip_adapter_config_map,
+                    region_list=region_list,
+                    region_condi_list=region_condi_list,
+                    output_map=project_setting.output,
+                    is_single_prompt_mode=project_setting.is_single_prompt_mode,
+                    is_sdxl=is_sdxl,
+                    apply_lcm_lora=project_setting.apply_lcm_lora,
+                    gradual_latent_map=project_setting.gradual_latent_hires_fix_map,
+                    handoff=handoff,
+                )
+            except RuntimeError as e:
+                if is_oom(e):
+                    # whatever was kept warm may be what no longer fits, start the next job from scratch
+                    logger.warning("Out of memory, dropping the warm pipelines and image encoders")
+                    g_pipeline = None
+                    pipeline_pool.clear()
+                    clear_image_encoders()
+                raise
             outputs.append(output)
             torch.cuda.empty_cache()
 
@@ -876,8 +918,6 @@ def refine(
     ] = Path("refine/"),
 ):
     """Create upscaled or improved video using pre-generated frames."""
-    import shutil
-
     from PIL import Image
 
     from animatediff.rife.rife import rife_interpolate
@@ -957,10 +997,11 @@ def refine(
             c_dir = controlnet_img_dir.joinpath(c)
             c_dir.mkdir(parents=True, exist_ok=True)
 
-        shutil.copytree(frames_dir, controlnet_img_dir.joinpath("controlnet_tile"), dirs_exist_ok=True)
+        frame_store = get_frame_store(save_dir)
+        frame_store.link_tree(frames_dir, controlnet_img_dir.joinpath("controlnet_tile"))
         # TODO: fix
-        shutil.copytree(frames_dir, controlnet_img_dir.joinpath("controlnet_openpose"), dirs_exist_ok=True)
-        shutil.copytree(frames_dir, controlnet_img_dir.joinpath("controlnet_canny"), dirs_exist_ok=True)
+        frame_store.link_tree(frames_dir, controlnet_img_dir.joinpath("controlnet_openpose"))
+        frame_store.link_tree(frames_dir, controlnet_img_dir.joinpath("controlnet_canny"))
 
         project_setting.controlnet_map["input_image_dir"] = os.path.relpath(controlnet_img_dir.absolute(), data_dir)
         project_setting.controlnet_map["is_loop"] = False
@@ -1026,3 +1067,35 @@ def refine(
         save_output(out_images, rife_img_dir, out_file, project_setting.output, True, save_frames=None, save_video=None)
 
     logger.info(f"Refined results are output to {generated_dir}")
+
+
+@cli.command()
+def worker(
+    name: Annotated[
+        Optional[str],
+        typer.Option(
+            "--name",
+            "-n",
+            help="Worker name shown in the job db and logs (default: hostname:pid:device)",
+        ),
+    ] = None,
+    device: Annotated[
+        str,
+        typer.Option("--device", "-d", help="CUDA device to run on (cuda, cuda:id)", rich_help_panel="Advanced"),
+    ] = "cuda",
+    poll_interval: Annotated[
+        float,
+        typer.Option("--poll-interval", "-p", min=0.1, help="Seconds to wait between polls of an empty queue"),
+    ] = 1.0,
+):
+    """Render jobs submitted through the web api, one GPU per worker process."""
+    from animatediff.adw.worker import default_worker_name, run_worker
+
+    torch_device = torch.device(device)
+    # jobs render on the current cuda device, there is no way to send them elsewhere
+    if torch_device.type != "cuda":
+        raise ValueError(f"worker only runs on cuda devices, got {device}")
+    if torch_device.index is not None:
+        torch.cuda.set_device(torch_device)
+
+    run_worker(name or default_worker_name(device), poll_interval=poll_interval)
@@ -31,6 +31,8 @@ class PathMgr:
     demo_prompt_json = REPO_DIR / "config/prompts/prompt_travel.json"
     repo = REPO_DIR
     rvm = MODELS_DIR / "rvm"
+    jobs_db = CACHE_DIR / "jobs.sqlite3"
+    model_index = CACHE_DIR / "model_index.json"
 
 
 path_mgr = PathMgr()
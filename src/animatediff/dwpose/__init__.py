@@ -6,6 +6,7 @@
 # 4th Edited by ControlNet (added face and correct hands)
 
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 from ..utils.torch_compact import get_torch_device
 
@@ -37,6 +38,29 @@ def draw_pose(pose, H, W):
     return canvas
 
 
+def get_pose(candidate, subset, H, W):
+    nums, keys, locs = candidate.shape
+    candidate[..., 0] /= float(W)
+    candidate[..., 1] /= float(H)
+    body = candidate[:, :18].copy()
+    body = body.reshape(nums * 18, locs)
+    # index of each visible body keypoint in body, -1 for the rest
+    score = np.where(subset[:, :18] > 0.3, np.arange(nums * 18).reshape(nums, 18), -1).astype(subset.dtype)
+
+    un_visible = subset < 0.3
+    candidate[un_visible] = -1
+
+    foot = candidate[:, 18:24]
+
+    faces = candidate[:, 24:92]
+
+    hands = candidate[:, 92:113]
+    hands = np.vstack([hands, candidate[:, 113:]])
+
+    bodies = dict(candidate=body, subset=score)
+    return dict(bodies=bodies, hands=hands, faces=faces)
+
+
 class DWposeDetector:
     def __init__(self):
         pass
@@ -46,42 +70,24 @@ class DWposeDetector:
         return self
 
     def __call__(self, input_image, detect_resolution=512, image_resolution=512, output_type="pil", **kwargs):
-        input_image = cv2.cvtColor(np.array(input_image, dtype=np.uint8), cv2.COLOR_RGB2BGR)
+        return self.process_batch([input_image], detect_resolution, image_resolution, output_type, **kwargs)[0]
+
+    def process_batch(self, input_images, detect_resolution=512, image_resolution=512, output_type="pil", **kwargs):
+        """Detect the poses of a sequence of frames with batched onnx sessions, one pose map per frame."""
+        images = []
+        for input_image in input_images:
+            input_image = cv2.cvtColor(np.array(input_image, dtype=np.uint8), cv2.COLOR_RGB2BGR)
+            input_image = HWC3(input_image)
+            images.append(resize_image(input_image, detect_resolution))
 
-        input_image = HWC3(input_image)
-        input_image = resize_image(input_image, detect_resolution)
-        H, W, C = input_image.shape
         if not hasattr(self, "pose_estimation"):
             self.to(torch.device(get_torch_device()))
         with torch.no_grad():
-            candidate, subset = self.pose_estimation(input_image)
-            nums, keys, locs = candidate.shape
-            candidate[..., 0] /= float(W)
-            candidate[..., 1] /= float(H)
-            body = candidate[:, :18].copy()
-            body = body.reshape(nums * 18, locs)
-            score = subset[:, :18]
-            for i in range(len(score)):
-                for j in range(len(score[i])):
-                    if score[i][j] > 0.3:
-                        score[i][j] = int(18 * i + j)
-                    else:
-                        score[i][j] = -1
-
-            un_visible = subset < 0.3
-            candidate[un_visible] = -1
-
-            foot = candidate[:, 18:24]
-
-            faces = candidate[:, 24:92]
-
-            hands = candidate[:, 92:113]
-            hands = np.vstack([hands, candidate[:, 113:]])
-
-            bodies = dict(candidate=body, subset=score)
-            pose = dict(bodies=bodies, hands=hands, faces=faces)
-
-            detected_map = draw_pose(pose, H, W)
+            poses = self.pose_estimation.batch(images)
+
+        def render(input_image, candidate, subset):
+            H, W, C = input_image.shape
+            detected_map = draw_pose(get_pose(candidate, subset, H, W), H, W)
             detected_map = HWC3(detected_map)
 
             img = resize_image(input_image, image_resolution)
@@ -93,3 +99,7 @@ class DWposeDetector:
                 detected_map = Image.fromarray(detected_map)
 
             return detected_map
+
+        # opencv drawing releases the gil
+        with ThreadPoolExecutor(max_workers=min(len(images), os.cpu_count() or 1, 8)) as executor:
+            return list(executor.map(render, images, *zip(*poses)))
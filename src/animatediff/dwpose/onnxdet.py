@@ -97,31 +97,46 @@ def preprocess(img, input_size, swap=(2, 0, 1)):
     return padded_img, r
 
 
-def inference_detector(session, oriImg):
+def run_batched(session, inputs: np.ndarray, max_batch_size: int = 16) -> list[np.ndarray]:
+    """Run session over the first axis of inputs, batch_size at a time when the model has a dynamic batch axis."""
+    model_input = session.get_inputs()[0]
+    fixed = model_input.shape[0] if isinstance(model_input.shape[0], int) and model_input.shape[0] > 0 else None
+    batch_size = fixed or max(max_batch_size, 1)
+
+    all_out = []
+    for i in range(0, len(inputs), batch_size):
+        batch = inputs[i : i + batch_size]
+        n = len(batch)
+        if fixed and n < fixed:
+            batch = np.concatenate([batch, np.zeros((fixed - n, *batch.shape[1:]), dtype=batch.dtype)])
+        all_out.append([out[:n] for out in session.run(None, {model_input.name: batch})])
+    return [np.concatenate(outs, axis=0) for outs in zip(*all_out)]
+
+
+def get_person_boxes(predictions, ratio, nms_thr=0.45, score_thr=0.3):
+    """Person boxes (xyxy, in original image coordinates) from the yolox predictions of one image."""
+    # only the person class is used and nms is class-aware, so the other 79 classes never need suppressing.
+    # boxes under score_thr can't suppress higher scored ones, filtering them first gives the same result
+    scores = predictions[:, 4] * predictions[:, 5]
+    valid = scores > score_thr
+    if not valid.any():
+        return np.zeros((0, 4), dtype=predictions.dtype)
+    boxes, scores = predictions[valid, :4], scores[valid]
+
+    boxes_xyxy = np.concatenate([boxes[:, :2] - boxes[:, 2:4] / 2.0, boxes[:, :2] + boxes[:, 2:4] / 2.0], axis=1)
+    boxes_xyxy /= ratio
+    return boxes_xyxy[nms(boxes_xyxy, scores, nms_thr)]
+
+
+def inference_detector_batch(session, oriImgs, max_batch_size=16):
     input_shape = (640, 640)
-    img, ratio = preprocess(oriImg, input_shape)
+    imgs, ratios = zip(*[preprocess(img, input_shape) for img in oriImgs])
 
-    ort_inputs = {session.get_inputs()[0].name: img[None, :, :, :]}
-    output = session.run(None, ort_inputs)
-    predictions = demo_postprocess(output[0], input_shape)[0]
+    output = run_batched(session, np.stack(imgs), max_batch_size)
+    predictions = demo_postprocess(output[0], input_shape)
 
-    boxes = predictions[:, :4]
-    scores = predictions[:, 4:5] * predictions[:, 5:]
+    return [get_person_boxes(p, ratio) for p, ratio in zip(predictions, ratios)]
 
-    boxes_xyxy = np.ones_like(boxes)
-    boxes_xyxy[:, 0] = boxes[:, 0] - boxes[:, 2] / 2.0
-    boxes_xyxy[:, 1] = boxes[:, 1] - boxes[:, 3] / 2.0
-    boxes_xyxy[:, 2] = boxes[:, 0] + boxes[:, 2] / 2.0
-    boxes_xyxy[:, 3] = boxes[:, 1] + boxes[:, 3] / 2.0
-    boxes_xyxy /= ratio
-    dets = multiclass_nms(boxes_xyxy, scores, nms_thr=0.45, score_thr=0.1)
-    if dets is not None:
-        final_boxes, final_scores, final_cls_inds = dets[:, :4], dets[:, 4], dets[:, 5]
-        isscore = final_scores > 0.3
-        iscat = final_cls_inds == 0
-        isbbox = [i and j for (i, j) in zip(isscore, iscat)]
-        final_boxes = final_boxes[isbbox]
-    else:
-        return []
 
-    return final_boxes
+def inference_detector(session, oriImg):
+    return inference_detector_batch(session, [oriImg])[0]
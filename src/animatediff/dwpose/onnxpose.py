@@ -5,6 +5,8 @@ import cv2
 import numpy as np
 import onnxruntime as ort
 
+from .onnxdet import run_batched
+
 
 def preprocess(
     img: np.ndarray, out_bbox, input_size: Tuple[int, int] = (192, 256)
@@ -373,11 +375,30 @@ def decode(simcc_x: np.ndarray, simcc_y: np.ndarray, simcc_split_ratio) -> Tuple
     return keypoints, scores
 
 
-def inference_pose(session, out_bbox, oriImg):
+def inference_pose_batch(session, out_bboxes, oriImgs, max_batch_size=16, simcc_split_ratio=2.0):
+    """Run RTMPose on the bboxes of a sequence of images at once, return per image (keypoints, scores)."""
     h, w = session.get_inputs()[0].shape[2:]
     model_input_size = (w, h)
-    resized_img, center, scale = preprocess(oriImg, out_bbox, model_input_size)
-    outputs = inference(session, resized_img)
-    keypoints, scores = postprocess(outputs, model_input_size, center, scale)
 
-    return keypoints, scores
+    crops, centers, scales, counts = [], [], [], []
+    for out_bbox, oriImg in zip(out_bboxes, oriImgs):
+        resized_img, center, scale = preprocess(oriImg, out_bbox, model_input_size)
+        crops += resized_img
+        centers += center
+        scales += scale
+        counts.append(len(resized_img))
+
+    inputs = np.stack(crops).transpose(0, 3, 1, 2).astype(np.float32)
+    simcc_x, simcc_y = run_batched(session, inputs, max_batch_size)[:2]
+    keypoints, scores = decode(simcc_x, simcc_y, simcc_split_ratio)
+
+    # rescale keypoints
+    centers, scales = np.array(centers)[:, None], np.array(scales)[:, None]
+    keypoints = keypoints / model_input_size * scales + centers - scales / 2
+
+    splits = np.cumsum(counts)[:-1]
+    return list(zip(np.split(keypoints, splits), np.split(scores, splits)))
+
+
+def inference_pose(session, out_bbox, oriImg):
+    return inference_pose_batch(session, [out_bbox], [oriImg])[0]
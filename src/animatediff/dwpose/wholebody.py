@@ -5,8 +5,8 @@ import onnxruntime as ort
 
 from ..consts import path_mgr
 from ..utils.torch_compact import get_execution_providers
-from .onnxdet import inference_detector
-from .onnxpose import inference_pose
+from .onnxdet import inference_detector_batch
+from .onnxpose import inference_pose_batch
 
 
 class Wholebody:
@@ -19,8 +19,17 @@ class Wholebody:
         self.session_pose = ort.InferenceSession(path_or_bytes=onnx_pose, providers=providers)
 
     def __call__(self, oriImg):
-        det_result = inference_detector(self.session_det, oriImg)
-        keypoints, scores = inference_pose(self.session_pose, det_result, oriImg)
+        return self.batch([oriImg])[0]
+
+    def batch(self, oriImgs, max_batch_size=16):
+        """Return (keypoints, scores) in openpose order for each image."""
+        det_results = inference_detector_batch(self.session_det, oriImgs, max_batch_size)
+        poses = inference_pose_batch(self.session_pose, det_results, oriImgs, max_batch_size)
+
+        # convert the people of all images in one go
+        counts = [len(scores) for _, scores in poses]
+        keypoints = np.concatenate([k for k, _ in poses])
+        scores = np.concatenate([s for _, s in poses])
 
         keypoints_info = np.concatenate((keypoints, scores[..., None]), axis=-1)
         # compute neck joint
@@ -33,6 +42,5 @@ class Wholebody:
         new_keypoints_info[:, openpose_idx] = new_keypoints_info[:, mmpose_idx]
         keypoints_info = new_keypoints_info
 
-        keypoints, scores = keypoints_info[..., :2], keypoints_info[..., 2]
-
-        return keypoints, scores
+        splits = np.cumsum(counts)[:-1]
+        return [(k[..., :2], k[..., 2]) for k in np.split(keypoints_info, splits)]
@@ -3,11 +3,12 @@ import logging
 import os
 import re
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 from itertools import chain
 from os import PathLike
 from pathlib import Path
-from typing import Any, Callable, Dict, List, Optional, Union
+from typing import Any, Callable, Dict, Iterable, List, Optional, Union
 
 import numpy as np
 import torch
@@ -43,13 +44,13 @@ from transformers import (
 
 from animatediff import get_dir
 from animatediff.adw.schema import TPerformance
-from animatediff.consts import CACHE_DIR, MODELS_DIR, path_mgr
+from animatediff.consts import MODELS_DIR, path_mgr
 from animatediff.dwpose import DWposeDetector
-from animatediff.globals import check_interrupted
+from animatediff.globals import check_interrupted, g
 from animatediff.models.clip import CLIPSkipTextModel
 from animatediff.models.unet import UNet3DConditionModel
 from animatediff.pipelines import AnimationPipeline, load_text_embeddings
-from animatediff.pipelines.lora import load_lcm_lora, load_lora_map
+from animatediff.pipelines.lora import get_lora_scales, load_lora_map, merge_lora_scales
 from animatediff.pipelines.pipeline_controlnet_img2img_reference import (
     StableDiffusionControlNetImg2ImgReferencePipeline,
 )
@@ -66,14 +67,23 @@ from animatediff.schema import (
     TProjectSetting,
     TUpscaleConfig,
 )
-from animatediff.settings import InferenceConfig
+from animatediff.settings import InferenceConfig, UpscaleBatchConfig
+from animatediff.utils.conversion_cache import conversion_cache
 from animatediff.utils.convert_from_ckpt import convert_ldm_vae_checkpoint
+from animatediff.utils.cpu_preprocessor import BlurPreProcessor, NullPreProcessor, TileResamplePreProcessor
+from animatediff.utils.device import dtype_for_model
+from animatediff.utils.embedding_cache import model_file_id
 from animatediff.utils.model import ensure_motion_modules, get_checkpoint_weights, get_checkpoint_weights_sdxl
+from animatediff.utils.preprocess_engine import PreprocessEngine
+from animatediff.utils.preview import encode_webp, latents_to_rgb
+from animatediff.utils.stage_handoff import StageHandoff
+from animatediff.utils.torch_compact import get_free_device_memory, is_oom
 from animatediff.utils.util import (
     get_resized_image,
     get_resized_image2,
     get_resized_images,
     get_tensor_interpolation_method,
+    iter_rgb_frames,
     prepare_animatediff_controlnet,
     prepare_dwpose,
     prepare_ip_adapter,
@@ -134,10 +144,11 @@ def load_tensors(path: Path, framework="pt", device="cpu"):
     return tensors
 
 
-def load_motion_lora(unet, lora_path: Path, alpha=1.0):
+def get_motion_lora_deltas(lora_path: Path, alpha=1.0) -> dict[str, torch.Tensor]:
+    """{unet parameter name: alpha * up @ down} for a motion lora."""
     state_dict = load_tensors(lora_path)
 
-    # directly update weight in diffusers model
+    deltas = {}
     for key in state_dict:
         # only process lora down key
         if "up." in key:
@@ -146,20 +157,22 @@ def load_motion_lora(unet, lora_path: Path, alpha=1.0):
         up_key = key.replace(".down.", ".up.")
         model_key = key.replace("processor.", "").replace("_lora", "").replace("down.", "").replace("up.", "")
         model_key = model_key.replace("to_out.", "to_out.0.")
-        layer_infos = model_key.split(".")[:-1]
-
-        curr_layer = unet
-        try:
-            while len(layer_infos) > 0:
-                temp_name = layer_infos.pop(0)
-                curr_layer = curr_layer.__getattr__(temp_name)
-        except:
-            logger.info(f"{model_key} not found")
-            continue
 
         weight_down = state_dict[key]
         weight_up = state_dict[up_key]
-        curr_layer.weight.data += alpha * torch.mm(weight_up, weight_down).to(curr_layer.weight.data.device)
+        deltas[model_key] = alpha * torch.mm(weight_up, weight_down)
+    return deltas
+
+
+def load_motion_lora(unet, lora_path: Path, alpha=1.0):
+    params = dict(unet.named_parameters())
+
+    # directly update weight in diffusers model
+    for model_key, delta in get_motion_lora_deltas(lora_path, alpha).items():
+        if model_key not in params:
+            logger.info(f"{model_key} not found")
+            continue
+        params[model_key].data += delta.to(params[model_key].data.device)
 
 
 class SegPreProcessor:
@@ -168,11 +181,12 @@ class SegPreProcessor:
         self.processor = UperNetForSemanticSegmentation.from_pretrained("openmmlab/upernet-convnext-small")
 
     def __call__(self, input_image, detect_resolution=512, image_resolution=512, output_type="pil", **kwargs):
-        input_array = np.array(input_image, dtype=np.uint8)
-        input_array = HWC3(input_array)
-        input_array = aux_resize_image(input_array, detect_resolution)
+        return self.process_batch([input_image], detect_resolution, image_resolution)[0]
+
+    def process_batch(self, input_images, detect_resolution=512, image_resolution=512, **kwargs):
+        input_arrays = [aux_resize_image(HWC3(np.array(img, dtype=np.uint8)), detect_resolution) for img in input_images]
 
-        pixel_values = self.image_processor(input_array, return_tensors="pt").pixel_values
+        pixel_values = self.image_processor(input_arrays, return_tensors="pt").pixel_values
 
         with torch.no_grad():
             outputs = self.processor(pixel_values.to(self.processor.device))
@@ -184,60 +198,22 @@ class SegPreProcessor:
         )
         outputs.attentions = outputs.attentions.to("cpu") if outputs.attentions is not None else outputs.attentions
 
-        seg = self.image_processor.post_process_semantic_segmentation(outputs, target_sizes=[input_image.size[::-1]])[0]
-        color_seg = np.zeros((seg.shape[0], seg.shape[1], 3), dtype=np.uint8)  # height, width, 3
-
-        for label, color in enumerate(ade_palette()):
-            color_seg[seg == label, :] = color
-
-        color_seg = color_seg.astype(np.uint8)
-        color_seg = aux_resize_image(color_seg, image_resolution)
-        color_seg = Image.fromarray(color_seg)
-
-        return color_seg
-
-
-class NullPreProcessor:
-    def __call__(self, input_image, **kwargs):
-        return input_image
-
-
-class BlurPreProcessor:
-    def __call__(self, input_image, sigma=5.0, **kwargs):
-        import cv2
-
-        input_array = np.array(input_image, dtype=np.uint8)
-        input_array = HWC3(input_array)
-
-        dst = cv2.GaussianBlur(input_array, (0, 0), sigma)
-
-        return Image.fromarray(dst)
-
-
-class TileResamplePreProcessor:
-    def resize(self, input_image, resolution):
-        import cv2
-
-        H, W, C = input_image.shape
-        H = float(H)
-        W = float(W)
-        k = float(resolution) / min(H, W)
-        H *= k
-        W *= k
-        img = cv2.resize(input_image, (int(W), int(H)), interpolation=cv2.INTER_LANCZOS4 if k > 1 else cv2.INTER_AREA)
-        return img
-
-    def __call__(self, input_image, down_sampling_rate=1.0, **kwargs):
-        input_array = np.array(input_image, dtype=np.uint8)
-        input_array = HWC3(input_array)
+        segs = self.image_processor.post_process_semantic_segmentation(
+            outputs, target_sizes=[img.size[::-1] for img in input_images]
+        )
 
-        H, W, C = input_array.shape
+        results = []
+        palette = ade_palette()
+        for seg in segs:
+            color_seg = np.zeros((seg.shape[0], seg.shape[1], 3), dtype=np.uint8)  # height, width, 3
 
-        target_res = min(H, W) / down_sampling_rate
+            for label, color in enumerate(palette):
+                color_seg[seg == label, :] = color
 
-        dst = self.resize(input_array, target_res)
+            color_seg = aux_resize_image(color_seg, image_resolution)
+            results.append(Image.fromarray(color_seg))
 
-        return Image.fromarray(dst)
+        return results
 
 
 controlnet_address_table = {
@@ -393,6 +369,16 @@ def clear_controlnet_preprocessor(type_str=None):
         torch.cuda.empty_cache()
 
 
+def merge_project_loras(pipeline, project_setting: TProjectSetting, is_sdxl: bool = False):
+    """Merge the plain loras and the lcm lora of project_setting, unmerging whatever was merged before."""
+    lcm_lora_scale = None
+    if project_setting.apply_lcm_lora:
+        prepare_lcm_lora()
+        lcm_lora_scale = project_setting.lcm_lora_scale
+    lora_scales = get_lora_scales(project_setting.lora_map, lcm_lora_scale, is_sdxl)
+    merge_lora_scales(pipeline, lora_scales, is_sdxl)
+
+
 def create_pipeline_sdxl(
         base_model: Union[str, PathLike],
         model_config: TProjectSetting,
@@ -511,6 +497,8 @@ def create_pipeline_sdxl(
         scheduler=scheduler,
         controlnet_map=None,
     )
+    # identifies the text encoder weights for the text embedding cache
+    pipeline.text_encoder_source = model_file_id(model_path) if model_config.checkpoint is not None else str(base_model)
 
     del vae
     del text_encoder
@@ -521,10 +509,7 @@ def create_pipeline_sdxl(
 
     torch.cuda.empty_cache()
 
-    if model_config.apply_lcm_lora:
-        prepare_lcm_lora()
-        load_lcm_lora(pipeline, model_config.lcm_lora_scale, is_sdxl=True)
-
+    merge_project_loras(pipeline, model_config, is_sdxl=True)
     load_lora_map(pipeline, model_config.lora_map, video_length, is_sdxl=True)
 
     # Load TI embeddings
@@ -539,9 +524,11 @@ def create_pipeline(
         infer_config: InferenceConfig,
         video_length: int = 16,
         is_sdxl: bool = False,
+        device: Optional[torch.device] = None,
 ) -> AnimationPipeline:
     """Create an AnimationPipeline from a pretrained model.
     Uses the base_model argument to load or download the pretrained reference pipeline model.
+    With a device the unet is built there in the dtype send_to_device would pick, instead of fp32 on the host.
     """
     # make sure motion_module is a Path and exists
     logger.info("Checking motion module...")
@@ -571,12 +558,6 @@ def create_pipeline(
     tokenizer: CLIPTokenizer = CLIPTokenizer.from_pretrained(base_model, subfolder="tokenizer")
     text_encoder: CLIPSkipTextModel = CLIPSkipTextModel.from_pretrained(base_model, subfolder="text_encoder")
     vae: AutoencoderKL = AutoencoderKL.from_pretrained(base_model, subfolder="vae")
-    unet: UNet3DConditionModel = UNet3DConditionModel.from_pretrained_2d(
-        pretrained_model_path=base_model,
-        motion_module_path=motion_module,
-        subfolder="unet",
-        unet_additional_kwargs=infer_config.unet_additional_kwargs,
-    )
     feature_extractor = CLIPImageProcessor.from_pretrained(base_model, subfolder="feature_extractor")
 
     # set up scheduler
@@ -606,11 +587,37 @@ def create_pipeline(
     else:
         raise FileNotFoundError(f"model_path {model_path} is not a file or directory")
 
-    # Load into the unet, TE, and VAE
+    # motion loras are folded into the weights while they are assigned
+    motion_lora_deltas = {}
+    for l in project_setting.motion_lora_map:
+        lora_path = path_mgr.motion_loras / l
+        logger.info(f"loading motion lora {lora_path=}")
+        if lora_path.is_file():
+            logger.info(f"Loading motion lora {lora_path}")
+            logger.info(f"alpha = {project_setting.motion_lora_map[l]}")
+            for k, delta in get_motion_lora_deltas(lora_path, alpha=project_setting.motion_lora_map[l]).items():
+                motion_lora_deltas[k] = motion_lora_deltas[k] + delta if k in motion_lora_deltas else delta
+        else:
+            raise ValueError(f"{lora_path=} not found")
+
+    # Build the unet straight from the base unet, motion module and checkpoint weights
     logger.info("Merging weights into UNet...")
-    _, unet_unex = unet.load_state_dict(unet_state_dict, strict=False)
+    unet: UNet3DConditionModel = UNet3DConditionModel.from_pretrained_2d(
+        pretrained_model_path=base_model,
+        motion_module_path=motion_module,
+        subfolder="unet",
+        unet_additional_kwargs=infer_config.unet_additional_kwargs,
+        state_dict=unet_state_dict,
+        weight_deltas=motion_lora_deltas,
+        torch_dtype=dtype_for_model("unet", device) if device is not None else None,
+        device=device,
+    )
+    unet_unex = unet_state_dict.keys() - unet.state_dict().keys()
     if len(unet_unex) > 0:
         raise ValueError(f"UNet has unexpected keys: {unet_unex}")
+    del unet_state_dict
+
+    # Load into the TE and VAE
     tenc_missing, _ = text_encoder.load_state_dict(tenc_state_dict, strict=False)
     if len(tenc_missing) > 0:
         raise ValueError(f"TextEncoder has missing keys: {tenc_missing}")
@@ -629,17 +636,6 @@ def create_pipeline(
             tensors = convert_ldm_vae_checkpoint(tensors, vae.config)
             vae.load_state_dict(tensors)
 
-    # motion lora
-    for l in project_setting.motion_lora_map:
-        lora_path = path_mgr.motion_loras / l
-        logger.info(f"loading motion lora {lora_path=}")
-        if lora_path.is_file():
-            logger.info(f"Loading motion lora {lora_path}")
-            logger.info(f"alpha = {project_setting.motion_lora_map[l]}")
-            load_motion_lora(unet, lora_path, alpha=project_setting.motion_lora_map[l])
-        else:
-            raise ValueError(f"{lora_path=} not found")
-
     pipeline = AnimationPipeline(
         vae=vae,
         text_encoder=text_encoder,
@@ -649,15 +645,14 @@ def create_pipeline(
         feature_extractor=feature_extractor,
         controlnet_map=None,
     )
+    # identifies the text encoder weights for the text embedding cache
+    pipeline.text_encoder_source = model_file_id(model_path)
     # project_setting.
 
     if project_setting.performance == TPerformance.QUALITY:
         pipeline.enable_freeu(0.9, 0.2, 1.5, 1.6)
 
-    if project_setting.apply_lcm_lora:
-        prepare_lcm_lora()
-        load_lcm_lora(pipeline, project_setting.lcm_lora_scale, is_sdxl=False)
-
+    merge_project_loras(pipeline, project_setting, is_sdxl=False)
     load_lora_map(pipeline, project_setting.lora_map, video_length)
 
     # Load TI embeddings
@@ -730,14 +725,7 @@ def create_us_pipeline(
         logger.info(f"Loading weights from {model_path}")
         if model_path.is_file():
 
-            def is_empty_dir(path):
-                import os
-
-                return len(os.listdir(path)) == 0
-
-            save_path = CACHE_DIR.joinpath("huggingface/" + model_path.stem + "_" + str(model_path.stat().st_size))
-            save_path.mkdir(exist_ok=True)
-            if save_path.is_dir() and is_empty_dir(save_path):
+            def save_pretrained(save_path):
                 # StableDiffusionControlNetImg2ImgPipeline.from_single_file does not exist in version 18.2
                 logger.debug("Loading from single checkpoint file")
                 tmp_pipeline = StableDiffusionPipeline.from_single_file(
@@ -746,6 +734,8 @@ def create_us_pipeline(
                 tmp_pipeline.save_pretrained(save_path, safe_serialization=True)
                 del tmp_pipeline
 
+            save_path = conversion_cache.get_pipeline_dir(model_path, save_pretrained)
+
             if use_controlnet_ref:
                 pipeline = StableDiffusionControlNetImg2ImgReferencePipeline.from_pretrained(
                     save_path,
@@ -789,6 +779,7 @@ def create_us_pipeline(
     pipeline.scheduler = scheduler
 
     # lora
+    merged_loras = []
     for l in model_config.lora_map:
         lora_path = path_mgr.loras / l
         if lora_path.is_file():
@@ -799,6 +790,10 @@ def create_us_pipeline(
             logger.info(f"Loading lora {lora_path}")
             logger.info(f"alpha = {alpha}")
             load_safetensors_lora2(pipeline.text_encoder, pipeline.unet, lora_path, alpha=alpha, is_animatediff=False)
+            merged_loras.append((model_file_id(lora_path), alpha))
+
+    # the loras are merged for good here, so they are part of the source
+    pipeline.text_encoder_source = [model_file_id(model_path), merged_loras]
 
     # Load TI embeddings
     load_text_embeddings(pipeline)
@@ -827,6 +822,7 @@ def controlnet_preprocess(
         duration: int = 16,
         device_str: Optional[str] = None,
         is_sdxl: bool = False,
+        handoff: Optional[StageHandoff] = None,
 ):
     controlnet_image_map = defaultdict(dict)
 
@@ -836,59 +832,58 @@ def controlnet_preprocess(
     save_detectmap = controlnet_map.save_detectmap
 
     cache_dir = path_mgr.projects / project_dir / "cache"
-    cache_dir.mkdir(exist_ok=True)
+    engine = PreprocessEngine(
+        cache_dir / "controlnet",
+        num_workers=controlnet_map.preprocess_workers,
+        batch_size=controlnet_map.preprocess_batch_size,
+    )
 
     @check_interrupted
     def processing_controlnet_images(cn_name, cn: TAnyControlnet):
-        processed = False
         if isinstance(cn, TControlnetRef):
             return
         if not cn.enable:
             return
         if not is_valid_controlnet_type(cn_name, is_sdxl):
             return
-        img_dir = c_image_dir / controlnet_name
-        images_to_be_processing = sorted(glob.glob(os.path.join(img_dir, "[0-9]*.png"), recursive=False))
+        # frames of the previous in-process pass, instead of its pngs
+        handoff_images = handoff.get(cn_name) if handoff else None
+        if handoff_images is not None:
+            images_to_be_processing = handoff_images
+        else:
+            img_dir = c_image_dir / cn_name
+            images_to_be_processing = {
+                int(Path(img_path).stem): img_path
+                for img_path in sorted(glob.glob(os.path.join(img_dir, "[0-9]*.png"), recursive=False))
+            }
         if not images_to_be_processing:
             return
-        preprocessor_config = controlnet.preprocessor
-
-        for img_path in images_to_be_processing:
-            frame_no = int(Path(img_path).stem)
-            cache_image_path = os.path.join(cache_dir, f"{frame_no:08d}_{cn_name}.png")
-
-            def has_cache():
-                if not os.path.exists(cache_image_path):
-                    return False
-                original_img_mtime = os.path.getmtime(img_path)
-                preprocessed_img_mtime = os.path.getmtime(cache_image_path)
-                if original_img_mtime > preprocessed_img_mtime:
-                    # If the original image isn't newer than the preprocessed one, use the preprocessed image
-                    return False
-                return True
+        preprocessor_config = cn.preprocessor
 
+        frames = {}
+        for frame_no, img in images_to_be_processing.items():
             if frame_no > duration:
                 continue
-            if not cn.use_preprocessor:
-                # TODO: fix
-                # read cache if cache exists, use cache
-                # if not, create cache
-                if not has_cache():
-                    controlnet_image_map[frame_no][cn_name] = get_resized_image2(img_path, 512)
-                else:
-                    controlnet_image_map[frame_no][cn_name] = Image.open(cache_image_path)
+            frames[frame_no] = img
 
-                controlnet_image_map[frame_no][cn_name].save(cache_image_path)
-                continue
+        if cn.use_preprocessor:
+            pre_type = preprocessor_config.type or default_preprocessor_table.get(cn_name, "none")
+            params = preprocessor_config.param
+        else:
+            pre_type = "none"
+            params = {}
 
-            # 检查缓存文件是否存在
-            if has_cache():
-                controlnet_image_map[frame_no][cn_name] = Image.open(cache_image_path)
-                continue
-            img = get_resized_image2(img_path, 512)
-            preprocessed_img = get_preprocessor(cn_name, preprocessor_config)(img, **preprocessor_config.param)
-            controlnet_image_map[frame_no][cn_name] = preprocessed_img
-            preprocessed_img.save(cache_image_path)
+        if handoff_images is not None:
+            detected = engine.run_images(
+                pre_type, lambda: get_preprocessor(cn_name, preprocessor_config), frames, params, size=512
+            )
+            processed = True
+        else:
+            detected, processed = engine.run(
+                pre_type, lambda: get_preprocessor(cn_name, preprocessor_config), frames, params, size=512
+            )
+        for frame_no, img in detected.items():
+            controlnet_image_map[frame_no][cn_name] = img
 
         controlnet_type_map[cn_name] = {
             "controlnet_conditioning_scale": cn.controlnet_conditioning_scale,
@@ -1166,6 +1161,7 @@ def img2img_preprocess(
         width: int = 512,
         height: int = 512,
         duration: int = 16,
+        handoff: Optional[StageHandoff] = None,
 ):
     img2img_map = {}
 
@@ -1174,16 +1170,22 @@ def img2img_preprocess(
     if not img2img_config_map:
         return None
     if img2img_config_map.enable:
-        image_dir = project_dir / img2img_config_map.init_img_dir
-        imgs = sorted(glob.glob(os.path.join(image_dir, "[0-9]*.png"), recursive=False))
+        handoff_images = handoff.get("img2img") if handoff else None
+        if handoff_images is not None:
+            imgs = handoff_images
+        else:
+            image_dir = project_dir / img2img_config_map.init_img_dir
+            imgs = {
+                int(Path(img_path).stem): img_path
+                for img_path in sorted(glob.glob(os.path.join(image_dir, "[0-9]*.png"), recursive=False))
+            }
         if not imgs:
             return None
         img2img_map["images"] = {}
         img2img_map["denoising_strength"] = img2img_config_map["denoising_strength"]
-        for img_path in tqdm(imgs, desc="Preprocessing images (img2img)"):
-            frame_no = int(Path(img_path).stem)
+        for frame_no, img in tqdm(imgs.items(), desc="Preprocessing images (img2img)"):
             if frame_no < duration:
-                img2img_map["images"][frame_no] = get_resized_image(img_path, width, height)
+                img2img_map["images"][frame_no] = get_resized_image(img, width, height)
                 processed = True
 
         if (img2img_config_map["save_init_image"] is True) and processed:
@@ -1280,36 +1282,65 @@ def wild_card_conversion(
                     c["prompt_fixed_ratio"] = max(min(1.0, c["prompt_fixed_ratio"]), 0)
 
 
-def save_output(
-        pipeline_output,
-        frame_dir: Path,
+def get_output_encoder(
+        frame_dir: Path | None,
         out_file: Path,
         output_map: TOutput,
-        no_frames: bool = False,
-        save_frames=save_frames,
-        save_video=None,
+        frames: Iterable[np.ndarray] | None = None,
+        frame_size: tuple[int, int] | None = None,
 ):
-    output_format = "h264" if output_map.format == "mp4" else "h2654"
-    output_fps = output_map.fps
-    if save_frames:
-        save_frames(pipeline_output, frame_dir)
-
+    """Return an ffmpeg encoder for the pngs in frame_dir, or for frames piped as raw rgb when given."""
     from animatediff.rife.ffmpeg import FfmpegEncoder, codec_extn
 
+    output_format = "h264" if output_map.format == "mp4" else "h2654"
     out_file = out_file.with_suffix(f".{codec_extn(output_format)}")
 
     logger.info("Creating ffmpeg encoder...")
-    encoder = FfmpegEncoder(
+    return FfmpegEncoder(
         frames_dir=frame_dir,
         out_file=out_file,
         codec=output_format,
-        in_fps=output_fps,
-        out_fps=output_fps,
+        in_fps=output_map.fps,
+        out_fps=output_map.fps,
         lossless=False,
         param=output_map.encode_param.model_dump(),
+        frames=frames,
+        frame_size=frame_size,
     )
-    logger.info("Encoding interpolated frames with ffmpeg...")
-    result = encoder.encode()
+
+
+def save_output(
+        pipeline_output,
+        frame_dir: Path,
+        out_file: Path,
+        output_map: TOutput,
+        no_frames: bool = False,
+        save_frames=save_frames,
+        save_video=None,
+):
+    # frames we have in memory are piped to ffmpeg as raw rgb, pngs are only written for the frame dir
+    frames = None
+    frame_size = None
+    if save_frames:
+        if isinstance(pipeline_output, list):
+            frames = iter_rgb_frames(pipeline_output)
+            frame_size = pipeline_output[0].size
+        elif pipeline_output.shape[0] == 1:
+            frames = iter_rgb_frames(pipeline_output)
+            frame_size = (pipeline_output.shape[-1], pipeline_output.shape[-2])
+        else:
+            # a batch is saved as an image grid per frame, encode from the pngs
+            save_frames(pipeline_output, frame_dir)
+
+    encoder = get_output_encoder(frame_dir, out_file, output_map, frames, frame_size)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        writer = None
+        if frames is not None and not no_frames:
+            writer = executor.submit(save_frames, pipeline_output, frame_dir)
+        logger.info("Encoding interpolated frames with ffmpeg...")
+        result = encoder.encode()
+        if writer:
+            writer.result()
     logger.debug(f"ffmpeg result: {result}")
 
 
@@ -1344,6 +1375,7 @@ def run_inference(
         is_sdxl: bool = False,
         apply_lcm_lora: bool = False,
         gradual_latent_map: TGradualLatentHiresFixMap = None,
+        handoff: Optional[StageHandoff] = None,
 ):
     out_dir = Path(out_dir)  # ensure out_dir is a Path
 
@@ -1359,6 +1391,11 @@ def run_inference(
     def preview_callback(i: int, video: torch.Tensor, save_fn: Callable[[torch.Tensor], None], out_file: str) -> None:
         save_fn(video, out_file=Path(f"{out_file}_preview@{i}"))
 
+    def latent_preview_callback(i: int, latents: torch.Tensor) -> None:
+        preview = encode_webp(latents_to_rgb(latents, is_sdxl), output_map.fps)
+        Path(f"{out_file}_preview@{i}.webp").write_bytes(preview)
+        g.pipeline.preview, g.pipeline.preview_step = preview, i
+
     save_fn = partial(
         save_output,
         frame_dir=frame_dir,
@@ -1394,6 +1431,7 @@ def run_inference(
         controlnet_max_samples_on_vram=controlnet_map.max_samples_on_vram,
         controlnet_max_models_on_vram=controlnet_map.max_models_on_vram,
         controlnet_is_loop=controlnet_map.is_loop,
+        controlnet_residual_cache=controlnet_map.residual_cache,
         img2img_map=img2img_map,
         ip_adapter_config_map=ip_adapter_config_map,
         region_list=region_list,
@@ -1402,9 +1440,17 @@ def run_inference(
         is_single_prompt_mode=is_single_prompt_mode,
         apply_lcm_lora=apply_lcm_lora,
         gradual_latent_map=gradual_latent_map,
-        callback=callback,
+        callback=callback if output_map.preview_mode == "full" else None,
+        latent_callback=latent_preview_callback if output_map.preview_mode == "fast" else None,
         callback_steps=output_map.preview_steps,
     )
+    if handoff is not None:
+        # the next pass takes the frames from memory, saving overlaps with it
+        handoff.put(pipeline_output)
+        logger.info("Generation complete, saving in the background...")
+        handoff.submit(save_fn, pipeline_output, out_file=out_file)
+        return pipeline_output
+
     logger.info("Generation complete, saving...")
 
     save_fn(pipeline_output, out_file=out_file)
@@ -1413,6 +1459,39 @@ def run_inference(
     return pipeline_output
 
 
+def control_images_to_tensor(images: list[Image.Image], width: int, height: int) -> torch.Tensor:
+    """Stack images into a (b 3 h w) float tensor in [0, 1], resized like the pipeline's control image processor."""
+    arrays = [np.asarray(img.convert("RGB").resize((width, height), resample=Image.LANCZOS)) for img in images]
+    return torch.from_numpy(np.stack(arrays)).permute(0, 3, 1, 2).float() / 255.0
+
+
+# rough peak unet + controlnet activation memory per latent pixel of one cfg branch, in units of element size
+UPSCALE_ACTIVATION_FACTOR = 64 * 1024
+
+
+def get_upscale_batch_size(
+    pipeline: DiffusionPipeline,
+    width: int,
+    height: int,
+    do_classifier_free_guidance: bool,
+    config: UpscaleBatchConfig | None = None,
+) -> int:
+    config = config or UpscaleBatchConfig()
+    if config.batch_size > 0:
+        return config.batch_size
+
+    device = pipeline._execution_device
+    if device.type != "cuda":
+        return 1
+    free = get_free_device_memory(device)
+
+    element_size = torch.finfo(pipeline.unet.dtype).bits // 8
+    frame_nbytes = (width // 8) * (height // 8) * UPSCALE_ACTIVATION_FACTOR * element_size
+    if do_classifier_free_guidance:
+        frame_nbytes *= 2
+    return max(1, min(int(free * config.memory_fraction) // frame_nbytes, config.max_batch_size))
+
+
 def run_upscale(
         project_dir: Path,
         project_setting: TProjectSetting,
@@ -1541,7 +1620,18 @@ def run_upscale(
 
         return get_tensor_interpolation_method()(prompt_embeds_map[key_prev], prompt_embeds_map[key_next], rate)
 
-    line_anime_processor = LineartAnimeDetector.from_pretrained("lllyasviel/Annotators")
+    # conditions of the whole sequence are ready before the first unet batch
+    control_images = []
+    if use_controlnet_tile:
+        control_images.append(images)
+    if use_controlnet_line_anime:
+        line_anime_processor = LineartAnimeDetector.from_pretrained("lllyasviel/Annotators")
+        control_images.append([line_anime_processor(img) for img in tqdm(images, desc="Lineart...")])
+        line_anime_processor = None
+    if use_controlnet_ip2p:
+        control_images.append(images)
+
+    width, height = images[0].size
 
     out_images = []
 
@@ -1554,28 +1644,22 @@ def run_upscale(
     logger.info(f"{control_guidance_start=}")
     logger.info(f"{control_guidance_end=}")
 
-    for i, org_image in enumerate(tqdm(images, desc="Upscaling...")):
-        cur_positive = get_current_prompt_embeds(i, len(images))
+    def upscale_batch(start: int, end: int) -> list[Image.Image]:
+        nonlocal ref_image
 
-        #        logger.info(f"w {condition_image.size[0]}")
-        #        logger.info(f"h {condition_image.size[1]}")
-        condition_image = []
-
-        if use_controlnet_tile:
-            condition_image.append(org_image)
-        if use_controlnet_line_anime:
-            condition_image.append(line_anime_processor(org_image))
-        if use_controlnet_ip2p:
-            condition_image.append(org_image)
+        cur_positive = torch.cat([get_current_prompt_embeds(i, len(images)) for i in range(start, end)])
+        cur_negative = negative[0].expand(end - start, -1, -1) if negative[0] is not None else None
+        # one (b c h w) tensor per controlnet, the pipelines reject nested lists of images
+        condition_image = [control_images_to_tensor(c[start:end], width, height) for c in control_images]
 
         if not use_controlnet_ref:
-            out_image = pipeline(
+            return pipeline(
                 prompt_embeds=cur_positive,
-                negative_prompt_embeds=negative[0],
-                image=org_image,
+                negative_prompt_embeds=cur_negative,
+                image=images[start:end],
                 control_image=condition_image,
-                width=org_image.size[0],
-                height=org_image.size[1],
+                width=width,
+                height=height,
                 strength=strength,
                 num_inference_steps=steps,
                 guidance_scale=guidance_scale,
@@ -1588,41 +1672,61 @@ def run_upscale(
                 if len(control_guidance_start) > 1
                 else control_guidance_start[0],
                 control_guidance_end=control_guidance_end if len(control_guidance_end) > 1 else control_guidance_end[0],
-            ).images[0]
-        else:
-            if upscale_config["controlnet_ref"]["use_1st_frame_as_ref_image"]:
-                if i == 0:
-                    ref_image = org_image
-            elif upscale_config["controlnet_ref"]["use_frame_as_ref_image"]:
-                ref_image = org_image
-
-            out_image = pipeline(
-                prompt_embeds=cur_positive,
-                negative_prompt_embeds=negative[0],
-                image=org_image,
-                control_image=condition_image,
-                width=org_image.size[0],
-                height=org_image.size[1],
-                strength=strength,
-                num_inference_steps=steps,
-                guidance_scale=guidance_scale,
-                generator=generator,
-                controlnet_conditioning_scale=controlnet_conditioning_scale
-                if len(controlnet_conditioning_scale) > 1
-                else controlnet_conditioning_scale[0],
-                guess_mode=guess_mode[0],
-                # control_guidance_start= control_guidance_start,
-                # control_guidance_end= control_guidance_end,
-                ### for controlnet ref
-                ref_image=ref_image,
-                attention_auto_machine_weight=upscale_config["controlnet_ref"]["attention_auto_machine_weight"],
-                gn_auto_machine_weight=upscale_config["controlnet_ref"]["gn_auto_machine_weight"],
-                style_fidelity=upscale_config["controlnet_ref"]["style_fidelity"],
-                reference_attn=upscale_config["controlnet_ref"]["reference_attn"],
-                reference_adain=upscale_config["controlnet_ref"]["reference_adain"],
-            ).images[0]
-
-        out_images.append(out_image)
+            ).images
+
+        if upscale_config["controlnet_ref"]["use_1st_frame_as_ref_image"]:
+            if start == 0:
+                ref_image = images[0]
+        elif upscale_config["controlnet_ref"]["use_frame_as_ref_image"]:
+            ref_image = images[start]
+
+        return pipeline(
+            prompt_embeds=cur_positive,
+            negative_prompt_embeds=cur_negative,
+            image=images[start:end],
+            control_image=condition_image,
+            width=width,
+            height=height,
+            strength=strength,
+            num_inference_steps=steps,
+            guidance_scale=guidance_scale,
+            generator=generator,
+            controlnet_conditioning_scale=controlnet_conditioning_scale
+            if len(controlnet_conditioning_scale) > 1
+            else controlnet_conditioning_scale[0],
+            guess_mode=guess_mode[0],
+            # control_guidance_start= control_guidance_start,
+            # control_guidance_end= control_guidance_end,
+            ### for controlnet ref
+            ref_image=ref_image,
+            attention_auto_machine_weight=upscale_config["controlnet_ref"]["attention_auto_machine_weight"],
+            gn_auto_machine_weight=upscale_config["controlnet_ref"]["gn_auto_machine_weight"],
+            style_fidelity=upscale_config["controlnet_ref"]["style_fidelity"],
+            reference_attn=upscale_config["controlnet_ref"]["reference_attn"],
+            reference_adain=upscale_config["controlnet_ref"]["reference_adain"],
+        ).images
+
+    # the reference image may change every frame, so reference mode stays at one frame per call
+    batch_size = 1
+    if not use_controlnet_ref:
+        batch_size = get_upscale_batch_size(pipeline, width, height, do_classifier_free_guidance)
+    logger.info(f"upscale {batch_size=}")
+
+    with tqdm(total=len(images), desc="Upscaling...") as pbar:
+        start = 0
+        while start < len(images):
+            end = min(start + batch_size, len(images))
+            try:
+                out_images += upscale_batch(start, end)
+            except Exception as e:
+                if batch_size == 1 or not is_oom(e):
+                    raise
+                batch_size = max(1, batch_size // 2)
+                logger.info(f"out of memory, retrying with {batch_size=}")
+                torch.cuda.empty_cache()
+                continue
+            pbar.update(end - start)
+            start = end
 
     # Trim and clean up the prompt for filename use
     prompt_tags = [
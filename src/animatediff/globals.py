@@ -32,8 +32,8 @@ class ProgressBar:
     def status(self):
         return [
             {
-                "description": t.description,
-                "completed": t.completed,
+                "description": t.desc,
+                "completed": t.n,
                 "total": t.total,
             }
             for t in [
@@ -57,6 +57,9 @@ class GPipeline:
     pid: int
     pipeline: TPipeline
     progress_bar: ProgressBar | None
+    # latest low-cost preview (animated webp) and the denoising step it was taken at
+    preview: bytes | None = None
+    preview_step: int = -1
     interrupt_processing = False
     interrupt_processing_mutex = threading.RLock()
 
@@ -1,4 +1,11 @@
-from .ip_adapter import IPAdapter, IPAdapterFull, IPAdapterPlus, IPAdapterPlusXL, IPAdapterXL
+from .ip_adapter import (
+    IPAdapter,
+    IPAdapterFull,
+    IPAdapterPlus,
+    IPAdapterPlusXL,
+    IPAdapterXL,
+    clear_image_encoders,
+)
 
 __all__ = [
     "IPAdapter",
@@ -6,4 +13,5 @@ __all__ = [
     "IPAdapterPlusXL",
     "IPAdapterXL",
     "IPAdapterFull",
+    "clear_image_encoders",
 ]
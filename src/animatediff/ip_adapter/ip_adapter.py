@@ -1,4 +1,6 @@
+import gc
 import os
+from collections import OrderedDict
 from typing import List
 
 import torch
@@ -6,6 +8,9 @@ from PIL import Image
 from safetensors import safe_open
 from transformers import CLIPImageProcessor, CLIPVisionModelWithProjection
 
+from animatediff.settings import PipelinePoolConfig
+from animatediff.utils.embedding_cache import image_embedding_cache, image_hash, model_file_id
+
 from .utils import is_torch2_available
 
 if is_torch2_available():
@@ -22,6 +27,37 @@ from .resampler import Resampler
 
 logger = logging.getLogger(__name__)
 
+# images per image encoder call
+IMAGE_EMBEDS_BATCH_SIZE = 16
+
+# the last used image encoders stay loaded between jobs, delete_encoder parks them on the cpu
+_image_encoders: OrderedDict[str, CLIPVisionModelWithProjection] = OrderedDict()
+
+
+def get_image_encoder(image_encoder_path) -> CLIPVisionModelWithProjection:
+    key = str(image_encoder_path)
+    if key in _image_encoders:
+        _image_encoders.move_to_end(key)
+        return _image_encoders[key]
+
+    max_encoders = PipelinePoolConfig().max_image_encoders
+    while _image_encoders and len(_image_encoders) >= max_encoders:
+        evicted, _ = _image_encoders.popitem(last=False)
+        logger.info(f"Evicting image encoder {evicted}")
+        gc.collect()
+
+    logger.info(f"Loading image encoder {key}")
+    encoder = CLIPVisionModelWithProjection.from_pretrained(key).to(dtype=torch.float16)
+    if max_encoders > 0:
+        _image_encoders[key] = encoder
+    return encoder
+
+
+def clear_image_encoders():
+    _image_encoders.clear()
+    gc.collect()
+    torch.cuda.empty_cache()
+
 
 class ImageProjModel(torch.nn.Module):
 
@@ -73,10 +109,8 @@ class IPAdapter:
         self.pipe = sd_pipe
         self.set_ip_adapter()
 
-        # load image encoder
-        self.image_encoder = CLIPVisionModelWithProjection.from_pretrained(self.image_encoder_path).to(
-            self.device, dtype=torch.float16
-        )
+        # load image encoder, it is moved to the device when there are images to encode
+        self.image_encoder = get_image_encoder(self.image_encoder_path)
         self.clip_image_processor = CLIPImageProcessor()
         # image proj model
         self.image_proj_model = self.init_proj()
@@ -131,12 +165,37 @@ class IPAdapter:
     def get_image_embeds(self, pil_image):
         if isinstance(pil_image, Image.Image):
             pil_image = [pil_image]
+        self.image_encoder.to(self.device)
         clip_image = self.clip_image_processor(images=pil_image, return_tensors="pt").pixel_values
         clip_image_embeds = self.image_encoder(clip_image.to(self.device, dtype=torch.float16)).image_embeds
         image_prompt_embeds = self.image_proj_model(clip_image_embeds)
         uncond_image_prompt_embeds = self.image_proj_model(torch.zeros_like(clip_image_embeds))
         return image_prompt_embeds, uncond_image_prompt_embeds
 
+    def get_cached_image_embeds(self, pil_images: List[Image.Image]):
+        """get_image_embeds through image_embedding_cache, images not seen before are encoded in fixed size batches."""
+        hashes = [image_hash(image) for image in pil_images]
+        images = dict(zip(hashes, pil_images))
+
+        def encode(keys):
+            values = []
+            for i in range(0, len(keys), IMAGE_EMBEDS_BATCH_SIZE):
+                batch = [images[k] for k in keys[i : i + IMAGE_EMBEDS_BATCH_SIZE]]
+                image_prompt_embeds, uncond_image_prompt_embeds = self.get_image_embeds(batch)
+                values += list(zip(image_prompt_embeds, uncond_image_prompt_embeds))
+            return values
+
+        values = image_embedding_cache.get_or_encode(self.cache_key, "ip_adapter", hashes, encode)
+        # cache hits come back on the cpu, newly encoded images on the device
+        image_prompt_embeds = torch.stack([e.to(self.device) for e, _ in values])
+        uncond_image_prompt_embeds = torch.stack([u.to(self.device) for _, u in values])
+        return image_prompt_embeds, uncond_image_prompt_embeds
+
+    @property
+    def cache_key(self) -> str:
+        # the adapter variant is its checkpoint (plus/full/light/face) and class
+        return f"{type(self).__name__}:{self.num_tokens}:{model_file_id(self.ip_ckpt)}:{self.image_encoder_path}"
+
     def set_scale(self, scale):
         for attn_processor in self.pipe.unet.attn_processors.values():
             if isinstance(attn_processor, IPAttnProcessor):
@@ -155,6 +214,8 @@ class IPAdapter:
         unet.set_attn_processor(attn_procs)
 
     def delete_encoder(self):
+        # the encoder itself stays in the pool for the next job, off the device
+        self.image_encoder.to("cpu")
         del self.image_encoder
         del self.clip_image_processor
         del self.image_proj_model
@@ -310,6 +371,7 @@ class IPAdapterPlus(IPAdapter):
     def get_image_embeds(self, pil_image):
         if isinstance(pil_image, Image.Image):
             pil_image = [pil_image]
+        self.image_encoder.to(self.device)
         clip_image = self.clip_image_processor(images=pil_image, return_tensors="pt").pixel_values
         clip_image = clip_image.to(self.device, dtype=torch.float16)
         clip_image_embeds = self.image_encoder(clip_image, output_hidden_states=True).hidden_states[-2]
@@ -354,6 +416,7 @@ class IPAdapterPlusXL(IPAdapter):
     def get_image_embeds(self, pil_image):
         if isinstance(pil_image, Image.Image):
             pil_image = [pil_image]
+        self.image_encoder.to(self.device)
         clip_image = self.clip_image_processor(images=pil_image, return_tensors="pt").pixel_values
         clip_image = clip_image.to(self.device, dtype=torch.float16)
         clip_image_embeds = self.image_encoder(clip_image, output_hidden_states=True).hidden_states[-2]
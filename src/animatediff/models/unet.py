@@ -12,9 +12,10 @@ from diffusers.models import ModelMixin
 from diffusers.models.attention_processor import AttentionProcessor
 from diffusers.models.embeddings import TimestepEmbedding, Timesteps
 from diffusers.utils import SAFETENSORS_WEIGHTS_NAME, WEIGHTS_NAME, BaseOutput, logging
-from safetensors.torch import load_file
 from torch import Tensor, nn
 
+from animatediff.utils.weight_loading import gather_weights, open_weights
+
 from .resnet import InflatedConv3d, InflatedGroupNorm
 from .unet_blocks import (
     CrossAttnDownBlock3D,
@@ -521,7 +522,16 @@ class UNet3DConditionModel(ModelMixin, ConfigMixin):
         motion_module_path: PathLike,
         subfolder: Optional[str] = None,
         unet_additional_kwargs: Optional[dict] = None,
+        state_dict: Optional[Dict[str, Tensor]] = None,
+        weight_deltas: Optional[Dict[str, Tensor]] = None,
+        torch_dtype: Optional[torch.dtype] = None,
+        device: Optional[Union[str, torch.device]] = None,
     ):
+        """Build the unet on the meta device and assign it mapped weights.
+
+        Weights come from the base unet, the motion module and state_dict (e.g. checkpoint weights) in that order
+        of precedence, plus weight_deltas (motion loras).
+        """
         pretrained_model_path = Path(pretrained_model_path)
         motion_module_path = Path(motion_module_path)
         if subfolder is not None:
@@ -549,36 +559,42 @@ class UNet3DConditionModel(ModelMixin, ConfigMixin):
         ]
         unet_config["mid_block_type"] = "UNetMidBlock3DCrossAttn"
 
-        model: nn.Module = cls.from_config(unet_config, **unet_additional_kwargs)
+        with torch.device("meta"):
+            model: nn.Module = cls.from_config(unet_config, **unet_additional_kwargs)
+        if torch_dtype is not None:
+            model.to(torch_dtype)
 
-        # load the vanilla weights
+        # the vanilla weights
         if pretrained_model_path.joinpath(SAFETENSORS_WEIGHTS_NAME).exists():
             logger.debug(f"loading safeTensors weights from {pretrained_model_path} ...")
-            state_dict = load_file(pretrained_model_path.joinpath(SAFETENSORS_WEIGHTS_NAME), device="cpu")
-
+            sources = [open_weights(pretrained_model_path.joinpath(SAFETENSORS_WEIGHTS_NAME))]
         elif pretrained_model_path.joinpath(WEIGHTS_NAME).exists():
             logger.debug(f"loading weights from {pretrained_model_path} ...")
-            state_dict = torch.load(pretrained_model_path.joinpath(WEIGHTS_NAME), map_location="cpu", weights_only=True)
+            sources = [open_weights(pretrained_model_path.joinpath(WEIGHTS_NAME))]
         else:
             raise FileNotFoundError(f"no weights file found in {pretrained_model_path}")
 
-        # load the motion module weights
+        # the motion module weights
         if motion_module_path.exists() and motion_module_path.is_file():
-            if motion_module_path.suffix.lower() in [".pth", ".pt", ".ckpt"]:
-                motion_state_dict = torch.load(motion_module_path, map_location="cpu", weights_only=True)
-            elif motion_module_path.suffix.lower() == ".safetensors":
-                motion_state_dict = load_file(motion_module_path, device="cpu")
-            else:
+            if motion_module_path.suffix.lower() not in [".pth", ".pt", ".ckpt", ".safetensors"]:
                 raise RuntimeError(f"unknown file format for motion module weights: {motion_module_path.suffix}")
+            sources.append(open_weights(motion_module_path))
         else:
             raise FileNotFoundError(f"no motion module weights found in {motion_module_path}")
 
-        # merge the state dicts
-        state_dict.update(motion_state_dict)
+        if state_dict is not None:
+            sources.append(state_dict)
 
-        # load the weights into the model
-        m, u = model.load_state_dict(state_dict, strict=False)
-        logger.debug(f"### missing keys: {len(m)}; \n### unexpected keys: {len(u)};")
+        weights, missing = gather_weights(model, sources, weight_deltas, device)
+        if missing:
+            # keys without weights keep their initialised values, which a meta model does not have
+            logger.warning(f"{len(missing)} unet weights not found, initialising the unet on the host instead")
+            model = cls.from_config(unet_config, **unet_additional_kwargs)
+            model.to(device=device, dtype=torch_dtype)
+            model.load_state_dict(weights, strict=False)
+        else:
+            model.load_state_dict(weights, strict=False, assign=True)
+        logger.debug(f"### missing keys: {len(missing)};")
 
         params = [p.numel() if "temporal" in n else 0 for n, p in model.named_parameters()]
         logger.info(f"Loaded {sum(params) / 1e6}M-parameter motion module")
@@ -1,13 +1,24 @@
 from .animation import AnimationPipeline, AnimationPipelineOutput
-from .context import get_context_scheduler, get_total_steps, ordered_halving, uniform
+from .context import (
+    estimate_context_cost,
+    get_context_scheduler,
+    get_total_steps,
+    ordered_halving,
+    pick_context_schedule,
+    register_context_scheduler,
+    uniform,
+)
 from .ti import get_text_embeddings, load_text_embeddings
 
 __all__ = [
     "AnimationPipeline",
     "AnimationPipelineOutput",
+    "estimate_context_cost",
     "get_context_scheduler",
     "get_total_steps",
     "ordered_halving",
+    "pick_context_schedule",
+    "register_context_scheduler",
     "uniform",
     "get_text_embeddings",
     "load_text_embeddings",
@@ -36,9 +36,11 @@ from animatediff.models.clip import CLIPSkipTextModel
 from animatediff.models.unet import UNet3DConditionModel, UNetMidBlock3DCrossAttn
 from animatediff.models.unet_blocks import CrossAttnDownBlock3D, CrossAttnUpBlock3D, DownBlock3D, UpBlock3D
 from animatediff.pipelines.context import get_context_scheduler, get_total_steps
-from animatediff.schema import TGradualLatentHiresFixMap
+from animatediff.pipelines.controlnet_cache import ControlnetResidualCache
+from animatediff.pipelines.lora import LoraState
+from animatediff.pipelines.vae_decode import VaeDecoder
+from animatediff.schema import TControlnetResidualCache, TGradualLatentHiresFixMap
 from animatediff.utils.model import nop_train
-from animatediff.utils.torch_compact import get_torch_device
 from animatediff.utils.util import (
     get_tensor_interpolation_method,
     show_gpu,
@@ -76,6 +78,9 @@ class PromptEncoder:
         self.pipe = pipe
         self.is_single_prompt_mode = is_signle_prompt_mode
         self.do_classifier_free_guidance = do_classifier_free_guidance
+        # per frame embeddings, see build_embeds_tables
+        self.embeds_tables: Dict[str, torch.Tensor] = {}
+        self.embeds_tables_length = -1
 
         uncond_num = 0
         if do_classifier_free_guidance:
@@ -158,7 +163,7 @@ class PromptEncoder:
                 ip_im_nums.append(len(_ip_im_list))
                 ip_im_list += _ip_im_list
 
-            positive, negative = pipe.ip_adapter.get_image_embeds(ip_im_list)
+            positive, negative = pipe.ip_adapter.get_cached_image_embeds(ip_im_list)
 
             positive = positive.to(device=latents_device)
             negative = negative.to(device=latents_device)
@@ -267,50 +272,60 @@ class PromptEncoder:
 
         return outputs
 
+    def build_image_embeds_table(self, video_length: int) -> torch.Tensor:
+        return torch.stack(
+            [
+                torch.cat(
+                    [
+                        self._get_current_prompt_embeds_from_image(ip_im_map, im_prompt_embeds_map, f, video_length)
+                        for f in range(video_length)
+                    ]
+                )
+                for ip_im_map, im_prompt_embeds_map in zip(self.ip_im_map_list, self.im_prompt_embeds_region_list)
+            ]
+        )
+
+    def build_embeds_tables(self, video_length: int) -> Dict[str, torch.Tensor]:
+        """Interpolate the embeddings of every frame once, as (condi, video_length, tokens, dim) tables."""
+        tables = {
+            "text": torch.stack(
+                [
+                    torch.cat(
+                        [
+                            self._get_current_prompt_embeds_from_text(prompt_map, prompt_embeds_map, f, video_length)
+                            for f in range(video_length)
+                        ]
+                    )
+                    for prompt_map, prompt_embeds_map in zip(self.prompt_map_list, self.prompt_embeds_region_list)
+                ]
+            )
+        }
+        if self.pipe.ip_adapter:
+            tables["image"] = self.build_image_embeds_table(video_length)
+        return tables
+
+    def get_embeds_tables(self, video_length: int) -> Dict[str, torch.Tensor]:
+        if self.embeds_tables_length != video_length:
+            self.embeds_tables = self.build_embeds_tables(video_length)
+            self.embeds_tables_length = video_length
+        return self.embeds_tables
+
     def get_current_prompt_embeds_single(self, context: Optional[List[int]] = None, video_length: int = 0):
         center_frame = context[len(context) // 2]
-        text_emb = self.get_current_prompt_embeds_from_text(center_frame, video_length)
-        text_emb = torch.cat(text_emb)
+        tables = self.get_embeds_tables(video_length)
+        text_emb = tables["text"][:, center_frame]
         if self.pipe.ip_adapter:
-            image_emb = self.get_current_prompt_embeds_from_image(center_frame, video_length)
-            image_emb = torch.cat(image_emb)
-            return torch.cat([text_emb, image_emb], dim=1)
+            return torch.cat([text_emb, tables["image"][:, center_frame]], dim=1)
         else:
             return text_emb
 
     def get_current_prompt_embeds_multi(self, context: Optional[List[int]] = None, video_length: int = 0):
-        emb_list = []
-        for c in context:
-            t = self.get_current_prompt_embeds_from_text(c, video_length)
-            for i, emb in enumerate(t):
-                if i >= len(emb_list):
-                    emb_list.append([])
-                emb_list[i].append(emb)
-
-        text_emb = []
-        for emb in emb_list:
-            emb = torch.cat(emb)
-            text_emb.append(emb)
-        text_emb = torch.cat(text_emb)
-
+        # (condi, frames, tokens, dim) -> (condi * frames, tokens, dim), region major like the unet batch
+        tables = self.get_embeds_tables(video_length)
+        text_emb = tables["text"][:, context].flatten(0, 1)
         if self.pipe.ip_adapter is None:
             return text_emb
-
-        emb_list = []
-        for c in context:
-            t = self.get_current_prompt_embeds_from_image(c, video_length)
-            for i, emb in enumerate(t):
-                if i >= len(emb_list):
-                    emb_list.append([])
-                emb_list[i].append(emb)
-
-        image_emb = []
-        for emb in emb_list:
-            emb = torch.cat(emb)
-            image_emb.append(emb)
-        image_emb = torch.cat(image_emb)
-
-        return torch.cat([text_emb, image_emb], dim=1)
+        return torch.cat([text_emb, tables["image"][:, context].flatten(0, 1)], dim=1)
 
     def get_current_prompt_embeds(self, context: Optional[List[int]] = None, video_length: int = 0):
         return (
@@ -488,6 +503,72 @@ class RegionMask:
         return self.region_list[region_index]["crop_generation_rate"]
 
 
+class ControlnetResidualAssembler:
+
+    """Sum per-frame controlnet residuals into residuals for a context window.
+
+    Which residual lands on which context frame, and with what scale, only depends on the context and the
+    set of computed residuals, so the weights are built once as a (context, residuals) matrix and applied
+    with one einsum per block.
+    """
+
+    def __init__(self, controlnet_scale_map: Dict[str, Dict[str, List]], device: torch.device):
+        self.device = device
+        # "0_type_str" -> {frame: scale}, the first listed scale wins for frames that wrap around twice
+        self.scale_table: Dict[str, Dict[int, float]] = {}
+        for key, m in controlnet_scale_map.items():
+            table = {}
+            for f, s in zip(m["frames"], m["scales"]):
+                table.setdefault(f, s)
+            self.scale_table[key] = table
+        self.weights: Dict[tuple, Tuple[List[int], torch.Tensor]] = {}
+
+    def get_weights(self, context: List[int], keys: List[str], dtype: torch.dtype) -> Tuple[List[int], torch.Tensor]:
+        cache_key = (tuple(context), tuple(keys), dtype)
+        if cache_key not in self.weights:
+            used = [n for n, key in enumerate(keys) if any(f in self.scale_table[key] for f in context)]
+            # a frame that appears twice in the context only gets the residual at its first position
+            first_index = {}
+            for j, f in enumerate(context):
+                first_index.setdefault(f, j)
+            weight = torch.zeros((len(context), len(used)), dtype=torch.float32)
+            for col, n in enumerate(used):
+                table = self.scale_table[keys[n]]
+                for f, j in first_index.items():
+                    if f in table:
+                        weight[j, col] = table[f]
+            self.weights[cache_key] = used, weight.to(self.device, dtype=dtype)
+        return self.weights[cache_key]
+
+    def __call__(
+        self, controlnet_result: Dict[int, Dict[str, Tuple[List[torch.Tensor], torch.Tensor]]], context: List[int]
+    ) -> Tuple[List[torch.Tensor], torch.Tensor]:
+        keys = []
+        values = []
+        for fr in controlnet_result:
+            for type_str, val in controlnet_result[fr].items():
+                keys.append(str(fr) + "_" + type_str)
+                values.append(val)
+
+        first_down, first_mid = values[0]
+        used, weight = self.get_weights(context, keys, first_mid.dtype)
+
+        def assemble(samples: List[torch.Tensor], like: torch.Tensor) -> torch.Tensor:
+            if not samples:
+                return torch.zeros(
+                    (like.shape[0], like.shape[1], len(context), *like.shape[3:]), device=self.device, dtype=like.dtype
+                )
+            # (b c 1 h w) per residual -> (b c n h w), then mix the n residuals into the context frames
+            stacked = torch.cat([v.to(device=self.device, dtype=like.dtype, non_blocking=True) for v in samples], dim=2)
+            return torch.einsum("bcnhw,jn->bcjhw", stacked, weight.to(like.dtype))
+
+        down_block_res_samples = [
+            assemble([values[n][0][ii] for n in used], first_down[ii]) for ii in range(len(first_down))
+        ]
+        mid_block_res_samples = assemble([values[n][1] for n in used], first_mid)
+        return down_block_res_samples, mid_block_res_samples
+
+
 @dataclass
 class AnimationPipelineOutput(BaseOutput):
     videos: Union[torch.Tensor, np.ndarray]
@@ -511,6 +592,7 @@ class AnimationPipeline(DiffusionPipeline, TextualInversionLoaderMixin):
     ]
     controlnet_map: Dict[str, ControlNetModel]
     ip_adapter: IPAdapter = None
+    lora_state: LoraState = None
 
     model_cpu_offload_seq = "text_encoder->unet->vae"
 
@@ -702,7 +784,7 @@ class AnimationPipeline(DiffusionPipeline, TextualInversionLoaderMixin):
             max_embeddings_multiples (`int`, *optional*, defaults to `3`):
                 The max multiple length of prompt embeddings compared to the max output length of text encoder.
         """
-        from ..utils.lpw_stable_diffusion import get_weighted_text_embeddings
+        from ..utils.lpw_stable_diffusion import get_cached_weighted_text_embeddings
 
         if prompt is not None and isinstance(prompt, str):
             batch_size = 1
@@ -728,7 +810,7 @@ class AnimationPipeline(DiffusionPipeline, TextualInversionLoaderMixin):
                 if do_classifier_free_guidance and negative_prompt_embeds is None:
                     negative_prompt = self.maybe_convert_prompt(negative_prompt, self.tokenizer)
 
-            prompt_embeds1, negative_prompt_embeds1 = get_weighted_text_embeddings(
+            prompt_embeds1, negative_prompt_embeds1 = get_cached_weighted_text_embeddings(
                 pipe=self,
                 prompt=prompt,
                 uncond_prompt=negative_prompt if do_classifier_free_guidance else None,
@@ -918,21 +1000,7 @@ class AnimationPipeline(DiffusionPipeline, TextualInversionLoaderMixin):
         return new_latents
 
     def decode_latents(self, latents: torch.Tensor):
-        video_length = latents.shape[2]
-        latents = 1 / self.vae.config.scaling_factor * latents
-        latents = rearrange(latents, "b c f h w -> (b f) c h w")
-        # video = self.vae.decode(latents).sample
-        video = []
-        for frame_idx in range(latents.shape[0]):
-            video.append(
-                self.vae.decode(latents[frame_idx : frame_idx + 1].to(get_torch_device(), self.vae.dtype)).sample.cpu(),
-            )
-        video = torch.cat(video)
-        video = rearrange(video, "(b f) c h w -> b c f h w", f=video_length)
-        video = (video / 2 + 0.5).clamp(0, 1)
-        # we always cast to float32 as this does not cause significant overhead and is compatible with bfloa16
-        video = video.float().numpy()
-        return video
+        return VaeDecoder(self.vae).decode(latents)
 
     def prepare_extra_step_kwargs(self, generator, eta):
         # prepare extra kwargs for the scheduler step, since not all schedulers have the same signature
@@ -2279,6 +2347,7 @@ class AnimationPipeline(DiffusionPipeline, TextualInversionLoaderMixin):
         return_dict: bool = True,
         callback: Optional[Callable[[int, torch.FloatTensor], None]] = None,
         callback_steps: Optional[List[int]] = None,
+        latent_callback: Optional[Callable[[int, torch.Tensor], None]] = None,
         cross_attention_kwargs: Optional[Dict[str, Any]] = None,
         context_frames: int = -1,
         context_stride: int = 3,
@@ -2299,8 +2368,22 @@ class AnimationPipeline(DiffusionPipeline, TextualInversionLoaderMixin):
         is_single_prompt_mode=False,
         apply_lcm_lora=False,
         gradual_latent_map: TGradualLatentHiresFixMap | None = None,
+        controlnet_residual_cache: TControlnetResidualCache | None = None,
         **kwargs,
     ):
+        r"""Run the pipeline to generate a video.
+
+        Args:
+        ----
+            latent_callback (`Callable`, *optional*):
+                Called on the same steps as `callback` with the undecoded latents, `latent_callback(step, latents)`.
+                Use it for previews that should not pay for a full vae decode.
+            controlnet_residual_cache (`TControlnetResidualCache`, *optional*):
+                When enabled, the controlnet residuals of a frame are reused for `refresh_interval` steps instead of
+                running the controlnets on every step, optionally extrapolated with `interpolation="linear"`. Cached
+                residuals are kept on the device up to `max_mb_on_vram` and on the cpu up to `max_mb_on_cpu`.
+
+        """
         global C_REF_MODE
 
         gradual_latent = gradual_latent_map.enable
@@ -2469,6 +2552,8 @@ class AnimationPipeline(DiffusionPipeline, TextualInversionLoaderMixin):
         def controlnet_is_affected(frame_index: int):
             return controlnet_affected_list[frame_index]
 
+        controlnet_residual_assembler = ControlnetResidualAssembler(controlnet_scale_map, device)
+
         def get_controlnet_scale(
             type: str,
             cur_step: int,
@@ -2677,6 +2762,10 @@ class AnimationPipeline(DiffusionPipeline, TextualInversionLoaderMixin):
             )
         prev_gradient_latent_size = gradual_latent_size(0)
 
+        residual_cache = None
+        if controlnet_image_map and controlnet_residual_cache and controlnet_residual_cache.enable:
+            residual_cache = ControlnetResidualCache(controlnet_residual_cache, device)
+
         # 7. Denoising loop
         num_warmup_steps = len(timesteps) - num_inference_steps * self.scheduler.order
         with self.progress_bar(total=total_steps) as progress_bar:
@@ -2715,75 +2804,7 @@ class AnimationPipeline(DiffusionPipeline, TextualInversionLoaderMixin):
                     if hit is False:
                         return None, None
 
-                    _down_block_res_samples = []
-
-                    first_down = list(list(controlnet_result.values())[0].values())[0][0]
-                    first_mid = list(list(controlnet_result.values())[0].values())[0][1]
-                    for ii in range(len(first_down)):
-                        _down_block_res_samples.append(
-                            torch.zeros(
-                                (
-                                    first_down[ii].shape[0],
-                                    first_down[ii].shape[1],
-                                    len(context),
-                                    *first_down[ii].shape[3:],
-                                ),
-                                device=device,
-                                dtype=first_down[ii].dtype,
-                            )
-                        )
-                    _mid_block_res_samples = torch.zeros(
-                        (first_mid.shape[0], first_mid.shape[1], len(context), *first_mid.shape[3:]),
-                        device=device,
-                        dtype=first_mid.dtype,
-                    )
-
-                    for fr in controlnet_result:
-                        for type_str in controlnet_result[fr]:
-                            result = str(fr) + "_" + type_str
-
-                            val = controlnet_result[fr][type_str]
-                            cur_down = [
-                                v.to(device=device, dtype=first_down[0].dtype, non_blocking=True)
-                                if v.device != device
-                                else v
-                                for v in val[0]
-                            ]
-                            cur_mid = (
-                                val[1].to(device=device, dtype=first_mid.dtype, non_blocking=True)
-                                if val[1].device != device
-                                else val[1]
-                            )
-                            loc = list(set(context) & set(controlnet_scale_map[result]["frames"]))
-                            scales = []
-
-                            for o in loc:
-                                for j, f in enumerate(controlnet_scale_map[result]["frames"]):
-                                    if o == f:
-                                        scales.append(controlnet_scale_map[result]["scales"][j])
-                                        break
-                            loc_index = []
-
-                            for o in loc:
-                                for j, f in enumerate(context):
-                                    if o == f:
-                                        loc_index.append(j)
-                                        break
-
-                            mod = torch.tensor(scales).to(device, dtype=cur_mid.dtype)
-
-                            add = cur_mid * mod[None, None, :, None, None]
-                            _mid_block_res_samples[:, :, loc_index, :, :] = (
-                                _mid_block_res_samples[:, :, loc_index, :, :] + add
-                            )
-
-                            for ii in range(len(cur_down)):
-                                add = cur_down[ii] * mod[None, None, :, None, None]
-                                _down_block_res_samples[ii][:, :, loc_index, :, :] = (
-                                    _down_block_res_samples[ii][:, :, loc_index, :, :] + add
-                                )
-
-                    return _down_block_res_samples, _mid_block_res_samples
+                    return controlnet_residual_assembler(controlnet_result, context)
 
                 def process_controlnet(target_frames: Optional[List[int]] = None):
                     # logger.info(f"process_controlnet called {target_frames=}")
@@ -2834,6 +2855,23 @@ class AnimationPipeline(DiffusionPipeline, TextualInversionLoaderMixin):
                         if not cont_vars:
                             continue
 
+                        if residual_cache:
+                            missed_vars = []
+                            for cont_var in cont_vars:
+                                frame_no = cont_var["frame_no"]
+                                cached = residual_cache.get(
+                                    frame_no, type_str, i, float(t), cont_var["cond_scale"], tuple(latents.shape[-2:])
+                                )
+                                if cached is None:
+                                    missed_vars.append(cont_var)
+                                    continue
+                                if frame_no not in controlnet_result:
+                                    controlnet_result[frame_no] = {}
+                                controlnet_result[frame_no][type_str] = sample_to_device(cached)
+                            cont_vars = missed_vars
+                            if not cont_vars:
+                                continue
+
                         org_device = self.controlnet_map[type_str].device
                         if org_device != device:
                             self.controlnet_map[type_str] = self.controlnet_map[type_str].to(
@@ -2877,6 +2915,17 @@ class AnimationPipeline(DiffusionPipeline, TextualInversionLoaderMixin):
                                 down_samples[ii] = rearrange(down_samples[ii], "(b f) c h w -> b c f h w", f=1)
                             mid_sample = rearrange(mid_sample, "(b f) c h w -> b c f h w", f=1)
 
+                            if residual_cache:
+                                residual_cache.put(
+                                    frame_no,
+                                    type_str,
+                                    i,
+                                    float(t),
+                                    cont_var["cond_scale"],
+                                    tuple(latents.shape[-2:]),
+                                    (down_samples, mid_sample),
+                                )
+
                             if frame_no not in controlnet_result:
                                 controlnet_result[frame_no] = {}
 
@@ -3097,11 +3146,17 @@ class AnimationPipeline(DiffusionPipeline, TextualInversionLoaderMixin):
                 # call the callback, if provided
                 if (
                     i == len(timesteps) - 1 or ((i + 1) > num_warmup_steps and (i + 1) % self.scheduler.order == 0)
-                ) and (callback is not None and (callback_steps is not None and i in callback_steps)):
+                ) and (
+                    (callback is not None or latent_callback is not None)
+                    and (callback_steps is not None and i in callback_steps)
+                ):
                     denoised = latents - noise_pred
                     denoised = self.interpolate_latents(denoised, interpolation_factor, device)
-                    video = torch.from_numpy(self.decode_latents(denoised))
-                    callback(i, video)
+                    if latent_callback is not None:
+                        latent_callback(i, denoised)
+                    if callback is not None:
+                        video = torch.from_numpy(self.decode_latents(denoised))
+                        callback(i, video)
 
                 if gradual_latent:
                     if prev_gradient_latent_size != cur_gradient_latent_size:
@@ -3167,6 +3222,8 @@ class AnimationPipeline(DiffusionPipeline, TextualInversionLoaderMixin):
                 stopwatch_stop("LOOP end")
 
         controlnet_result = None
+        if residual_cache:
+            residual_cache.clear()
         torch.cuda.empty_cache()
 
         if c_ref_enable:
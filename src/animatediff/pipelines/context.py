@@ -1,7 +1,35 @@
+import math
 from typing import Callable, Optional
 
 import numpy as np
 
+# name -> scheduler, see register_context_scheduler
+CONTEXT_SCHEDULERS: dict[str, Callable] = {}
+
+
+def register_context_scheduler(name: str, step_invariant: bool = False):
+    """Register a context scheduler under name.
+
+    A scheduler is a generator (step, num_steps, num_frames, context_size, context_stride, context_overlap,
+    closed_loop) -> frame index lists. step_invariant schedulers yield the same windows on every step, which
+    lets the cost helpers look at a single step.
+    """
+
+    def decorator(fn: Callable) -> Callable:
+        fn.step_invariant = step_invariant
+        CONTEXT_SCHEDULERS[name] = fn
+        return fn
+
+    return decorator
+
+
+def max_context_levels(num_frames: int, context_size: int) -> int:
+    """Return the number of frame strides 1, 2, 4, ... at which a window of context_size frames fits in num_frames.
+
+    A wider window would wrap around and hold some frames twice.
+    """
+    return max((num_frames // context_size).bit_length(), 1)
+
 
 # Whatever this is, it's utterly cursed.
 def ordered_halving(val):
@@ -13,6 +41,7 @@ def ordered_halving(val):
 
 
 # I have absolutely no idea how this works and I don't like that.
+@register_context_scheduler("uniform")
 def uniform(
     step: int = ...,
     num_steps: Optional[int] = None,
@@ -38,12 +67,108 @@ def uniform(
             yield [e % num_frames for e in range(j, j + context_size * context_step, context_step)]
 
 
+@register_context_scheduler("static_stride", step_invariant=True)
+def static_stride(
+    step: int = ...,
+    num_steps: Optional[int] = None,
+    num_frames: int = ...,
+    context_size: Optional[int] = None,
+    context_stride: int = 3,
+    context_overlap: int = 4,
+    closed_loop: bool = True,
+):
+    """Yield fixed windows every context_size - context_overlap frames, the same on every step."""
+    if num_frames <= context_size:
+        yield list(range(num_frames))
+        return
+
+    shift = max(context_size - context_overlap, 1)
+    if closed_loop:
+        for j in range(0, num_frames, shift):
+            yield [e % num_frames for e in range(j, j + context_size)]
+        return
+
+    starts = list(range(0, num_frames - context_size + 1, shift))
+    if starts[-1] != num_frames - context_size:
+        starts.append(num_frames - context_size)
+    for j in starts:
+        yield list(range(j, j + context_size))
+
+
+@register_context_scheduler("pyramid", step_invariant=True)
+def pyramid(
+    step: int = ...,
+    num_steps: Optional[int] = None,
+    num_frames: int = ...,
+    context_size: Optional[int] = None,
+    context_stride: int = 3,
+    context_overlap: int = 4,
+    closed_loop: bool = True,
+):
+    """static_stride windows at frame strides 1, 2, 4, ... up to context_stride levels.
+
+    Every level covers every frame, so each level costs about as much as level 1. Levels stop where a window
+    no longer fits in num_frames.
+    """
+    if num_frames <= context_size:
+        yield list(range(num_frames))
+        return
+
+    levels = min(context_stride, max_context_levels(num_frames, context_size))
+    for level in range(levels):
+        dilation = 1 << level
+        for phase in range(dilation):
+            # every dilation-th frame, at least context_size of them at any level that fits
+            frames = list(range(phase, num_frames, dilation))
+            for window in static_stride(
+                step, num_steps, len(frames), context_size, context_stride, context_overlap, closed_loop
+            ):
+                yield [frames[i] for i in window]
+
+
+@register_context_scheduler("min_overlap", step_invariant=True)
+def min_overlap(
+    step: int = ...,
+    num_steps: Optional[int] = None,
+    num_frames: int = ...,
+    context_size: Optional[int] = None,
+    context_stride: int = 3,
+    context_overlap: int = 4,
+    closed_loop: bool = True,
+):
+    """Yield the fewest windows that cover every frame N times, evenly spaced.
+
+    N = ceil(context_size / (context_size - context_overlap)), so any overlap puts every frame in at least two
+    windows. In a closed loop every frame is covered exactly N times when N * num_frames is a multiple of
+    context_size, otherwise N or N + 1 times.
+    """
+    if num_frames <= context_size:
+        yield list(range(num_frames))
+        return
+
+    coverage = math.ceil(context_size / max(context_size - context_overlap, 1))
+    num_windows = math.ceil(coverage * num_frames / context_size)
+    if closed_loop:
+        for k in range(num_windows):
+            j = k * num_frames // num_windows
+            yield [e % num_frames for e in range(j, j + context_size)]
+        return
+
+    last = num_frames - context_size
+    num_windows = max(num_windows, math.ceil(num_frames / context_size))
+    for k in range(num_windows):
+        j = round(k * last / max(num_windows - 1, 1))
+        yield list(range(j, j + context_size))
+
+
 def get_context_scheduler(name: str) -> Callable:
-    match name:
-        case "uniform":
-            return uniform
-        case _:
-            raise ValueError(f"Unknown context_overlap policy {name}")
+    if name not in CONTEXT_SCHEDULERS:
+        raise ValueError(f"Unknown context_overlap policy {name}")
+    return CONTEXT_SCHEDULERS[name]
+
+
+def _steps_to_check(scheduler, num_steps: int) -> range:
+    return range(1) if getattr(scheduler, "step_invariant", False) else range(num_steps)
 
 
 def get_total_steps(
@@ -56,18 +181,54 @@ def get_total_steps(
     context_overlap: int = 4,
     closed_loop: bool = True,
 ):
-    return sum(
-        len(
-            list(
-                scheduler(
-                    i,
-                    num_steps,
-                    num_frames,
-                    context_size,
-                    context_stride,
-                    context_overlap,
-                )
-            )
+    args = (num_steps, num_frames, context_size, context_stride, context_overlap, closed_loop)
+    if getattr(scheduler, "step_invariant", False):
+        return len(timesteps) * sum(1 for _ in scheduler(0, *args))
+    return sum(sum(1 for _ in scheduler(i, *args)) for i in range(len(timesteps)))
+
+
+def estimate_context_cost(
+    name: str,
+    num_steps: int,
+    num_frames: int,
+    context_size: int,
+    context_stride: int = 3,
+    context_overlap: int = 4,
+    closed_loop: bool = True,
+) -> tuple[float, int]:
+    """Return (unet calls per step, minimum number of windows covering any frame on any step)."""
+    scheduler = get_context_scheduler(name)
+    steps = _steps_to_check(scheduler, num_steps)
+    calls = 0
+    coverage = None
+    for i in steps:
+        counts = np.zeros(num_frames, dtype=int)
+        for context in scheduler(i, num_steps, num_frames, context_size, context_stride, context_overlap, closed_loop):
+            counts[context] += 1
+            calls += 1
+        coverage = counts.min() if coverage is None else min(coverage, counts.min())
+    return calls / len(steps), int(coverage)
+
+
+def pick_context_schedule(
+    num_steps: int,
+    num_frames: int,
+    context_size: int,
+    context_stride: int = 3,
+    context_overlap: int = 4,
+    min_coverage: int = 1,
+    closed_loop: bool = True,
+) -> str:
+    """Name of the cheapest registered schedule that covers every frame at least min_coverage times.
+
+    Falls back to uniform when no schedule reaches min_coverage.
+    """
+    best_name = "uniform"
+    best_cost = math.inf
+    for name in CONTEXT_SCHEDULERS:
+        cost, coverage = estimate_context_cost(
+            name, num_steps, num_frames, context_size, context_stride, context_overlap, closed_loop
         )
-        for i in range(len(timesteps))
-    )
+        if coverage >= min_coverage and cost < best_cost:
+            best_name, best_cost = name, cost
+    return best_name
@@ -0,0 +1,119 @@
+import logging
+from typing import List, Optional, Tuple
+
+import torch
+
+from animatediff.schema import TControlnetResidualCache
+
+logger = logging.getLogger(__name__)
+
+TResidual = Tuple[List[torch.Tensor], torch.Tensor]
+
+
+def residual_nbytes(residual: TResidual) -> int:
+    down_samples, mid_sample = residual
+    return sum(v.numel() * v.element_size() for v in down_samples) + mid_sample.numel() * mid_sample.element_size()
+
+
+def residual_to(residual: TResidual, device: torch.device) -> TResidual:
+    down_samples, mid_sample = residual
+    return [v.to(device=device, non_blocking=True) for v in down_samples], mid_sample.to(
+        device=device, non_blocking=True
+    )
+
+
+class ControlnetResidualCache:
+
+    """Reuse controlnet down/mid residuals of a frame across nearby denoising steps.
+
+    The conditioning image of a frame never changes during a render, only the noisy latent fed to the
+    controlnet does. A residual computed at step i is reused until step i + refresh_interval; with
+    interpolation="linear" it is extrapolated along the timestep from the last two evaluations.
+    """
+
+    def __init__(self, config: TControlnetResidualCache, device: torch.device):
+        self.refresh_interval = max(config.refresh_interval, 1)
+        self.interpolation = config.interpolation
+        self.max_vram_bytes = config.max_mb_on_vram * 1024**2
+        self.max_cpu_bytes = config.max_mb_on_cpu * 1024**2
+        self.device = device
+        # (frame_no, type_str) -> [(step, timestep, residual), ...] newest last, at most two entries
+        self.entries: dict[tuple[int, str], list[tuple[int, float, TResidual]]] = {}
+        # (frame_no, type_str) -> (cond_scale, latent size) the residuals were computed with
+        self.conditions: dict[tuple[int, str], tuple[float, tuple]] = {}
+        self.vram_bytes = 0
+        self.cpu_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _account(self, residual: TResidual, sign: int):
+        if residual[1].device.type == "cpu":
+            self.cpu_bytes += sign * residual_nbytes(residual)
+        else:
+            self.vram_bytes += sign * residual_nbytes(residual)
+
+    def get(
+        self, frame_no: int, type_str: str, step: int, timestep: float, cond_scale: float, latent_size: tuple
+    ) -> Optional[TResidual]:
+        key = (frame_no, type_str)
+        history = self.entries.get(key)
+        # a changed scale (control_guidance_start/end) or latent size (gradual latent) invalidates the residuals
+        if not history or self.conditions[key] != (cond_scale, latent_size):
+            self.misses += 1
+            return None
+        last_step, last_t, last = history[-1]
+        if step - last_step >= self.refresh_interval or step < last_step:
+            self.misses += 1
+            return None
+        self.hits += 1
+
+        last = residual_to(last, self.device)
+        if self.interpolation != "linear" or len(history) < 2:
+            return last
+        prev_step, prev_t, prev = history[0]
+        if last_t == prev_t:
+            return last
+        prev = residual_to(prev, self.device)
+        rate = (timestep - last_t) / (last_t - prev_t)
+        down_samples = [v + (v - p) * rate for v, p in zip(last[0], prev[0])]
+        return down_samples, last[1] + (last[1] - prev[1]) * rate
+
+    def put(
+        self,
+        frame_no: int,
+        type_str: str,
+        step: int,
+        timestep: float,
+        cond_scale: float,
+        latent_size: tuple,
+        residual: TResidual,
+    ):
+        key = (frame_no, type_str)
+        history = self.entries.setdefault(key, [])
+        keep = 2 if self.interpolation == "linear" and self.conditions.get(key) == (cond_scale, latent_size) else 1
+        while len(history) >= keep:
+            self._account(history.pop(0)[2], -1)
+
+        nbytes = residual_nbytes(residual)
+        if self.vram_bytes + nbytes <= self.max_vram_bytes:
+            stored = residual_to(residual, self.device)
+        elif self.cpu_bytes + nbytes <= self.max_cpu_bytes:
+            stored = residual_to(residual, torch.device("cpu"))
+        else:
+            if not history:
+                del self.entries[key]
+            return
+        self._account(stored, 1)
+        history.append((step, timestep, stored))
+        self.conditions[key] = (cond_scale, latent_size)
+
+    def clear(self):
+        if self.hits or self.misses:
+            logger.info(
+                f"controlnet residual cache: {self.hits=} {self.misses=} "
+                f"hit rate {self.hits / (self.hits + self.misses):.1%}"
+            )
+        self.entries = {}
+        self.conditions = {}
+        self.vram_bytes = 0
+        self.cpu_bytes = 0
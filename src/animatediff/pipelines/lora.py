@@ -1,5 +1,7 @@
 import logging
+from pathlib import Path
 
+import torch
 from safetensors.torch import load_file
 
 from animatediff.consts import path_mgr
@@ -8,52 +10,121 @@ from animatediff.utils.lora_diffusers import LoRANetwork, create_network_from_we
 logger = logging.getLogger(__name__)
 
 
-def merge_safetensors_lora(text_encoder, unet, lora_path, alpha=0.75, is_animatediff=True):
-    def dump(loaded):
-        for a in loaded:
-            logger.info(f"{a} {loaded[a].shape}")
-
+def create_lora_network(pipe, lora_path, multiplier=0.75, is_sdxl=False):
     sd = load_file(lora_path)
-
-    if False:
-        dump(sd)
-
-    logger.debug("create LoRA network")
+    if not sd:
+        return None
+    te_en = [pipe.text_encoder, pipe.text_encoder_2] if is_sdxl else pipe.text_encoder
     lora_network: LoRANetwork = create_network_from_weights(
-        text_encoder, unet, sd, multiplier=alpha, is_animatediff=is_animatediff
+        te_en, pipe.unet, sd, multiplier=multiplier, is_animatediff=not is_sdxl
     )
-    logger.debug("load LoRA network weights")
     lora_network.load_state_dict(sd, False)
-    lora_network.merge_to(alpha)
+    return lora_network
+
+
+def get_lcm_lora_path(is_sdxl=False) -> Path:
+    if is_sdxl:
+        return path_mgr.lcm_loras / "sdxl/pytorch_lora_weights.safetensors"
+    return path_mgr.lcm_loras / "sd15/pytorch_lora_weights.safetensors"
+
+
+def get_lora_scales(lora_map_config, lcm_lora_scale=None, is_sdxl=False) -> dict[Path, float]:
+    """Loras merged into the weights: plain float entries of lora_map, plus the lcm lora if enabled."""
+    lora_scales = {
+        path_mgr.loras / item: float(scale) for item, scale in lora_map_config.items() if type(scale) in (float, int)
+    }
+    if lcm_lora_scale is not None:
+        lora_scales[get_lcm_lora_path(is_sdxl)] = float(lcm_lora_scale)
+    return lora_scales
+
+
+class LoraState:
+
+    """Loras merged into a pipeline, so a new lora set only merges/restores the difference.
+
+    The original weights of every layer a merged lora touches are kept on the cpu.
+    Unmerging copies them back instead of subtracting the lora, which would drift in fp16.
+    Loras without any weights are remembered in failed and not loaded again.
+    """
+
+    def __init__(self):
+        self.merged: dict[Path, tuple[LoRANetwork, float]] = {}
+        self.backup: dict[torch.nn.Module, torch.Tensor] = {}
+        self.failed: set[Path] = set()
+
+    @staticmethod
+    def target_modules(network: LoRANetwork):
+        return [lora.org_module[0] for lora in network.text_encoder_loras + network.unet_loras]
+
+    def update(self, pipe, lora_scales: dict[Path, float], is_sdxl=False):
+        removed = [p for p, (_, scale) in self.merged.items() if lora_scales.get(p) != scale]
+        added = {
+            p: scale
+            for p, scale in lora_scales.items()
+            if p not in self.failed and (p not in self.merged or self.merged[p][1] != scale)
+        }
+        if not removed and not added:
+            logger.info("Loras already merged, skipping")
+            return
+
+        unmerged = {}
+        dirty = set()
+        for p in removed:
+            network, scale = self.merged.pop(p)
+            logger.info(f"Unmerging lora {p.name} ({scale=})")
+            unmerged[p] = network
+            dirty.update(self.target_modules(network))
+
+        with torch.no_grad():
+            for module in dirty:
+                module.weight.copy_(self.backup[module])
+
+            # loras that stay merged have to be merged again into the restored layers
+            for network, scale in self.merged.values():
+                for lora in network.text_encoder_loras + network.unet_loras:
+                    if lora.org_module[0] in dirty:
+                        lora.merge_to(scale)
+
+            for p, scale in added.items():
+                logger.info(f"Merging lora {p.name} ({scale=})")
+                network = unmerged.get(p) or create_lora_network(pipe, p, scale, is_sdxl)
+                if network is None:
+                    logger.warning(f"Lora {p.name} has no weights, skipping it from now on")
+                    self.failed.add(p)
+                    continue
+                for module in self.target_modules(network):
+                    if module not in self.backup:
+                        self.backup[module] = module.weight.detach().to("cpu", copy=True)
+                network.merge_to(scale)
+                self.merged[p] = (network, scale)
+
+        in_use = {module for network, _ in self.merged.values() for module in self.target_modules(network)}
+        for module in list(self.backup):
+            if module not in in_use:
+                del self.backup[module]
+
+
+def get_lora_state(pipe) -> LoraState:
+    if getattr(pipe, "lora_state", None) is None:
+        pipe.lora_state = LoraState()
+    return pipe.lora_state
+
+
+def merge_lora_scales(pipe, lora_scales: dict[Path, float], is_sdxl=False):
+    get_lora_state(pipe).update(pipe, lora_scales, is_sdxl)
 
 
 def load_lora_map(pipe, lora_map_config, video_length, is_sdxl=False):
+    """Set up the region loras of lora_map, plain float entries are merged by merge_lora_scales."""
     new_map = {}
     for item in lora_map_config:
-        lora_path = path_mgr.loras / item
-        if type(lora_map_config[item]) in (float, int):
-            #            merge_safetensors_lora(pipe.text_encoder, pipe.unet, lora_path, lora_map_config[item], True)
-
-            te_en = [pipe.text_encoder, pipe.text_encoder_2] if is_sdxl else pipe.text_encoder
-            merge_safetensors_lora(te_en, pipe.unet, lora_path, lora_map_config[item], not is_sdxl)
-        else:
-            new_map[lora_path] = lora_map_config[item]
+        if type(lora_map_config[item]) not in (float, int):
+            new_map[path_mgr.loras / item] = lora_map_config[item]
 
     lora_map = LoraMap(pipe, new_map, video_length, is_sdxl)
     pipe.lora_map = lora_map if lora_map.is_valid else None
 
 
-def load_lcm_lora(pipe, scale, is_sdxl=False):
-    if is_sdxl:
-        lora_path = path_mgr.lcm_loras / "sdxl/pytorch_lora_weights.safetensors"
-    else:
-        lora_path = path_mgr.lcm_loras / "sd15/pytorch_lora_weights.safetensors"
-    logger.info(f"{lora_path=}")
-
-    te_en = [pipe.text_encoder, pipe.text_encoder_2] if is_sdxl else pipe.text_encoder
-    merge_safetensors_lora(te_en, pipe.unet, lora_path, scale, not is_sdxl)
-
-
 class LoraMap:
     def __init__(
         self,
@@ -90,14 +161,9 @@ class LoraMap:
             return schedule
 
         for lora_path in lora_map:
-            sd = load_file(lora_path)
-            if not sd:
+            lora_network = create_lora_network(pipe, lora_path, 0.75, is_sdxl)
+            if lora_network is None:
                 continue
-            te_en = [pipe.text_encoder, pipe.text_encoder_2] if is_sdxl else pipe.text_encoder
-            lora_network: LoRANetwork = create_network_from_weights(
-                te_en, pipe.unet, sd, multiplier=0.75, is_animatediff=not is_sdxl
-            )
-            lora_network.load_state_dict(sd, False)
             lora_network.apply_to(0.75)
 
             self.networks.append(
@@ -0,0 +1,134 @@
+import gc
+import json
+import logging
+from collections import OrderedDict
+from typing import Callable, NamedTuple
+
+import torch
+from diffusers import DiffusionPipeline
+
+from animatediff.schema import TProjectSetting
+
+logger = logging.getLogger(__name__)
+
+
+class PipelineKey(NamedTuple):
+    checkpoint: str
+    motion: str
+    vae: str
+    scheduler: str
+    performance: str
+    # plain loras and the lcm lora are merged/unmerged on a warm pipeline, only region loras are part of the key
+    region_lora: tuple
+    motion_lora: tuple
+    is_sdxl: bool
+    # region loras bake their per-frame schedule into the pipeline
+    video_length: int | None
+
+
+def _freeze(d: dict) -> tuple:
+    return tuple(sorted((k, v if isinstance(v, (int, float)) else json.dumps(v, sort_keys=True)) for k, v in d.items()))
+
+
+def get_pipeline_key(project_setting: TProjectSetting, video_length: int, is_sdxl: bool) -> PipelineKey:
+    region_lora = {k: v for k, v in project_setting.lora_map.items() if not isinstance(v, (int, float))}
+    return PipelineKey(
+        checkpoint=project_setting.checkpoint,
+        motion=project_setting.motion,
+        vae=project_setting.vae,
+        scheduler=project_setting.scheduler,
+        performance=str(project_setting.performance),
+        region_lora=_freeze(region_lora),
+        motion_lora=_freeze(project_setting.motion_lora_map),
+        is_sdxl=is_sdxl,
+        video_length=video_length if region_lora else None,
+    )
+
+
+def _pipeline_modules(pipeline: DiffusionPipeline) -> list[torch.nn.Module]:
+    names = ["unet", "text_encoder", "text_encoder_2", "vae"]
+    return [m for m in (getattr(pipeline, n, None) for n in names) if isinstance(m, torch.nn.Module)]
+
+
+def _module_nbytes(m: torch.nn.Module) -> int:
+    return sum(p.numel() * p.element_size() for p in m.parameters()) + sum(
+        b.numel() * b.element_size() for b in m.buffers()
+    )
+
+
+def get_pipeline_nbytes(pipeline: DiffusionPipeline) -> int:
+    """Weights of the pipeline, plus the merged lora networks and the original layer weights kept to unmerge them."""
+    nbytes = sum(_module_nbytes(m) for m in _pipeline_modules(pipeline))
+    lora_state = getattr(pipeline, "lora_state", None)
+    if lora_state is not None:
+        nbytes += sum(_module_nbytes(network) for network, _ in lora_state.merged.values())
+        nbytes += sum(t.numel() * t.element_size() for t in lora_state.backup.values())
+    return nbytes
+
+
+def park_pipeline(pipeline: DiffusionPipeline, is_sdxl: bool = False):
+    """Move an idle pipeline's weights to host memory, keeping their dtype."""
+    if is_sdxl:
+        # sdxl pipelines run with model cpu offload, the weights are already on the host
+        return
+    logger.info("Parking idle pipeline on cpu")
+    for m in _pipeline_modules(pipeline):
+        m.to("cpu")
+    if getattr(pipeline, "lora_map", None):
+        pipeline.lora_map.to(device="cpu", dtype=pipeline.unet.dtype)
+    torch.cuda.empty_cache()
+
+
+class PipelinePool:
+
+    """LRU pool of built pipelines, only the active one is kept on the device."""
+
+    def __init__(self, max_pipelines: int = 3, max_bytes: int = 24 * 1024**3):
+        self.max_pipelines = max_pipelines
+        self.max_bytes = max_bytes
+        self.pipelines: OrderedDict[PipelineKey, DiffusionPipeline] = OrderedDict()
+        self.nbytes: dict[PipelineKey, int] = {}
+        self.active_key: PipelineKey | None = None
+
+    def get(self, key: PipelineKey, factory: Callable[[], DiffusionPipeline]) -> tuple[DiffusionPipeline, bool]:
+        """Return the pipeline for key and whether it was already warm."""
+        if self.active_key is not None and self.active_key != key and self.active_key in self.pipelines:
+            park_pipeline(self.pipelines[self.active_key], self.active_key.is_sdxl)
+        # the loras merged by earlier jobs change the size of warm pipelines
+        for k, pipeline in self.pipelines.items():
+            self.nbytes[k] = get_pipeline_nbytes(pipeline)
+
+        if key in self.pipelines:
+            self.active_key = key
+            self.pipelines.move_to_end(key)
+            self.evict()
+            return self.pipelines[key], True
+
+        pipeline = factory()
+        self.active_key = key
+        self.pipelines[key] = pipeline
+        self.nbytes[key] = get_pipeline_nbytes(pipeline)
+        logger.info(f"Pipeline pool: added {key.checkpoint} ({self.nbytes[key] / 1024**3:.1f}GB)")
+        self.evict()
+        return pipeline, False
+
+    def evict(self):
+        evicted = False
+        while len(self.pipelines) > 1 and (
+            len(self.pipelines) > self.max_pipelines or sum(self.nbytes.values()) > self.max_bytes
+        ):
+            key = next(k for k in self.pipelines if k != self.active_key)
+            logger.info(f"Pipeline pool: evicting {key.checkpoint}")
+            del self.pipelines[key]
+            del self.nbytes[key]
+            evicted = True
+        if evicted:
+            gc.collect()
+            torch.cuda.empty_cache()
+
+    def clear(self):
+        self.pipelines.clear()
+        self.nbytes.clear()
+        self.active_key = None
+        gc.collect()
+        torch.cuda.empty_cache()
@@ -44,11 +44,11 @@ from transformers import CLIPTextModel, CLIPTextModelWithProjection, CLIPTokeniz
 
 from animatediff.consts import path_mgr
 from animatediff.ip_adapter import IPAdapterPlusXL, IPAdapterXL
-from animatediff.pipelines.animation import PromptEncoder, RegionMask
+from animatediff.pipelines.animation import ControlnetResidualAssembler, PromptEncoder, RegionMask
 from animatediff.pipelines.context import get_context_scheduler, get_total_steps
+from animatediff.pipelines.vae_decode import VaeDecoder
 from animatediff.sdxl_models.unet import UNet3DConditionModel
-from animatediff.utils.lpw_stable_diffusion_xl import get_weighted_text_embeddings_sdxl2
-from animatediff.utils.torch_compact import get_torch_device
+from animatediff.utils.lpw_stable_diffusion_xl import get_cached_text_embeddings_sdxl2
 from animatediff.utils.util import (
     get_tensor_interpolation_method,
     show_gpu,
@@ -73,6 +73,8 @@ class PromptEncoderSDXL(PromptEncoder):
         multi_uncond_mode,
     ):
         self.pipe = pipe
+        self.embeds_tables: Dict[str, torch.Tensor] = {}
+        self.embeds_tables_length = -1
         self.is_single_prompt_mode = is_signle_prompt_mode
         self.do_classifier_free_guidance = do_classifier_free_guidance
 
@@ -102,7 +104,7 @@ class PromptEncoderSDXL(PromptEncoder):
             negative_prompt_embeds_list,
             pooled_prompt_embeds_list,
             negative_pooled_prompt_embeds_list,
-        ) = get_weighted_text_embeddings_sdxl2(pipe, prompt_list, [negative_prompt], latents_device)
+        ) = get_cached_text_embeddings_sdxl2(pipe, prompt_list, [negative_prompt], latents_device)
 
         self.prompt_embeds_dtype = prompt_embeds_list[0].dtype
 
@@ -161,7 +163,7 @@ class PromptEncoderSDXL(PromptEncoder):
                 ip_im_nums.append(len(_ip_im_list))
                 ip_im_list += _ip_im_list
 
-            positive, negative = pipe.ip_adapter.get_image_embeds(ip_im_list)
+            positive, negative = pipe.ip_adapter.get_cached_image_embeds(ip_im_list)
 
             positive = positive.to(device=latents_device)
             negative = negative.to(device=latents_device)
@@ -245,60 +247,43 @@ class PromptEncoderSDXL(PromptEncoder):
 
         return outputs, outputs2
 
+    def build_embeds_tables(self, video_length: int) -> Dict[str, torch.Tensor]:
+        text_table = []
+        pooled_table = []
+        for prompt_map, prompt_embeds_map, pooled_embeds_map in zip(
+            self.prompt_map_list, self.prompt_embeds_region_list, self.pooled_embeds_region_list
+        ):
+            embs = [
+                self._get_current_prompt_embeds_from_text(
+                    prompt_map, prompt_embeds_map, pooled_embeds_map, f, video_length
+                )
+                for f in range(video_length)
+            ]
+            text_table.append(torch.cat([t for t, _ in embs]))
+            pooled_table.append(torch.cat([p for _, p in embs]))
+
+        tables = {"text": torch.stack(text_table), "pooled": torch.stack(pooled_table)}
+        if self.pipe.ip_adapter:
+            tables["image"] = self.build_image_embeds_table(video_length)
+        return tables
+
     def get_current_prompt_embeds_single(self, context: Optional[List[int]] = None, video_length: int = 0):
         center_frame = context[len(context) // 2]
-        text_emb, pooled_emb = self.get_current_prompt_embeds_from_text(center_frame, video_length)
-        text_emb = torch.cat(text_emb)
-        pooled_emb = torch.cat(pooled_emb)
+        tables = self.get_embeds_tables(video_length)
+        text_emb = tables["text"][:, center_frame]
+        pooled_emb = tables["pooled"][:, center_frame]
         if self.pipe.ip_adapter:
-            image_emb = self.get_current_prompt_embeds_from_image(center_frame, video_length)
-            image_emb = torch.cat(image_emb)
-            return torch.cat([text_emb, image_emb], dim=1), pooled_emb
+            return torch.cat([text_emb, tables["image"][:, center_frame]], dim=1), pooled_emb
         else:
             return text_emb, pooled_emb
 
     def get_current_prompt_embeds_multi(self, context: Optional[List[int]] = None, video_length: int = 0):
-        emb_list = []
-        pooled_emb_list = []
-        for c in context:
-            t, p = self.get_current_prompt_embeds_from_text(c, video_length)
-            for i, (emb, pooled) in enumerate(zip(t, p)):
-                if i >= len(emb_list):
-                    emb_list.append([])
-                    pooled_emb_list.append([])
-                emb_list[i].append(emb)
-                pooled_emb_list[i].append(pooled)
-
-        text_emb = []
-        for emb in emb_list:
-            emb = torch.cat(emb)
-            text_emb.append(emb)
-        text_emb = torch.cat(text_emb)
-
-        pooled_emb = []
-        for emb in pooled_emb_list:
-            emb = torch.cat(emb)
-            pooled_emb.append(emb)
-        pooled_emb = torch.cat(pooled_emb)
-
+        tables = self.get_embeds_tables(video_length)
+        text_emb = tables["text"][:, context].flatten(0, 1)
+        pooled_emb = tables["pooled"][:, context].flatten(0, 1)
         if self.pipe.ip_adapter is None:
             return text_emb, pooled_emb
-
-        emb_list = []
-        for c in context:
-            t = self.get_current_prompt_embeds_from_image(c, video_length)
-            for i, emb in enumerate(t):
-                if i >= len(emb_list):
-                    emb_list.append([])
-                emb_list[i].append(emb)
-
-        image_emb = []
-        for emb in emb_list:
-            emb = torch.cat(emb)
-            image_emb.append(emb)
-        image_emb = torch.cat(image_emb)
-
-        return torch.cat([text_emb, image_emb], dim=1), pooled_emb
+        return torch.cat([text_emb, tables["image"][:, context].flatten(0, 1)], dim=1), pooled_emb
 
     """
     def get_current_prompt_embeds(
@@ -1020,21 +1005,7 @@ class AnimationPipeline(DiffusionPipeline, FromSingleFileMixin, LoraLoaderMixin,
             self.vae.decoder.mid_block.to(dtype)
 
     def decode_latents(self, latents: torch.Tensor):
-        video_length = latents.shape[2]
-        latents = 1 / self.vae.config.scaling_factor * latents
-        latents = rearrange(latents, "b c f h w -> (b f) c h w")
-        # video = self.vae.decode(latents).sample
-        video = []
-        for frame_idx in range(latents.shape[0]):
-            video.append(
-                self.vae.decode(latents[frame_idx : frame_idx + 1].to(get_torch_device(), self.vae.dtype)).sample.cpu()
-            )
-        video = torch.cat(video)
-        video = rearrange(video, "(b f) c h w -> b c f h w", f=video_length)
-        video = (video / 2 + 0.5).clamp(0, 1)
-        # we always cast to float32 as this does not cause significant overhead and is compatible with bfloa16
-        video = video.float().numpy()
-        return video
+        return VaeDecoder(self.vae).decode(latents)
 
     def get_img2img_timesteps(self, num_inference_steps, strength, device):
         strength = min(1, max(0, strength))
@@ -1072,6 +1043,7 @@ class AnimationPipeline(DiffusionPipeline, FromSingleFileMixin, LoraLoaderMixin,
         return_dict: bool = True,
         callback: Optional[Callable[[int, torch.FloatTensor], None]] = None,
         callback_steps: Optional[List[int]] = None,
+        latent_callback: Optional[Callable[[int, torch.Tensor], None]] = None,
         cross_attention_kwargs: Optional[Dict[str, Any]] = None,
         guidance_rescale: float = 0.0,
         original_size: Optional[Tuple[int, int]] = None,
@@ -1175,6 +1147,9 @@ class AnimationPipeline(DiffusionPipeline, FromSingleFileMixin, LoraLoaderMixin,
             callback_steps (`int`, *optional*, defaults to 1):
                 The frequency at which the `callback` function will be called. If not specified, the callback will be
                 called at every step.
+            latent_callback (`Callable`, *optional*):
+                Called on the same steps as `callback` with the undecoded latents, `latent_callback(step, latents)`.
+                Use it for previews that should not pay for a full vae decode.
             cross_attention_kwargs (`dict`, *optional*):
                 A kwargs dictionary that if specified is passed along to the `AttentionProcessor` as defined under
                 `self.processor` in
@@ -1383,6 +1358,8 @@ class AnimationPipeline(DiffusionPipeline, FromSingleFileMixin, LoraLoaderMixin,
         def controlnet_is_affected(frame_index: int):
             return controlnet_affected_list[frame_index]
 
+        controlnet_residual_assembler = ControlnetResidualAssembler(controlnet_scale_map, device)
+
         def get_controlnet_scale(
             type: str,
             cur_step: int,
@@ -1609,75 +1586,7 @@ class AnimationPipeline(DiffusionPipeline, FromSingleFileMixin, LoraLoaderMixin,
                     if hit is False:
                         return None, None
 
-                    _down_block_res_samples = []
-
-                    first_down = list(list(controlnet_result.values())[0].values())[0][0]
-                    first_mid = list(list(controlnet_result.values())[0].values())[0][1]
-                    for ii in range(len(first_down)):
-                        _down_block_res_samples.append(
-                            torch.zeros(
-                                (
-                                    first_down[ii].shape[0],
-                                    first_down[ii].shape[1],
-                                    len(context),
-                                    *first_down[ii].shape[3:],
-                                ),
-                                device=device,
-                                dtype=first_down[ii].dtype,
-                            )
-                        )
-                    _mid_block_res_samples = torch.zeros(
-                        (first_mid.shape[0], first_mid.shape[1], len(context), *first_mid.shape[3:]),
-                        device=device,
-                        dtype=first_mid.dtype,
-                    )
-
-                    for fr in controlnet_result:
-                        for type_str in controlnet_result[fr]:
-                            result = str(fr) + "_" + type_str
-
-                            val = controlnet_result[fr][type_str]
-                            cur_down = [
-                                v.to(device=device, dtype=first_down[0].dtype, non_blocking=True)
-                                if v.device != device
-                                else v
-                                for v in val[0]
-                            ]
-                            cur_mid = (
-                                val[1].to(device=device, dtype=first_mid.dtype, non_blocking=True)
-                                if val[1].device != device
-                                else val[1]
-                            )
-                            loc = list(set(context) & set(controlnet_scale_map[result]["frames"]))
-                            scales = []
-
-                            for o in loc:
-                                for j, f in enumerate(controlnet_scale_map[result]["frames"]):
-                                    if o == f:
-                                        scales.append(controlnet_scale_map[result]["scales"][j])
-                                        break
-                            loc_index = []
-
-                            for o in loc:
-                                for j, f in enumerate(context):
-                                    if o == f:
-                                        loc_index.append(j)
-                                        break
-
-                            mod = torch.tensor(scales).to(device, dtype=cur_mid.dtype)
-
-                            add = cur_mid * mod[None, None, :, None, None]
-                            _mid_block_res_samples[:, :, loc_index, :, :] = (
-                                _mid_block_res_samples[:, :, loc_index, :, :] + add
-                            )
-
-                            for ii in range(len(cur_down)):
-                                add = cur_down[ii] * mod[None, None, :, None, None]
-                                _down_block_res_samples[ii][:, :, loc_index, :, :] = (
-                                    _down_block_res_samples[ii][:, :, loc_index, :, :] + add
-                                )
-
-                    return _down_block_res_samples, _mid_block_res_samples
+                    return controlnet_residual_assembler(controlnet_result, context)
 
                 def process_controlnet(target_frames: Optional[List[int]] = None):
                     # logger.info(f"process_controlnet called {target_frames=}")
@@ -1973,11 +1882,17 @@ class AnimationPipeline(DiffusionPipeline, FromSingleFileMixin, LoraLoaderMixin,
                 # call the callback, if provided
                 if (
                     i == len(timesteps) - 1 or ((i + 1) > num_warmup_steps and (i + 1) % self.scheduler.order == 0)
-                ) and (callback is not None and (callback_steps is not None and i in callback_steps)):
+                ) and (
+                    (callback is not None or latent_callback is not None)
+                    and (callback_steps is not None and i in callback_steps)
+                ):
                     denoised = latents - noise_pred
                     # denoised = self.interpolate_latents(denoised, interpolation_factor, device)
-                    video = torch.from_numpy(self.decode_latents(denoised))
-                    callback(i, video)
+                    if latent_callback is not None:
+                        latent_callback(i, denoised)
+                    if callback is not None:
+                        video = torch.from_numpy(self.decode_latents(denoised))
+                        callback(i, video)
 
                 latents_list = latents.chunk(noise_size)
 
@@ -0,0 +1,149 @@
+import logging
+from typing import Iterator
+
+import numpy as np
+import torch
+from diffusers.models import AutoencoderKL
+from einops import rearrange
+
+from animatediff.settings import VaeDecodeConfig
+from animatediff.utils.torch_compact import get_free_device_memory, get_torch_device, is_oom
+
+logger = logging.getLogger(__name__)
+
+# rough peak activation memory of the decoder per output pixel, in units of block_out_channels[0] * element size
+ACTIVATION_FACTOR = 6
+
+# (out height, out width, dtype, tiling) -> largest chunk size that decoded without running out of memory
+_tuned_chunk_sizes: dict[tuple, int] = {}
+
+
+class VaeDecoder:
+
+    """Decode video latents in batched chunks sized to the free device memory.
+
+    Chunks are decoded back to back: the device-to-host copy of one chunk runs into a pinned buffer on a
+    separate copy stream while the next chunk is being decoded, and decoded chunks are yielded as soon as
+    they reach host memory.
+    """
+
+    def __init__(self, vae: AutoencoderKL, config: VaeDecodeConfig | None = None):
+        self.vae = vae
+        self.config = config or VaeDecodeConfig()
+        self.device = torch.device(get_torch_device())
+        self.copy_stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+
+    def frame_nbytes(self, height: int, width: int, tiling: bool) -> int:
+        if tiling:
+            tile = getattr(self.vae, "tile_sample_min_size", 512)
+            height, width = min(height, tile), min(width, tile)
+        channels = self.vae.config.block_out_channels[0]
+        return height * width * channels * torch.finfo(self.vae.dtype).bits // 8 * ACTIVATION_FACTOR
+
+    def free_nbytes(self) -> int | None:
+        if self.device.type != "cuda":
+            return None
+        return int(get_free_device_memory(self.device) * self.config.memory_fraction)
+
+    def plan(self, height: int, width: int) -> tuple[int, bool]:
+        """Return (chunk size, use tiling) for frames decoding to height x width."""
+        tiling = self.config.tiling == "on" or (self.config.tiling == "auto" and self.vae.use_tiling)
+        free = self.free_nbytes()
+        if self.config.tiling == "auto" and free is not None and self.frame_nbytes(height, width, False) > free:
+            tiling = True
+
+        if self.config.chunk_size > 0:
+            return self.config.chunk_size, tiling
+
+        key = (height, width, self.vae.dtype, tiling)
+        if key in _tuned_chunk_sizes:
+            return _tuned_chunk_sizes[key], tiling
+        if free is None:
+            return min(4, self.config.max_chunk_size), tiling
+        chunk_size = free // self.frame_nbytes(height, width, tiling)
+        return max(1, min(chunk_size, self.config.max_chunk_size)), tiling
+
+    def _decode_chunk(self, latents: torch.Tensor) -> torch.Tensor:
+        latents = latents.to(device=self.device, dtype=self.vae.dtype, non_blocking=True)
+        video = self.vae.decode(latents).sample
+        return (video / 2 + 0.5).clamp(0, 1)
+
+    def _to_host(self, video: torch.Tensor) -> tuple[torch.Tensor, torch.cuda.Event | None]:
+        if self.device.type != "cuda":
+            return video.cpu(), None
+        host = torch.empty(video.shape, dtype=video.dtype, pin_memory=True)
+        # the copy waits for this chunk's decode only, the next chunk decodes on the current stream meanwhile
+        self.copy_stream.wait_stream(torch.cuda.current_stream(self.device))
+        with torch.cuda.stream(self.copy_stream):
+            host.copy_(video, non_blocking=True)
+            # keeps the allocator from handing video's memory to the next chunk before the copy is done
+            video.record_stream(self.copy_stream)
+            event = torch.cuda.Event()
+            event.record()
+        return host, event
+
+    def iter_decode(self, latents: torch.Tensor) -> Iterator[tuple[int, torch.Tensor]]:
+        """Yield (first frame index, float32 frames in [0, 1]) for latents of shape (b c f h w)."""
+        latents = 1 / self.vae.config.scaling_factor * latents
+        latents = rearrange(latents, "b c f h w -> (b f) c h w")
+        if self.device.type == "cuda" and latents.device.type == "cpu":
+            latents = latents.pin_memory()
+
+        scale = 2 ** (len(self.vae.config.block_out_channels) - 1)
+        height, width = latents.shape[-2] * scale, latents.shape[-1] * scale
+        chunk_size, tiling = self.plan(height, width)
+        tuned = chunk_size
+
+        org_tiling = self.vae.use_tiling
+        self.vae.use_tiling = tiling
+        logger.info(f"decoding {latents.shape[0]} frames in chunks of {chunk_size} ({tiling=})")
+
+        pending = None
+        start = 0
+        try:
+            while start < latents.shape[0]:
+                try:
+                    video = self._decode_chunk(latents[start : start + chunk_size])
+                except RuntimeError as e:
+                    if not is_oom(e) or (chunk_size == 1 and (self.vae.use_tiling or self.config.tiling != "auto")):
+                        raise
+                    torch.cuda.empty_cache()
+                    if chunk_size == 1:
+                        logger.warning("vae decode out of memory, retrying with tiling")
+                        self.vae.use_tiling = tiling = True
+                    else:
+                        chunk_size = max(1, chunk_size // 2)
+                        logger.warning(f"vae decode out of memory, retrying with chunk size {chunk_size}")
+                    tuned = chunk_size
+                    continue
+
+                host, event = self._to_host(video)
+                del video
+                if pending:
+                    yield self._finish(*pending)
+                pending = (start, host, event)
+                start += chunk_size
+            if pending:
+                yield self._finish(*pending)
+        finally:
+            self.vae.use_tiling = org_tiling
+
+        if self.config.chunk_size <= 0:
+            _tuned_chunk_sizes[(height, width, self.vae.dtype, tiling)] = tuned
+
+    @staticmethod
+    def _finish(start: int, host: torch.Tensor, event: torch.cuda.Event | None) -> tuple[int, torch.Tensor]:
+        if event is not None:
+            event.synchronize()
+        # we always cast to float32 as this does not cause significant overhead and is compatible with bfloa16
+        return start, host.float()
+
+    def decode(self, latents: torch.Tensor) -> np.ndarray:
+        """Decode latents of shape (b c f h w) into a float32 array of the same layout."""
+        batch_size, video_length = latents.shape[0], latents.shape[2]
+        video = None
+        for start, frames in self.iter_decode(latents):
+            if video is None:
+                video = np.empty((batch_size * video_length, *frames.shape[1:]), dtype=np.float32)
+            video[start : start + frames.shape[0]] = frames.numpy()
+        return rearrange(video, "(b f) c h w -> b c f h w", f=video_length)
@@ -1,8 +1,10 @@
+import threading
 from enum import Enum
 from pathlib import Path
-from typing import Optional
+from typing import Iterable, Optional
 
 import ffmpeg
+import numpy as np
 from ffmpeg.nodes import FilterNode, InputNode
 
 
@@ -77,15 +79,23 @@ def clamp_gif_fps(fps: int):
 
 
 class FfmpegEncoder:
+
+    """Encode a %08d.png sequence in frames_dir, or raw rgb24 frames piped over stdin.
+
+    For the pipe mode pass frames (an iterable of HxWx3 uint8 arrays) and frame_size=(width, height).
+    """
+
     def __init__(
         self,
-        frames_dir: Path,
+        frames_dir: Optional[Path],
         out_file: Path,
         codec: VideoCodec,
         in_fps: int = 60,
         out_fps: int = 60,
         lossless: bool = False,
         param=None,
+        frames: Optional[Iterable[np.ndarray]] = None,
+        frame_size: Optional[tuple[int, int]] = None,
     ):
         if param is None:
             param = {}
@@ -96,13 +106,22 @@ class FfmpegEncoder:
         self.out_fps = out_fps
         self.lossless = lossless
         self.param = param
+        self.frames = frames
+        self.frame_size = frame_size
+        if frames is not None and frame_size is None:
+            raise ValueError("frame_size is required when piping frames")
 
         self.input: Optional[InputNode] = None
 
     def encode(self) -> tuple:
-        self.input: InputNode = ffmpeg.input(
-            str(self.frames_dir.resolve().joinpath("%08d.png")), framerate=self.in_fps
-        ).filter("fps", fps=self.in_fps)
+        if self.frames is not None:
+            width, height = self.frame_size
+            stream = ffmpeg.input(
+                "pipe:", format="rawvideo", pix_fmt="rgb24", s=f"{width}x{height}", framerate=self.in_fps
+            )
+        else:
+            stream = ffmpeg.input(str(self.frames_dir.resolve().joinpath("%08d.png")), framerate=self.in_fps)
+        self.input: InputNode = stream.filter("fps", fps=self.in_fps)
         match self.codec:
             case VideoCodec.gif:
                 return self._encode_gif()
@@ -121,6 +140,32 @@ class FfmpegEncoder:
     def _out_file(self) -> Path:
         return str(self.out_file.resolve())
 
+    def _run(self, stream, overwrite_output: bool = False) -> tuple:
+        if self.frames is None:
+            return stream.run(overwrite_output=overwrite_output)
+
+        process = stream.run_async(pipe_stdin=True, pipe_stderr=True, overwrite_output=overwrite_output)
+        # drained on a thread, ffmpeg would block on a full stderr pipe while we block on stdin
+        stderr = []
+        reader = threading.Thread(target=lambda: stderr.append(process.stderr.read()), daemon=True)
+        reader.start()
+        try:
+            for frame in self.frames:
+                process.stdin.write(np.ascontiguousarray(frame, dtype=np.uint8).tobytes())
+        except BrokenPipeError:
+            # ffmpeg exited early, its return code and stderr tell why
+            pass
+        finally:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+            retcode = process.wait()
+            reader.join()
+        if retcode:
+            raise ffmpeg.Error("ffmpeg", None, stderr[0] if stderr else None)
+        return None, None
+
     @staticmethod
     def _interpolate(stream, out_fps: int) -> FilterNode:
         return stream.filter("minterpolate", fps=out_fps, mi_mode="mci", mc_mode="aobmc", me_mode="bidir", vsbmc=1)
@@ -139,7 +184,7 @@ class FfmpegEncoder:
         # generate the palette, then use it to encode the GIF
         palette = split_stream[0].filter("palettegen")
         stream = ffmpeg.filter([split_stream[1], palette], "paletteuse").output(self._out_file, vcodec="gif", loop=0)
-        return stream.run()
+        return self._run(stream)
 
     def _encode_webm(self) -> tuple:
         stream: FilterNode = self.input
@@ -153,7 +198,7 @@ class FfmpegEncoder:
         }
         param.update(**self.param)
         stream = stream.output(self._out_file, **param)
-        return stream.run()
+        return self._run(stream)
 
     def _encode_webp(self) -> tuple:
         stream: FilterNode = self.input
@@ -182,7 +227,7 @@ class FfmpegEncoder:
             }
             param.update(**self.param)
             stream = stream.output(self._out_file, **param)
-        return stream.run()
+        return self._run(stream)
 
     def _encode_h264(self) -> tuple:
         stream: FilterNode = self.input
@@ -198,7 +243,7 @@ class FfmpegEncoder:
         param.update(**self.param)
 
         stream = stream.output(self._out_file, **param)
-        return stream.run(overwrite_output=True)
+        return self._run(stream, overwrite_output=True)
 
     def _encode_hevc(self) -> tuple:
         stream: FilterNode = self.input
@@ -214,4 +259,4 @@ class FfmpegEncoder:
         param.update(**self.param)
 
         stream = stream.output(self._out_file, **param)
-        return stream.run(overwrite_output=True)
+        return self._run(stream, overwrite_output=True)
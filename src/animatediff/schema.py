@@ -240,12 +240,23 @@ class TControlnetRef(BaseModel):
     scale_pattern: list[float] = pt.Field(default_factory=lambda: [1.0])
 
 
+class TControlnetResidualCache(BaseModel):
+    enable: bool = False
+    refresh_interval: int = 2
+    interpolation: str = "none"  # "none" | "linear"
+    max_mb_on_vram: int = 2048
+    max_mb_on_cpu: int = 8192
+
+
 class TControlnetMap(BaseModel):
     input_image_dir: str = "./00_controlnet"
     max_samples_on_vram: int = 200
     max_models_on_vram: int = 3
     save_detectmap: bool = True
     preprocess_on_gpu: bool = True
+    # process pool size for cpu bound detectors, and frames per call for detectors that batch
+    preprocess_workers: int = 4
+    preprocess_batch_size: int = 8
     is_loop: bool = True
     controlnet_tile: TControlnetTile = pt.Field(default_factory=lambda: TControlnetTile())
     controlnet_ip2p: TControlnetIp2p = pt.Field(default_factory=lambda: TControlnetIp2p())
@@ -266,6 +277,7 @@ class TControlnetMap(BaseModel):
     controlnet_mediapipe_face: TControlnetMediapipeFace = pt.Field(default_factory=lambda: TControlnetMediapipeFace())
     animatediff_controlnet: TAnimatediffControlnet = pt.Field(default_factory=lambda: TAnimatediffControlnet())
     controlnet_ref: TControlnetRef = pt.Field(default_factory=lambda: TControlnetRef())
+    residual_cache: TControlnetResidualCache = pt.Field(default_factory=lambda: TControlnetResidualCache())
 
     @property
     def controlnets(self) -> list[tuple[str, TAnyControlnet]]:
@@ -331,6 +343,8 @@ class TEncodeParam(BaseModel):
 
 class TOutput(BaseModel):
     preview_steps: list[int] = pt.Field(default_factory=lambda: [10])
+    # "fast": latent approximation encoded in memory, "full": vae decode and ffmpeg encode
+    preview_mode: str = "fast"
     format: str = "mp4"
     fps: int = 8
     encode_param: TEncodeParam = pt.Field(default_factory=lambda: TEncodeParam())
@@ -370,6 +384,9 @@ class TProjectSetting(BaseModel):
     steps: int = 20
     guidance_scale: float = 7.5
     unet_batch_size: int = 1
+    # uniform, static_stride, pyramid, min_overlap, or auto for the cheapest one reaching context_min_coverage
+    context_schedule: str = "uniform"
+    context_min_coverage: int = 1
     clip_skip: int = 2
     prompt_fixed_ratio: float = 0.5
     head_prompt: str = "masterpiece"
@@ -2,7 +2,7 @@ import logging
 from pathlib import Path
 from typing import Any
 
-from pydantic_settings import BaseSettings
+from pydantic_settings import BaseSettings, SettingsConfigDict
 
 from animatediff import get_dir
 from animatediff.schema import TProjectSetting
@@ -19,6 +19,85 @@ class InferenceConfig(BaseSettings):
     noise_scheduler_kwargs: dict[str, Any]
 
 
+class PipelinePoolConfig(BaseSettings):
+
+    """Warm pipeline pool limits, overridable with ANIMATEDIFF_POOL_* env vars."""
+
+    model_config = SettingsConfigDict(env_prefix="animatediff_pool_")
+
+    max_pipelines: int = 3
+    max_gb: float = 24.0
+    # ip adapter clip vision encoders kept loaded between jobs, ~1GB each
+    max_image_encoders: int = 1
+
+
+class VaeDecodeConfig(BaseSettings):
+
+    """Batched vae decode, overridable with ANIMATEDIFF_VAE_DECODE_* env vars."""
+
+    model_config = SettingsConfigDict(env_prefix="animatediff_vae_decode_")
+
+    # 0 picks the chunk size from free device memory
+    chunk_size: int = 0
+    max_chunk_size: int = 16
+    # "auto" tiles only when a single frame does not fit
+    tiling: str = "auto"
+    memory_fraction: float = 0.8
+
+
+class UpscaleBatchConfig(BaseSettings):
+
+    """Frames per tile upscale pipeline call, overridable with ANIMATEDIFF_UPSCALE_* env vars."""
+
+    model_config = SettingsConfigDict(env_prefix="animatediff_upscale_")
+
+    # 0 picks the batch size from free device memory
+    batch_size: int = 0
+    max_batch_size: int = 8
+    memory_fraction: float = 0.7
+
+
+class ConversionCacheConfig(BaseSettings):
+
+    """Cache of converted single file checkpoints, overridable with ANIMATEDIFF_CONVERSION_CACHE_* env vars."""
+
+    model_config = SettingsConfigDict(env_prefix="animatediff_conversion_cache_")
+
+    max_gb: float = 40.0
+
+
+class PreprocessCacheConfig(BaseSettings):
+
+    """Cache of detected controlnet frames, overridable with ANIMATEDIFF_PREPROCESS_CACHE_* env vars."""
+
+    model_config = SettingsConfigDict(env_prefix="animatediff_preprocess_cache_")
+
+    # per project
+    max_gb: float = 2.0
+
+
+class TextEmbeddingCacheConfig(BaseSettings):
+
+    """Cache of encoded prompts, overridable with ANIMATEDIFF_TEXT_EMBEDDING_CACHE_* env vars."""
+
+    model_config = SettingsConfigDict(env_prefix="animatediff_text_embedding_cache_")
+
+    enabled: bool = True
+    max_mb: float = 512.0
+    # entries evicted from memory are written to disk instead of dropped
+    spill_to_disk: bool = False
+    max_disk_gb: float = 4.0
+
+
+class ImageEmbeddingCacheConfig(TextEmbeddingCacheConfig):
+
+    """Cache of encoded ip adapter images, overridable with ANIMATEDIFF_IMAGE_EMBEDDING_CACHE_* env vars."""
+
+    model_config = SettingsConfigDict(env_prefix="animatediff_image_embedding_cache_")
+
+    max_mb: float = 256.0
+
+
 def get_infer_config(
     is_v2: bool,
     is_sdxl: bool,
@@ -1,10 +1,16 @@
 #!/usr/bin/env python
 
+import os
 import re
 
-import cupy
 import torch
 
+try:
+    import cupy
+except ImportError:
+    # without cupy (or without cuda) FunctionCorrelation falls back to correlation_torch
+    cupy = None
+
 kernel_Correlation_rearrange = """
     extern "C" __global__ void kernel_Correlation_rearrange(
         const int n,
@@ -283,11 +289,14 @@ def cupy_kernel(strFunction, objVariables):
 # end
 
 
-@cupy.memoize(for_each_device=True)
 def cupy_launch(strFunction, strKernel):
     return cupy.cuda.compile_with_cache(strKernel).get_function(strFunction)
 
 
+if cupy is not None:
+    cupy_launch = cupy.memoize(for_each_device=True)(cupy_launch)
+
+
 # end
 
 
@@ -441,8 +450,38 @@ class _FunctionCorrelation(torch.autograd.Function):
 # end
 
 
+def use_cupy(tenOne):
+    if os.environ.get("ANIMATEDIFF_SOFTSPLAT_BACKEND", "").lower() == "torch":
+        return False
+    return cupy is not None and tenOne.is_cuda
+
+
+# end
+
+
+def correlation_torch(tenOne, tenTwo):
+    # same 9x9 cost volume as kernel_Correlation_updateOutput, output channel (dy + 4) * 9 + (dx + 4)
+    intHeight, intWidth = tenOne.shape[2], tenOne.shape[3]
+    tenOne = tenOne.float()
+    tenTwo = torch.nn.functional.pad(tenTwo.float(), [4, 4, 4, 4])
+
+    return torch.stack(
+        [
+            (tenOne * tenTwo[:, :, intY : intY + intHeight, intX : intX + intWidth]).mean(1)
+            for intY in range(9)
+            for intX in range(9)
+        ],
+        1,
+    )
+
+
+# end
+
+
 def FunctionCorrelation(tenOne, tenTwo):
-    return _FunctionCorrelation.apply(tenOne, tenTwo)
+    if use_cupy(tenOne):
+        return _FunctionCorrelation.apply(tenOne, tenTwo)
+    return correlation_torch(tenOne, tenTwo).to(tenOne.dtype)
 
 
 # end
@@ -455,7 +494,7 @@ class ModuleCorrelation(torch.nn.Module):
     # end
 
     def forward(self, tenOne, tenTwo):
-        return _FunctionCorrelation.apply(tenOne, tenTwo)
+        return FunctionCorrelation(tenOne, tenTwo)
 
     # end
 
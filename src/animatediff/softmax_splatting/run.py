@@ -8,6 +8,8 @@ import PIL
 import PIL.Image
 import torch
 
+from animatediff.utils.torch_compact import get_torch_device
+
 from . import softsplat  # the custom softmax splatting layer
 
 try:
@@ -75,7 +77,8 @@ backwarp_tenGrid = {}
 
 
 def backwarp(tenIn, tenFlow):
-    if str(tenFlow.shape) not in backwarp_tenGrid:
+    strKey = str(tenFlow.shape) + str(tenFlow.device)
+    if strKey not in backwarp_tenGrid:
         tenHor = (
             torch.linspace(start=-1.0, end=1.0, steps=tenFlow.shape[3], dtype=tenFlow.dtype, device=tenFlow.device)
             .view(1, 1, 1, -1)
@@ -87,7 +90,7 @@ def backwarp(tenIn, tenFlow):
             .repeat(1, 1, 1, tenFlow.shape[3])
         )
 
-        backwarp_tenGrid[str(tenFlow.shape)] = torch.cat([tenHor, tenVer], 1).cuda()
+        backwarp_tenGrid[strKey] = torch.cat([tenHor, tenVer], 1)
     # end
 
     tenFlow = torch.cat(
@@ -100,7 +103,7 @@ def backwarp(tenIn, tenFlow):
 
     return torch.nn.functional.grid_sample(
         input=tenIn,
-        grid=(backwarp_tenGrid[str(tenFlow.shape)] + tenFlow).permute(0, 2, 3, 1),
+        grid=(backwarp_tenGrid[strKey] + tenFlow).permute(0, 2, 3, 1),
         mode="bilinear",
         padding_mode="zeros",
         align_corners=True,
@@ -851,17 +854,19 @@ def estimate(tenOne, tenTwo, fltTimes):
     global netNetwork
 
     if netNetwork is None:
-        netNetwork = Network().cuda().eval()
+        netNetwork = Network().to(get_torch_device()).eval()
     # end
 
+    device = next(netNetwork.parameters()).device
+
     assert tenOne.shape[1] == tenTwo.shape[1]
     assert tenOne.shape[2] == tenTwo.shape[2]
 
     intWidth = tenOne.shape[2]
     intHeight = tenOne.shape[1]
 
-    tenPreprocessedOne = tenOne.cuda().view(1, 3, intHeight, intWidth)
-    tenPreprocessedTwo = tenTwo.cuda().view(1, 3, intHeight, intWidth)
+    tenPreprocessedOne = tenOne.to(device).view(1, 3, intHeight, intWidth)
+    tenPreprocessedTwo = tenTwo.to(device).view(1, 3, intHeight, intWidth)
 
     intPadr = (2 - (intWidth % 2)) % 2
     intPadb = (2 - (intHeight % 2)) % 2
@@ -893,7 +898,7 @@ class Raft:
         from torchvision.models.optical_flow import Raft_Large_Weights, raft_large
 
         weights = Raft_Large_Weights.DEFAULT
-        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.device = get_torch_device()
         model = raft_large(weights=weights, progress=False).to(self.device)
         self.model = model.eval()
 
@@ -905,8 +910,10 @@ class Raft:
             i2 = torch.vstack([img2, img1])
             list_of_flows = self.model(i1, i2)
 
+        # (2 * batch) flows, forward for every pair first, then backward
         predicted_flows = list_of_flows[-1]
-        return {"tenForward": predicted_flows[0].unsqueeze(dim=0), "tenBackward": predicted_flows[1].unsqueeze(dim=0)}
+        batch_size = img1.shape[0]
+        return {"tenForward": predicted_flows[:batch_size], "tenBackward": predicted_flows[batch_size:]}
 
 
 img_count = 0
@@ -931,7 +938,7 @@ class Network2(torch.nn.Module):
 
         self.netSynthesis = Synthesis()
 
-        d = torch.load(model_file_path)
+        d = torch.load(model_file_path, map_location="cpu")
 
         d = {strKey.replace("module", "net"): tenWeight for strKey, tenWeight in d.items()}
 
@@ -1007,8 +1014,9 @@ class Network2(torch.nn.Module):
 
         def mask_dilate(ten, kernel_size=3):
             ten = ten.to(torch.float32)
-            k = torch.ones(1, 1, kernel_size, kernel_size, dtype=torch.float32).cuda()
-            ten = torch.nn.functional.conv2d(ten, k, padding=(kernel_size // 2, kernel_size // 2))
+            k = torch.ones(1, 1, kernel_size, kernel_size, dtype=torch.float32, device=ten.device)
+            # (b h w) masks, one input channel per sample
+            ten = torch.nn.functional.conv2d(ten[:, None], k, padding=(kernel_size // 2, kernel_size // 2))[:, 0]
             result = torch.clamp(ten, 0, 1)
             return result.to(torch.bool)
 
@@ -1016,8 +1024,9 @@ class Network2(torch.nn.Module):
             Z = nA
             Z2 = nB
 
-            mean2 = torch.mean(Z2)
-            max2 = torch.max(Z2)
+            # thresholds are per sample of the batch
+            mean2 = Z2.mean(dim=(1, 2), keepdim=True)
+            max2 = Z2.amax(dim=(1, 2), keepdim=True)
             mask2 = Z2 > (mean2 + max2) / 2
             debug_save_img(mask2.to(torch.float), "mask2_0")
             mask2 = mask_dilate(mask2, 9)
@@ -1026,18 +1035,18 @@ class Network2(torch.nn.Module):
 
             debug_save_img(mask2.to(torch.float), "mask2")
 
-            mean1 = torch.mean(Z)
-            max1 = torch.max(Z)
+            mean1 = Z.mean(dim=(1, 2), keepdim=True)
+            max1 = Z.amax(dim=(1, 2), keepdim=True)
             mask1 = Z > (mean1 + max1) / 2
 
             debug_save_img(mask1.to(torch.float), "mask1")
 
             mask = mask1 & mask2
-            mask = mask.squeeze()
 
             debug_save_img(mask.to(torch.float), "cmask", True)
 
-            fB[:, :, mask] = fA[:, :, mask]
+            mask = mask[:, None].expand_as(fB)
+            fB[mask] = fA[mask]
 
             return fB
 
@@ -1081,12 +1090,22 @@ netNetwork = None
 
 
 def estimate2(img1: PIL.Image, img2: PIL.Image, guideFrames, model_file_path):
+    return estimate2_batch([(img1, img2, guideFrames)], model_file_path)[0]
+
+
+# end
+
+
+def estimate2_batch(pairs, model_file_path):
+    """Interpolate every (img1, img2, guideFrames) in one batch, all images the same size with as many guides."""
     global netNetwork
 
     if netNetwork is None:
-        netNetwork = Network2(model_file_path).cuda().eval()
+        netNetwork = Network2(model_file_path).to(get_torch_device()).eval()
     # end
 
+    device = next(netNetwork.parameters()).device
+
     def forTensor(im):
         return torch.FloatTensor(
             numpy.ascontiguousarray(
@@ -1094,46 +1113,42 @@ def estimate2(img1: PIL.Image, img2: PIL.Image, guideFrames, model_file_path):
             )
         )
 
-    tenOne = forTensor(img1)
-    tenTwo = forTensor(img2)
+    tenOne = torch.stack([forTensor(img1) for img1, _, _ in pairs])
+    tenTwo = torch.stack([forTensor(img2) for _, img2, _ in pairs])
 
-    tenGuideFrames = []
-    for g in guideFrames:
-        tenGuideFrames.append(forTensor(g))
-
-    assert tenOne.shape[1] == tenTwo.shape[1]
-    assert tenOne.shape[2] == tenTwo.shape[2]
+    assert len(set(len(guideFrames) for _, _, guideFrames in pairs)) == 1
+    tenGuideFrames = [
+        torch.stack([forTensor(guideFrames[i]) for _, _, guideFrames in pairs]) for i in range(len(pairs[0][2]))
+    ]
 
-    intWidth = tenOne.shape[2]
-    intHeight = tenOne.shape[1]
+    assert tenOne.shape == tenTwo.shape
 
-    tenPreprocessedOne = tenOne.cuda().view(1, 3, intHeight, intWidth)
-    tenPreprocessedTwo = tenTwo.cuda().view(1, 3, intHeight, intWidth)
-    tenGuideFrames = [ten.cuda().view(1, 3, intHeight, intWidth) for ten in tenGuideFrames]
+    intWidth = tenOne.shape[3]
+    intHeight = tenOne.shape[2]
 
     intPadr = (2 - (intWidth % 2)) % 2
     intPadb = (2 - (intHeight % 2)) % 2
 
-    tenPreprocessedOne = torch.nn.functional.pad(
-        input=tenPreprocessedOne, pad=[0, intPadr, 0, intPadb], mode="replicate"
-    )
-    tenPreprocessedTwo = torch.nn.functional.pad(
-        input=tenPreprocessedTwo, pad=[0, intPadr, 0, intPadb], mode="replicate"
-    )
-    tenGuideFrames = [
-        torch.nn.functional.pad(input=ten, pad=[0, intPadr, 0, intPadb], mode="replicate") for ten in tenGuideFrames
-    ]
+    def preprocess(ten):
+        return torch.nn.functional.pad(input=ten.to(device), pad=[0, intPadr, 0, intPadb], mode="replicate")
 
-    result = [
-        tenImage[0, :, :intHeight, :intWidth].cpu()
+    tenPreprocessedOne = preprocess(tenOne)
+    tenPreprocessedTwo = preprocess(tenTwo)
+    tenGuideFrames = [preprocess(ten) for ten in tenGuideFrames]
+
+    # (frames of the pair) of (batch 3 h w) -> per pair, per frame
+    tenImages = [
+        tenImage[:, :, :intHeight, :intWidth].clip(0.0, 1.0).cpu()
         for tenImage in netNetwork(tenPreprocessedOne, tenPreprocessedTwo, tenGuideFrames)
     ]
-    result = [
-        PIL.Image.fromarray((r.clip(0.0, 1.0).numpy().transpose(1, 2, 0)[:, :, ::-1] * 255.0).astype(numpy.uint8))
-        for r in result
-    ]
 
-    return result
+    return [
+        [
+            PIL.Image.fromarray((tenImage[b].numpy().transpose(1, 2, 0)[:, :, ::-1] * 255.0).astype(numpy.uint8))
+            for tenImage in tenImages
+        ]
+        for b in range(len(pairs))
+    ]
 
 
 # end
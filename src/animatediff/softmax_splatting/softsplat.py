@@ -5,9 +5,14 @@ import os
 import re
 import typing
 
-import cupy
 import torch
 
+try:
+    import cupy
+except ImportError:
+    # without cupy (or without cuda) softsplat falls back to softsplat_torch
+    cupy = None
+
 ##########################################################
 
 
@@ -247,7 +252,6 @@ def cuda_kernel(strFunction: str, strKernel: str, objVariables: typing.Dict):
 # end
 
 
-@cupy.memoize(for_each_device=True)
 def cuda_launch(strKey: str):
     if "CUDA_HOME" not in os.environ:
         os.environ["CUDA_HOME"] = cupy.cuda.get_cuda_path()
@@ -259,6 +263,60 @@ def cuda_launch(strKey: str):
     ).get_function(objCudacache[strKey]["strFunction"])
 
 
+if cupy is not None:
+    cuda_launch = cupy.memoize(for_each_device=True)(cuda_launch)
+
+# end
+
+
+def use_cupy(tenIn: torch.Tensor) -> bool:
+    # the cupy kernels only run on cuda tensors, ANIMATEDIFF_SOFTSPLAT_BACKEND=torch forces the fallback
+    if os.environ.get("ANIMATEDIFF_SOFTSPLAT_BACKEND", "").lower() == "torch":
+        return False
+    return cupy is not None and tenIn.is_cuda
+
+
+# end
+
+
+def softsplat_torch(tenIn: torch.Tensor, tenFlow: torch.Tensor):
+    # same bilinear forward splatting as the softsplat_out kernel, with scatter_add_ in place of atomicAdd
+    intN, intC, intH, intW = tenIn.shape
+    tenIn = tenIn.float()
+    tenFlow = tenFlow.float()
+
+    tenY, tenX = torch.meshgrid(
+        torch.arange(intH, dtype=torch.float32, device=tenIn.device),
+        torch.arange(intW, dtype=torch.float32, device=tenIn.device),
+        indexing="ij",
+    )
+    fltX = tenX + tenFlow[:, 0, :, :]
+    fltY = tenY + tenFlow[:, 1, :, :]
+
+    tenFinite = fltX.isfinite() & fltY.isfinite()
+    fltX = torch.where(tenFinite, fltX, 0.0)
+    fltY = torch.where(tenFinite, fltY, 0.0)
+    intNorthwestX = fltX.floor()
+    intNorthwestY = fltY.floor()
+
+    tenIn = tenIn.view(intN, intC, intH * intW)
+    tenOut = tenIn.new_zeros([intN, intC, intH * intW])
+
+    for intOffsetX, intOffsetY in [(0, 0), (1, 0), (0, 1), (1, 1)]:
+        intCornerX = intNorthwestX + intOffsetX
+        intCornerY = intNorthwestY + intOffsetY
+        fltWeight = (1.0 - (fltX - intCornerX).abs()) * (1.0 - (fltY - intCornerY).abs())
+        tenValid = tenFinite & (intCornerX >= 0) & (intCornerX < intW) & (intCornerY >= 0) & (intCornerY < intH)
+        fltWeight = torch.where(tenValid, fltWeight, 0.0).view(intN, 1, intH * intW)
+
+        tenIndex = intCornerY.clamp(0, intH - 1) * intW + intCornerX.clamp(0, intW - 1)
+        tenIndex = tenIndex.long().view(intN, 1, intH * intW).expand(intN, intC, intH * intW)
+        tenOut.scatter_add_(2, tenIndex, tenIn * fltWeight)
+    # end
+
+    return tenOut.view(intN, intC, intH, intW)
+
+
 # end
 
 
@@ -288,7 +346,10 @@ def softsplat(tenIn: torch.Tensor, tenFlow: torch.Tensor, tenMetric: torch.Tenso
 
     # end
 
-    tenOut = softsplat_func.apply(tenIn, tenFlow)
+    if use_cupy(tenIn):
+        tenOut = softsplat_func.apply(tenIn, tenFlow)
+    else:
+        tenOut = softsplat_torch(tenIn, tenFlow).to(tenIn.dtype)
 
     if strMode.split("-")[0] in ["avg", "linear", "soft"]:
         tenNormalize = tenOut[:, -1:, :, :]
@@ -2,7 +2,9 @@ import glob
 import json
 import logging
 import os.path
+import queue
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
 from typing import Annotated, Optional
@@ -16,10 +18,12 @@ from animatediff import get_dir
 from animatediff.consts import path_mgr
 from animatediff.schema import TIPAdapterMap
 from animatediff.settings import get_project_setting
+from animatediff.utils.frame_source import FrameSource
+from animatediff.utils.frame_store import get_frame_store, link_file
+from animatediff.utils.stage_handoff import staged_passes
 from animatediff.utils.tagger import get_labels
 from animatediff.utils.util import (
     extract_frames,
-    get_resized_image,
     path_from_cwd,
     prepare_anime_seg,
     prepare_groundingDINO,
@@ -240,12 +244,13 @@ def create_config(
         c_dir = controlnet_img_dir.joinpath(c)
         c_dir.mkdir(parents=True, exist_ok=True)
 
+    frame_store = get_frame_store(save_dir)
     if not is_img2img:
-        shutil.copytree(img2img_dir, controlnet_img_dir.joinpath("controlnet_tile"), dirs_exist_ok=True)
+        frame_store.link_tree(img2img_dir, controlnet_img_dir.joinpath("controlnet_tile"))
     else:
-        shutil.copytree(img2img_dir, controlnet_img_dir.joinpath("controlnet_openpose"), dirs_exist_ok=True)
+        frame_store.link_tree(img2img_dir, controlnet_img_dir.joinpath("controlnet_openpose"))
 
-    shutil.copytree(img2img_dir, controlnet_img_dir.joinpath("controlnet_ip2p"), dirs_exist_ok=True)
+    frame_store.link_tree(img2img_dir, controlnet_img_dir.joinpath("controlnet_ip2p"))
 
     black_list = []
     if ignore_list.is_file():
@@ -508,7 +513,7 @@ def generate(
                     n = int(Path(img).stem)
                     if n in range(frame_offset, frame_offset + frame_length):
                         dst_img_path = dst_dir.joinpath(f"{n - frame_offset:08d}.png")
-                        shutil.copy(img, dst_img_path)
+                        link_file(img, dst_img_path)
         # img2img
         org_img2img_img_dir = data_dir.joinpath(project_setting.img2img_map["init_img_dir"])
         new_img2img_img_dir = org_img2img_img_dir.parent / "00_tmp_init_img_dir"
@@ -528,7 +533,7 @@ def generate(
                 n = int(Path(img).stem)
                 if n in range(frame_offset, frame_offset + frame_length):
                     dst_img_path = dst_dir.joinpath(f"{n - frame_offset:08d}.png")
-                    shutil.copy(img, dst_img_path)
+                    link_file(img, dst_img_path)
 
         new_prompt_map = {}
         for p in project_setting.prompt_map:
@@ -545,139 +550,158 @@ def generate(
         tmp_config_path.write_text(project_setting.model_dump_json(indent=4), encoding="utf-8")
         config_org = tmp_config_path
 
-    output_0_dir = generate(
-        config_path=config_org,
-        width=project_setting.stylize_config["0"]["width"],
-        height=project_setting.stylize_config["0"]["height"],
-        length=project_setting.stylize_config["0"]["length"],
-        context=project_setting.stylize_config["0"]["context"],
-        overlap=project_setting.stylize_config["0"]["overlap"],
-        stride=project_setting.stylize_config["0"]["stride"],
-        out_dir=project_dir / "draft",
-    )
-
-    torch.cuda.empty_cache()
-
-    # output_0_dir = output_0_dir.rename(output_0_dir.parent / f"{time_str}_{0:02d}")
-
-    if "1" not in project_setting.stylize_config:
-        logger.info(f"Stylized results are output to {output_0_dir}")
-        return
+    # both passes share the warm pipeline, the draft is handed to the upscale pass in memory while its pngs and
+    # video are written in the background
+    interpolation_multiplier = 1
+    if "1" in project_setting.stylize_config:
+        interpolation_multiplier = project_setting.stylize_config["1"].get("interpolation_multiplier", 1)
+
+    with staged_passes() as handoff:
+        # the upscale pass reads the draft frames from memory, unless rife makes new ones from the pngs
+        handoff.keep_frames = "1" in project_setting.stylize_config and interpolation_multiplier == 1
+        output_0_dir = generate(
+            config_path=config_org,
+            width=project_setting.stylize_config["0"]["width"],
+            height=project_setting.stylize_config["0"]["height"],
+            length=project_setting.stylize_config["0"]["length"],
+            context=project_setting.stylize_config["0"]["context"],
+            overlap=project_setting.stylize_config["0"]["overlap"],
+            stride=project_setting.stylize_config["0"]["stride"],
+            out_dir=project_dir / "draft",
+        )
+        handoff.keep_frames = False
 
-    logger.info(f"Intermediate files have been output to {output_0_dir}")
+        torch.cuda.empty_cache()
 
-    output_0_img_dir = glob.glob(os.path.join(output_0_dir, "00-frames"), recursive=False)[0]
+        # output_0_dir = output_0_dir.rename(output_0_dir.parent / f"{time_str}_{0:02d}")
 
-    interpolation_multiplier = 1
-    if "interpolation_multiplier" in project_setting.stylize_config["1"]:
-        interpolation_multiplier = project_setting.stylize_config["1"]["interpolation_multiplier"]
-
-    if interpolation_multiplier > 1:
-        from animatediff.rife.rife import rife_interpolate
-
-        rife_img_dir = stylize_dir.joinpath(f"{1:02d}_rife_frame")
-        if rife_img_dir.is_dir():
-            shutil.rmtree(rife_img_dir)
-        rife_img_dir.mkdir(parents=True, exist_ok=True)
-
-        rife_interpolate(output_0_img_dir, rife_img_dir, interpolation_multiplier)
-        project_setting.stylize_config["1"]["length"] *= interpolation_multiplier
-
-        if project_setting.output:
-            project_setting.output["fps"] *= interpolation_multiplier
-        if project_setting.prompt_map:
-            project_setting.prompt_map = {
-                str(int(i) * interpolation_multiplier): project_setting.prompt_map[i]
-                for i in project_setting.prompt_map
-            }
+        if "1" not in project_setting.stylize_config:
+            logger.info(f"Stylized results are output to {output_0_dir}")
+            return
 
-        output_0_img_dir = rife_img_dir
+        logger.info(f"Intermediate files have been output to {output_0_dir}")
 
-    controlnet_img_dir = stylize_dir.joinpath("01_controlnet_image")
-    img2img_dir = stylize_dir.joinpath("01_img2img")
-    img2img_dir.mkdir(parents=True, exist_ok=True)
+        # the frames may still be being written in the background
+        output_0_img_dir = output_0_dir / "00-frames"
 
-    for c in [
-        "controlnet_canny",
-        "controlnet_depth",
-        "controlnet_inpaint",
-        "controlnet_ip2p",
-        "controlnet_lineart",
-        "controlnet_lineart_anime",
-        "controlnet_mlsd",
-        "controlnet_normalbae",
-        "controlnet_openpose",
-        "controlnet_scribble",
-        "controlnet_seg",
-        "controlnet_shuffle",
-        "controlnet_softedge",
-        "controlnet_tile",
-    ]:
-        c_dir = controlnet_img_dir.joinpath(c)
-        c_dir.mkdir(parents=True, exist_ok=True)
+        if interpolation_multiplier > 1:
+            from animatediff.rife.rife import rife_interpolate
 
-    ip2p_for_upscale = project_setting.stylize_config["1"]["controlnet_ip2p"]["enable"]
-    ip_adapter_for_upscale = project_setting.stylize_config["1"]["ip_adapter"]
-    ref_for_upscale = project_setting.stylize_config["1"]["reference"]
+            # rife reads the draft frames from disk
+            handoff.wait()
 
-    shutil.copytree(output_0_img_dir, controlnet_img_dir.joinpath("controlnet_tile"), dirs_exist_ok=True)
-    if ip2p_for_upscale:
-        shutil.copytree(
-            controlnet_img_dir.joinpath("controlnet_tile"),
-            controlnet_img_dir.joinpath("controlnet_ip2p"),
-            dirs_exist_ok=True,
-        )
+            rife_img_dir = stylize_dir.joinpath(f"{1:02d}_rife_frame")
+            if rife_img_dir.is_dir():
+                shutil.rmtree(rife_img_dir)
+            rife_img_dir.mkdir(parents=True, exist_ok=True)
 
-    shutil.copytree(controlnet_img_dir.joinpath("controlnet_tile"), img2img_dir, dirs_exist_ok=True)
+            rife_interpolate(output_0_img_dir, rife_img_dir, interpolation_multiplier)
+            project_setting.stylize_config["1"]["length"] *= interpolation_multiplier
 
-    project_setting.controlnet_map["input_image_dir"] = os.path.relpath(controlnet_img_dir.absolute(), data_dir)
+            if project_setting.output:
+                project_setting.output["fps"] *= interpolation_multiplier
+            if project_setting.prompt_map:
+                project_setting.prompt_map = {
+                    str(int(i) * interpolation_multiplier): project_setting.prompt_map[i]
+                    for i in project_setting.prompt_map
+                }
 
-    project_setting.controlnet_map["controlnet_tile"] = project_setting.stylize_config["1"]["controlnet_tile"]
-    project_setting.controlnet_map["controlnet_ip2p"] = project_setting.stylize_config["1"]["controlnet_ip2p"]
+            output_0_img_dir = rife_img_dir
 
-    if "controlnet_ref" in project_setting.controlnet_map:
-        project_setting.controlnet_map["controlnet_ref"]["enable"] = ref_for_upscale
+        controlnet_img_dir = stylize_dir.joinpath("01_controlnet_image")
+        img2img_dir = stylize_dir.joinpath("01_img2img")
+        img2img_dir.mkdir(parents=True, exist_ok=True)
 
-    project_setting.ip_adapter_map["enable"] = ip_adapter_for_upscale
-    for r in project_setting.region_map:
-        reg = project_setting.region_map[r]
-        if "condition" in reg:
-            if "ip_adapter_map" in reg["condition"]:
-                reg["condition"]["ip_adapter_map"]["enable"] = ip_adapter_for_upscale
+        for c in [
+            "controlnet_canny",
+            "controlnet_depth",
+            "controlnet_inpaint",
+            "controlnet_ip2p",
+            "controlnet_lineart",
+            "controlnet_lineart_anime",
+            "controlnet_mlsd",
+            "controlnet_normalbae",
+            "controlnet_openpose",
+            "controlnet_scribble",
+            "controlnet_seg",
+            "controlnet_shuffle",
+            "controlnet_softedge",
+            "controlnet_tile",
+        ]:
+            c_dir = controlnet_img_dir.joinpath(c)
+            c_dir.mkdir(parents=True, exist_ok=True)
 
-    project_setting.steps = (
-        project_setting.stylize_config["1"]["steps"]
-        if "steps" in project_setting.stylize_config["1"]
-        else project_setting.steps
-    )
-    project_setting.guidance_scale = (
-        project_setting.stylize_config["1"]["guidance_scale"]
-        if "guidance_scale" in project_setting.stylize_config["1"]
-        else project_setting.guidance_scale
-    )
+        ip2p_for_upscale = project_setting.stylize_config["1"]["controlnet_ip2p"]["enable"]
+        ip_adapter_for_upscale = project_setting.stylize_config["1"]["ip_adapter"]
+        ref_for_upscale = project_setting.stylize_config["1"]["reference"]
+
+        def link_output_0_frames():
+            frame_store = get_frame_store(stylize_dir)
+            frame_store.link_tree(output_0_img_dir, controlnet_img_dir.joinpath("controlnet_tile"))
+            if ip2p_for_upscale:
+                frame_store.link_tree(output_0_img_dir, controlnet_img_dir.joinpath("controlnet_ip2p"))
+
+            frame_store.link_tree(output_0_img_dir, img2img_dir)
+            # frames of earlier passes that were replaced in every dir
+            frame_store.prune()
+
+        # queued behind the draft's own save, the dirs are filled for prompt_01.json reruns while the upscale pass
+        # already takes the same frames from memory
+        handoff.submit(link_output_0_frames)
+        if interpolation_multiplier == 1:
+            handoff.inputs = {"controlnet_tile", "img2img"}
+            if ip2p_for_upscale:
+                handoff.inputs.add("controlnet_ip2p")
+
+        project_setting.controlnet_map["input_image_dir"] = os.path.relpath(controlnet_img_dir.absolute(), data_dir)
+
+        project_setting.controlnet_map["controlnet_tile"] = project_setting.stylize_config["1"]["controlnet_tile"]
+        project_setting.controlnet_map["controlnet_ip2p"] = project_setting.stylize_config["1"]["controlnet_ip2p"]
+
+        if "controlnet_ref" in project_setting.controlnet_map:
+            project_setting.controlnet_map["controlnet_ref"]["enable"] = ref_for_upscale
+
+        project_setting.ip_adapter_map["enable"] = ip_adapter_for_upscale
+        for r in project_setting.region_map:
+            reg = project_setting.region_map[r]
+            if "condition" in reg:
+                if "ip_adapter_map" in reg["condition"]:
+                    reg["condition"]["ip_adapter_map"]["enable"] = ip_adapter_for_upscale
+
+        project_setting.steps = (
+            project_setting.stylize_config["1"]["steps"]
+            if "steps" in project_setting.stylize_config["1"]
+            else project_setting.steps
+        )
+        project_setting.guidance_scale = (
+            project_setting.stylize_config["1"]["guidance_scale"]
+            if "guidance_scale" in project_setting.stylize_config["1"]
+            else project_setting.guidance_scale
+        )
 
-    project_setting.img2img_map["enable"] = project_setting.stylize_config["1"]["img2img"]
+        project_setting.img2img_map["enable"] = project_setting.stylize_config["1"]["img2img"]
 
-    if project_setting.img2img_map["enable"]:
-        project_setting.img2img_map["init_img_dir"] = os.path.relpath(Path(output_0_img_dir).absolute(), data_dir)
+        if project_setting.img2img_map["enable"]:
+            project_setting.img2img_map["init_img_dir"] = os.path.relpath(Path(output_0_img_dir).absolute(), data_dir)
 
-    save_config_path = stylize_dir.joinpath("prompt_01.json")
-    save_config_path.write_text(project_setting.model_dump_json(indent=4), encoding="utf-8")
+        save_config_path = stylize_dir.joinpath("prompt_01.json")
+        save_config_path.write_text(project_setting.model_dump_json(indent=4), encoding="utf-8")
 
-    output_1_dir = generate(
-        config_path=save_config_path,
-        width=project_setting.stylize_config["1"]["width"],
-        height=project_setting.stylize_config["1"]["height"],
-        length=project_setting.stylize_config["1"]["length"],
-        context=project_setting.stylize_config["1"]["context"],
-        overlap=project_setting.stylize_config["1"]["overlap"],
-        stride=project_setting.stylize_config["1"]["stride"],
-        out_dir=stylize_dir,
-    )
+        output_1_dir = generate(
+            config_path=save_config_path,
+            width=project_setting.stylize_config["1"]["width"],
+            height=project_setting.stylize_config["1"]["height"],
+            length=project_setting.stylize_config["1"]["length"],
+            context=project_setting.stylize_config["1"]["context"],
+            overlap=project_setting.stylize_config["1"]["overlap"],
+            stride=project_setting.stylize_config["1"]["stride"],
+            out_dir=stylize_dir,
+        )
 
-    output_1_dir = output_1_dir.rename(output_1_dir.parent / f"{time_str}_{1:02d}")
+        handoff.wait()
+        output_1_dir = output_1_dir.rename(output_1_dir.parent / f"{time_str}_{1:02d}")
 
-    logger.info(f"Stylized results are output to {output_1_dir}")
+        logger.info(f"Stylized results are output to {output_1_dir}")
 
 
 @stylize.command(no_args_is_help=True)
@@ -696,19 +720,18 @@ def interpolate(
             help="interpolation_multiplier",
         ),
     ] = 1,
+    batch_size: Annotated[
+        int,
+        typer.Option(
+            "--batch_size",
+            "-b",
+            min=1,
+            max=32,
+            help="number of frame pairs interpolated at once",
+        ),
+    ] = 4,
 ):
     """Interpolation with original frames. This function does not work well if the shape of the subject is changed from the original video. Large movements can also ruin the picture.(Since this command is experimental, it is better to use other interpolation methods in most cases.)."""
-    try:
-        import cupy
-    except:
-        logger.info("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
-        logger.info("cupy is required to run interpolate")
-        logger.info(f"Your CUDA version is {torch.version.cuda}")
-        logger.info("Please find the installation method of cupy for your CUDA version from the following URL")
-        logger.info("https://docs.cupy.dev/en/latest/install.html#installing-cupy-from-pypi")
-        logger.info("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
-        return
-
     prepare_softsplat()
 
     time_str = datetime.now().strftime("%Y-%m-%dT%H-%M-%S")
@@ -733,72 +756,114 @@ def interpolate(
 
     save_dir = frame_dir.parent.joinpath(f"optflow_{time_str}")
 
-    org_frame_dir = save_dir.joinpath("org_frame")
-    org_frame_dir.mkdir(parents=True, exist_ok=True)
-
     stylize_frame = sorted(glob.glob(os.path.join(frame_dir, "[0-9]*.png"), recursive=False))
     stylize_frame_num = len(stylize_frame)
 
     duration = int(stylize_frame_num / model_config.output["fps"]) + 1
 
-    extract_frames(
-        org_video, model_config.output["fps"] * interpolation_multiplier, org_frame_dir, aspect_ratio, duration, offset
+    W, H = Image.open(stylize_frame[0]).size
+
+    # original frames are decoded and resized to the stylized size by ffmpeg, and only kept while needed
+    org_source = FrameSource(
+        org_video,
+        model_config.output["fps"] * interpolation_multiplier,
+        aspect_ratio,
+        duration,
+        offset,
+        size=(int(round(W / 8.0)) * 8, int(round(H / 8.0)) * 8),
     )
+    org_frames = enumerate(org_source)
+    org_frame_buf = {}
 
-    W, H = Image.open(stylize_frame[0]).size
+    from animatediff.generate import get_output_encoder, save_output
 
-    org_frame = sorted(glob.glob(os.path.join(org_frame_dir, "[0-9]*.png"), recursive=False))
+    model_config.output["fps"] *= interpolation_multiplier
 
-    for org in tqdm(org_frame):
-        img = get_resized_image(org, W, H)
-        img.save(org)
+    # the guide frames are also the 00_original video, piped to ffmpeg as they are decoded
+    org_out = queue.Queue(maxsize=2 * batch_size * interpolation_multiplier)
+
+    def encode_org_frames():
+        frames = iter(org_out.get, None)
+        try:
+            frame_size = (org_source.width, org_source.height)
+            get_output_encoder(None, save_dir.joinpath("00_original"), model_config.output, frames, frame_size).encode()
+        finally:
+            # a failed encode must not leave the interpolation blocked on a full queue
+            for _ in frames:
+                pass
+
+    def get_org_frame(frame_no):
+        while frame_no not in org_frame_buf:
+            try:
+                n, frame = next(org_frames)
+            except StopIteration:
+                raise ValueError(
+                    f"{org_video} ran out of frames at frame {frame_no}, "
+                    "check the fps, offset and duration of the stylize config"
+                ) from None
+            org_out.put(frame)
+            org_frame_buf[n] = Image.fromarray(frame)
+        return org_frame_buf[frame_no]
 
     output_dir = save_dir.joinpath("warp_img")
     output_dir.mkdir(parents=True, exist_ok=True)
 
-    from animatediff.softmax_splatting.run import estimate2
+    from animatediff.softmax_splatting.run import estimate2_batch
 
-    for sty1, sty2 in tqdm(zip(stylize_frame, stylize_frame[1:]), total=len(stylize_frame[1:])):
-        sty1 = Path(sty1)
-        sty2 = Path(sty2)
+    frame_pairs = list(zip(stylize_frame, stylize_frame[1:]))
 
-        head = int(sty1.stem)
+    with ThreadPoolExecutor(max_workers=1) as executor, tqdm(total=len(frame_pairs)) as pbar:
+        org_encoding = executor.submit(encode_org_frames)
+        try:
+            for b in range(0, len(frame_pairs), batch_size):
+                heads = []
+                pairs = []
+                for sty1, sty2 in frame_pairs[b : b + batch_size]:
+                    sty1 = Path(sty1)
+                    sty2 = Path(sty2)
 
-        sty1_img = Image.open(sty1)
-        sty2_img = Image.open(sty2)
+                    head = int(sty1.stem)
 
-        guide_frames = [
-            org_frame_dir.joinpath(f"{g:08d}.png")
-            for g in range(head * interpolation_multiplier, (head + 1) * interpolation_multiplier)
-        ]
+                    guide_frames = [
+                        get_org_frame(g)
+                        for g in range(head * interpolation_multiplier, (head + 1) * interpolation_multiplier)
+                    ]
 
-        guide_frames = [Image.open(g) for g in guide_frames]
+                    heads.append(head)
+                    pairs.append((Image.open(sty1), Image.open(sty2), guide_frames))
 
-        result = estimate2(sty1_img, sty2_img, guide_frames, path_mgr.softsplat / "softsplat-lf")
+                for g in [g for g in org_frame_buf if g < min(heads) * interpolation_multiplier]:
+                    del org_frame_buf[g]
 
-        shutil.copy(
-            frame_dir.joinpath(f"{head:08d}.png"), output_dir.joinpath(f"{head * interpolation_multiplier:08d}.png")
-        )
+                results = estimate2_batch(pairs, path_mgr.softsplat / "softsplat-lf")
 
-        offset = head * interpolation_multiplier + 1
-        for i, r in enumerate(result):
-            r.save(output_dir.joinpath(f"{offset + i:08d}.png"))
+                for head, result in zip(heads, results):
+                    shutil.copy(
+                        frame_dir.joinpath(f"{head:08d}.png"),
+                        output_dir.joinpath(f"{head * interpolation_multiplier:08d}.png"),
+                    )
 
-    from animatediff.generate import save_output
+                    offset = head * interpolation_multiplier + 1
+                    for i, r in enumerate(result):
+                        r.save(output_dir.joinpath(f"{offset + i:08d}.png"))
+
+                pbar.update(len(pairs))
+
+            # 00_original still covers the whole duration, not just the frames the last pair needed
+            for _, frame in org_frames:
+                org_out.put(frame)
+        finally:
+            org_out.put(None)
+        org_encoding.result()
 
     frames = sorted(glob.glob(os.path.join(output_dir, "[0-9]*.png"), recursive=False))
     out_images = []
     for f in frames:
         out_images.append(Image.open(f))
 
-    model_config.output["fps"] *= interpolation_multiplier
-
     out_file = save_dir.joinpath(f"01_{model_config.output['fps']}fps")
     save_output(out_images, output_dir, out_file, model_config.output, True, save_frames=None, save_video=None)
 
-    out_file = save_dir.joinpath("00_original")
-    save_output(out_images, org_frame_dir, out_file, model_config.output, True, save_frames=None, save_video=None)
-
 
 @stylize.command(no_args_is_help=True)
 def create_mask(
@@ -869,6 +934,17 @@ def create_mask(
             rich_help_panel="create mask",
         ),
     ] = False,
+    mask_keyframe_interval: Annotated[
+        int,
+        typer.Option(
+            "--mask_keyframe_interval",
+            "-mk",
+            min=1,
+            max=120,
+            help="run GroundingDINO every N frames (and on big changes) and track the subject in between",
+            rich_help_panel="create mask",
+        ),
+    ] = 1,
     use_rembg: Annotated[
         bool,
         typer.Option(
@@ -1080,6 +1156,8 @@ def create_mask(
                 mask_padding=mask_padding,
                 sam_checkpoint="models/sam/sam_hq_vit_h.pth" if not low_vram else "models/sam/sam_hq_vit_b.pth",
                 bg_color=None if no_gb else (0, 255, 0),
+                keyframe_interval=mask_keyframe_interval,
+                sam_batch_size=1 if low_vram else 4,
             )
 
         if not no_crop:
@@ -1096,12 +1174,13 @@ def create_mask(
 
         logger.info(f"mask from [{mask_token}] are output to {fg_dir}")
 
+        frame_store = get_frame_store(stylize_dir)
         if not is_img2img:
-            shutil.copytree(fg_masked_dir, fg_dir / "00_controlnet_image/controlnet_tile", dirs_exist_ok=True)
+            frame_store.link_tree(fg_masked_dir, fg_dir / "00_controlnet_image/controlnet_tile")
         else:
-            shutil.copytree(fg_masked_dir, fg_dir / "00_controlnet_image/controlnet_openpose", dirs_exist_ok=True)
+            frame_store.link_tree(fg_masked_dir, fg_dir / "00_controlnet_image/controlnet_openpose")
 
-        shutil.copytree(fg_masked_dir, fg_dir / "00_controlnet_image/controlnet_ip2p", dirs_exist_ok=True)
+        frame_store.link_tree(fg_masked_dir, fg_dir / "00_controlnet_image/controlnet_ip2p")
 
         if crop_size_hw:
             if crop_size_hw[0] == 0 or crop_size_hw[1] == 0:
@@ -1131,12 +1210,13 @@ def create_mask(
 
     logger.info(f"background are output to {bg_dir}")
 
+    frame_store = get_frame_store(stylize_dir)
     if not is_img2img:
-        shutil.copytree(bg_inpaint_dir, bg_dir / "00_controlnet_image/controlnet_tile", dirs_exist_ok=True)
+        frame_store.link_tree(bg_inpaint_dir, bg_dir / "00_controlnet_image/controlnet_tile")
     else:
-        shutil.copytree(bg_inpaint_dir, bg_dir / "00_controlnet_image/controlnet_openpose", dirs_exist_ok=True)
+        frame_store.link_tree(bg_inpaint_dir, bg_dir / "00_controlnet_image/controlnet_openpose")
 
-    shutil.copytree(bg_inpaint_dir, bg_dir / "00_controlnet_image/controlnet_ip2p", dirs_exist_ok=True)
+    frame_store.link_tree(bg_inpaint_dir, bg_dir / "00_controlnet_image/controlnet_ip2p")
 
     output_list.append((bg_dir, None))
 
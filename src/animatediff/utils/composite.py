@@ -2,6 +2,8 @@ import glob
 import logging
 import os
 import shutil
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import cv2
@@ -11,6 +13,8 @@ import torch.nn.functional as F
 from PIL import Image
 from tqdm.rich import tqdm
 
+from animatediff.utils.torch_compact import get_torch_device
+
 logger = logging.getLogger(__name__)
 
 
@@ -19,33 +23,41 @@ logger = logging.getLogger(__name__)
 class LaplacianPyramidBlender:
     device = None
 
-    def get_gaussian_kernel(self):
-        kernel = (
-            np.array(
-                [[1, 4, 6, 4, 1], [4, 16, 24, 16, 4], [6, 24, 36, 24, 6], [4, 16, 24, 16, 4], [1, 4, 6, 4, 1]],
-                np.float32,
+    def __init__(self):
+        # (device, channels) -> depthwise gaussian kernel
+        self.kernels = {}
+
+    def get_gaussian_kernel(self, channels=3):
+        key = (str(self.device), channels)
+        if key not in self.kernels:
+            kernel = (
+                np.array(
+                    [[1, 4, 6, 4, 1], [4, 16, 24, 16, 4], [6, 24, 36, 24, 6], [4, 16, 24, 16, 4], [1, 4, 6, 4, 1]],
+                    np.float32,
+                )
+                / 256.0
             )
-            / 256.0
-        )
-        gaussian_k = torch.as_tensor(kernel.reshape(1, 1, 5, 5), device=self.device)
-        return gaussian_k
+            gaussian_k = torch.as_tensor(kernel.reshape(1, 1, 5, 5), device=self.device)
+            self.kernels[key] = gaussian_k.repeat(channels, 1, 1, 1)
+        return self.kernels[key]
+
+    def blur(self, image, stride=1):
+        # every channel convolved on its own, as one grouped conv
+        channels = image.shape[1]
+        return F.conv2d(image, self.get_gaussian_kernel(channels), padding=2, stride=stride, groups=channels)
 
     def pyramid_down(self, image):
         with torch.no_grad():
-            gaussian_k = self.get_gaussian_kernel()
-            multiband = [F.conv2d(image[:, i : i + 1, :, :], gaussian_k, padding=2, stride=2) for i in range(3)]
-            down_image = torch.cat(multiband, dim=1)
+            down_image = self.blur(image, stride=2)
         return down_image
 
     def pyramid_up(self, image, size=None):
         with torch.no_grad():
-            gaussian_k = self.get_gaussian_kernel()
             if size is None:
                 upsample = F.interpolate(image, scale_factor=2)
             else:
                 upsample = F.interpolate(image, size=size)
-            multiband = [F.conv2d(upsample[:, i : i + 1, :, :], gaussian_k, padding=2) for i in range(3)]
-            up_image = torch.cat(multiband, dim=1)
+            up_image = self.blur(upsample)
         return up_image
 
     def gaussian_pyramid(self, original, n_pyramids):
@@ -70,21 +82,17 @@ class LaplacianPyramidBlender:
         return laplacian
 
     def laplacian_pyramid_blending_with_mask(self, src, target, mask, num_levels=9):
-        # assume mask is float32 [0,1]
-
-        # generate Gaussian pyramid for src,target and mask
+        # src, target, mask : (n 3 h w) float32 [0,1] tensors
 
-        Gsrc = torch.as_tensor(np.expand_dims(src, axis=0), device=self.device)
-        Gtarget = torch.as_tensor(np.expand_dims(target, axis=0), device=self.device)
-        Gmask = torch.as_tensor(np.expand_dims(mask, axis=0), device=self.device)
-
-        lpA = self.laplacian_pyramid(Gsrc, num_levels)[::-1]
-        lpB = self.laplacian_pyramid(Gtarget, num_levels)[::-1]
-        gpMr = self.gaussian_pyramid(Gmask, num_levels)[::-1]
+        # src and target share one pass through the pyramid
+        n = src.shape[0]
+        lpAB = self.laplacian_pyramid(torch.cat([src, target]), num_levels)[::-1]
+        gpMr = self.gaussian_pyramid(mask, num_levels)[::-1]
 
         # Now blend images according to mask in each level
         LS = []
-        for idx, (la, lb, Gmask) in enumerate(zip(lpA, lpB, gpMr)):
+        for idx, (lab, Gmask) in enumerate(zip(lpAB, gpMr)):
+            la, lb = lab[:n], lab[n:]
             lo = lb * (1.0 - Gmask)
             if idx <= 2:
                 lo += lb * Gmask
@@ -97,33 +105,59 @@ class LaplacianPyramidBlender:
         for lap in LS:
             ls_ = self.pyramid_up(ls_, lap.shape[2:]) + lap
 
-        result = ls_.squeeze(dim=0).to("cpu").detach().numpy().copy()
+        return ls_
 
-        return result
+    def blend_batch(self, src_images: np.ndarray, target_images: np.ndarray, mask_images: np.ndarray, device):
+        """Blend (n h w 3) src and target in [0,255] with masks in [0,1] of the same size into (n h w 3) uint8."""
+        self.device = device
+
+        num_levels = int(np.log2(src_images.shape[1]))
+
+        def to_tensor(images, scale):
+            images = torch.as_tensor(np.ascontiguousarray(images), device=self.device)
+            return images.permute(0, 3, 1, 2).to(torch.float32) * scale
+
+        with torch.no_grad():
+            mask = to_tensor(mask_images, 1.0).clamp(0, 1)
+            src = to_tensor(src_images, 1.0 / 255.0)
+            target = to_tensor(target_images, 1.0 / 255.0)
+            composite_images = self.laplacian_pyramid_blending_with_mask(src, target, mask, num_levels)
+            composite_images = (composite_images * 255).clamp(0, 255).to(torch.uint8)
+        return composite_images.permute(0, 2, 3, 1).cpu().numpy()
 
     def __call__(self, src_image: np.ndarray, target_image: np.ndarray, mask_image: np.ndarray, device):
-        self.device = device
+        return self.blend_batch(src_image[None], target_image[None], mask_image[None], device)[0]
+
+
+def prepare_composite_frame(bg_path, fg_array, mask):
+    """Return (bg, fg pasted over bg, blurred mask) at the size of the bg frame."""
+    bg = np.asarray(Image.open(bg_path)).copy()
+    fg = fg_array
+    mask = np.concatenate([mask, mask, mask], 2)
+
+    h, w, _ = bg.shape
 
-        num_levels = int(np.log2(src_image.shape[0]))
-        # normalize image to 0, 1
-        mask_image = np.clip(mask_image, 0, 1).transpose([2, 0, 1])
+    fg = cv2.resize(fg, dsize=(w, h))
+    mask = cv2.resize(mask, dsize=(w, h))
 
-        src_image = src_image.transpose([2, 0, 1]).astype(np.float32) / 255.0
-        target_image = target_image.transpose([2, 0, 1]).astype(np.float32) / 255.0
-        composite_image = self.laplacian_pyramid_blending_with_mask(src_image, target_image, mask_image, num_levels)
-        composite_image = np.clip(composite_image * 255, 0, 255).astype(np.uint8)
-        composite_image = composite_image.transpose([1, 2, 0])
-        return composite_image
+    mask = mask.astype(np.float32)
+    # mask = mask * 255
+    mask = cv2.GaussianBlur(mask, (15, 15), 0)
+    mask = mask / 255
 
+    fg = fg * mask + bg * (1 - mask)
+    return bg, fg, mask
 
-def composite(bg_dir, fg_list, output_dir, masked_area_list, device="cuda"):
+
+def composite(bg_dir, fg_list, output_dir, masked_area_list, device=None, batch_size=8, num_workers=4):
     bg_list = sorted(glob.glob(os.path.join(bg_dir, "[0-9]*.png"), recursive=False))
+    device = device or get_torch_device()
 
     blender = LaplacianPyramidBlender()
 
-    for bg, fg_array, mask in tqdm(zip(bg_list, fg_list, masked_area_list), total=len(bg_list), desc="compositing"):
-        name = Path(bg).name
-        save_path = output_dir / name
+    frames = []
+    for bg, fg_array, mask in zip(bg_list, fg_list, masked_area_list):
+        save_path = output_dir / Path(bg).name
 
         if fg_array is None:
             logger.info("composite fg_array is None -> skip")
@@ -135,26 +169,42 @@ def composite(bg_dir, fg_list, output_dir, masked_area_list, device="cuda"):
             shutil.copy(bg, save_path)
             continue
 
-        bg = np.asarray(Image.open(bg)).copy()
-        fg = fg_array
-        mask = np.concatenate([mask, mask, mask], 2)
-
-        h, w, _ = bg.shape
-
-        fg = cv2.resize(fg, dsize=(w, h))
-        mask = cv2.resize(mask, dsize=(w, h))
-
-        mask = mask.astype(np.float32)
-        # mask = mask * 255
-        mask = cv2.GaussianBlur(mask, (15, 15), 0)
-        mask = mask / 255
-
-        fg = fg * mask + bg * (1 - mask)
-
-        img = blender(fg, bg, mask, device)
-
-        img = Image.fromarray(img)
-        img.save(save_path)
+        frames.append((bg, fg_array, mask, save_path))
+
+    batches = [frames[i : i + batch_size] for i in range(0, len(frames), batch_size)]
+
+    def save(img, save_path):
+        Image.fromarray(img).save(save_path)
+
+    # read and resize the next batch, and write the previous one, while the current one is blended
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        pending = [executor.submit(prepare_composite_frame, *f[:3]) for f in batches[0]] if batches else []
+        writes = deque()
+        with tqdm(total=len(frames), desc="compositing") as pbar:
+            for b, batch in enumerate(batches):
+                prepared = [f.result() for f in pending]
+                if b + 1 < len(batches):
+                    pending = [executor.submit(prepare_composite_frame, *f[:3]) for f in batches[b + 1]]
+
+                # frames of different sizes can't share a tensor
+                i = 0
+                while i < len(prepared):
+                    j = i + 1
+                    while j < len(prepared) and prepared[j][0].shape == prepared[i][0].shape:
+                        j += 1
+                    bg, fg, mask = (np.stack(x) for x in zip(*prepared[i:j]))
+                    for img, f in zip(blender.blend_batch(fg, bg, mask, device), batch[i:j]):
+                        writes.append(executor.submit(save, img, f[3]))
+                    i = j
+
+                # every queued write holds a decoded frame, don't let them fall more than two batches behind
+                while len(writes) > 2 * batch_size:
+                    writes.popleft().result()
+
+                pbar.update(len(batch))
+
+        for w in writes:
+            w.result()
 
 
 def simple_composite(bg_dir, fg_list, output_dir, masked_area_list, device="cuda"):
@@ -0,0 +1,107 @@
+import logging
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import Callable
+
+import torch
+from safetensors.torch import load_file, save_file
+
+from animatediff.consts import CACHE_DIR
+from animatediff.settings import ConversionCacheConfig
+from animatediff.utils.model_info import model_index
+
+logger = logging.getLogger(__name__)
+
+
+def _to_saveable(state_dict: dict[str, torch.Tensor]) -> dict[str, torch.Tensor]:
+    # safetensors refuses tensors sharing storage, copy only those
+    seen = set()
+    tensors = {}
+    for k, v in state_dict.items():
+        v = v.contiguous()
+        if v.untyped_storage().data_ptr() in seen:
+            v = v.clone()
+        seen.add(v.untyped_storage().data_ptr())
+        tensors[k] = v
+    return tensors
+
+
+def _dir_nbytes(path: Path) -> int:
+    return sum(f.stat().st_size for f in path.rglob("*") if f.is_file())
+
+
+class ConversionCache:
+
+    """Diffusers weights converted from single file checkpoints, keyed by the checkpoint's sha256.
+
+    Every component is stored as its own safetensors file, which load_file maps into memory instead of
+    reading. Entries are evicted least recently used first once the cache grows past max_gb.
+    """
+
+    def __init__(self, cache_dir: Path = CACHE_DIR / "converted", config: ConversionCacheConfig | None = None):
+        self.cache_dir = Path(cache_dir)
+        self.config = config or ConversionCacheConfig()
+
+    def entry_dir(self, checkpoint: Path) -> Path:
+        return self.cache_dir / model_index.get_sha256(checkpoint)[:32]
+
+    def _touch(self, entry: Path):
+        now = time.time()
+        os.utime(entry, (now, now))
+
+    def get_state_dicts(
+        self, checkpoint: Path, components: list[str], convert: Callable[[], dict[str, dict[str, torch.Tensor]]]
+    ) -> dict[str, dict[str, torch.Tensor]]:
+        """Return {component: state dict}, running convert() and storing its result on a miss."""
+        entry = self.entry_dir(checkpoint)
+        paths = {c: entry / f"{c}.safetensors" for c in components}
+        if all(p.is_file() for p in paths.values()):
+            logger.info(f"Loading converted weights of {checkpoint.name} from cache")
+            self._touch(entry)
+            return {c: load_file(p) for c, p in paths.items()}
+
+        state_dicts = convert()
+        tmp = entry.with_name(f"{entry.name}.{os.getpid()}.tmp")
+        tmp.mkdir(parents=True, exist_ok=True)
+        for c in components:
+            save_file(_to_saveable(state_dicts[c]), tmp / f"{c}.safetensors")
+        entry.mkdir(parents=True, exist_ok=True)
+        for c in components:
+            os.replace(tmp / f"{c}.safetensors", paths[c])
+        shutil.rmtree(tmp, ignore_errors=True)
+        self._touch(entry)
+
+        self.evict(keep=entry)
+        return state_dicts
+
+    def get_pipeline_dir(self, checkpoint: Path, save_pretrained: Callable[[Path], None]) -> Path:
+        """Directory holding the checkpoint saved as a full diffusers pipeline, created on a miss."""
+        entry = self.entry_dir(checkpoint)
+        pipeline_dir = entry / "pipeline"
+        if not (pipeline_dir / "model_index.json").is_file():
+            tmp = entry / f"pipeline.{os.getpid()}.tmp"
+            save_pretrained(tmp)
+            shutil.rmtree(pipeline_dir, ignore_errors=True)
+            os.replace(tmp, pipeline_dir)
+            self.evict(keep=entry)
+        self._touch(entry)
+        return pipeline_dir
+
+    def evict(self, keep: Path | None = None):
+        entries = [e for e in self.cache_dir.iterdir() if e.is_dir() and not e.name.endswith(".tmp")]
+        sizes = {e: _dir_nbytes(e) for e in entries}
+        total = sum(sizes.values())
+        max_bytes = self.config.max_gb * 1024**3
+        for e in sorted(entries, key=lambda e: e.stat().st_mtime):
+            if total <= max_bytes:
+                break
+            if e == keep:
+                continue
+            logger.info(f"Conversion cache: evicting {e.name} ({sizes[e] / 1024**3:.1f}GB)")
+            shutil.rmtree(e, ignore_errors=True)
+            total -= sizes[e]
+
+
+conversion_cache = ConversionCache()
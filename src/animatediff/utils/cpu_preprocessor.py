@@ -0,0 +1,85 @@
+from typing import Any
+
+import numpy as np
+from PIL import Image
+
+# kept apart from animatediff.generate, so a spawned preprocess worker imports only what its detector needs
+
+# pre_type -> detector, created on first use in each worker
+_worker_preprocessors: dict[str, Any] = {}
+
+
+def hwc3(x: np.ndarray) -> np.ndarray:
+    """controlnet_aux.util.HWC3, without importing every controlnet_aux detector."""
+    if x.ndim == 2:
+        x = x[:, :, None]
+    if x.shape[2] == 1:
+        return np.concatenate([x, x, x], axis=2)
+    if x.shape[2] == 4:
+        color = x[:, :, 0:3].astype(np.float32)
+        alpha = x[:, :, 3:4].astype(np.float32) / 255.0
+        return (color * alpha + 255.0 * (1.0 - alpha)).clip(0, 255).astype(np.uint8)
+    return x
+
+
+class NullPreProcessor:
+    def __call__(self, input_image, **kwargs):
+        return input_image
+
+
+class BlurPreProcessor:
+    def __call__(self, input_image, sigma=5.0, **kwargs):
+        import cv2
+
+        input_array = np.array(input_image, dtype=np.uint8)
+        input_array = hwc3(input_array)
+
+        dst = cv2.GaussianBlur(input_array, (0, 0), sigma)
+
+        return Image.fromarray(dst)
+
+
+class TileResamplePreProcessor:
+    def resize(self, input_image, resolution):
+        import cv2
+
+        H, W, C = input_image.shape
+        H = float(H)
+        W = float(W)
+        k = float(resolution) / min(H, W)
+        H *= k
+        W *= k
+        img = cv2.resize(input_image, (int(W), int(H)), interpolation=cv2.INTER_LANCZOS4 if k > 1 else cv2.INTER_AREA)
+        return img
+
+    def __call__(self, input_image, down_sampling_rate=1.0, **kwargs):
+        input_array = np.array(input_image, dtype=np.uint8)
+        input_array = hwc3(input_array)
+
+        H, W, C = input_array.shape
+
+        target_res = min(H, W) / down_sampling_rate
+
+        dst = self.resize(input_array, target_res)
+
+        return Image.fromarray(dst)
+
+
+def create_cpu_preprocessor(pre_type: str):
+    if pre_type == "blur":
+        return BlurPreProcessor()
+    elif pre_type == "tile_resample":
+        return TileResamplePreProcessor()
+    elif pre_type == "none":
+        return NullPreProcessor()
+
+    from controlnet_aux.processor import Processor
+
+    return Processor(pre_type)
+
+
+def run_in_worker(pre_type: str, images: list[Image.Image], params: dict[str, Any]) -> list[Image.Image]:
+    if pre_type not in _worker_preprocessors:
+        _worker_preprocessors[pre_type] = create_cpu_preprocessor(pre_type)
+    preprocessor = _worker_preprocessors[pre_type]
+    return [preprocessor(img, **params) for img in images]
@@ -0,0 +1,178 @@
+import hashlib
+import json
+import logging
+import os
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable
+
+import torch
+from PIL import Image
+from safetensors.torch import load_file, save_file
+
+from animatediff.consts import CACHE_DIR
+from animatediff.settings import ImageEmbeddingCacheConfig, TextEmbeddingCacheConfig
+
+logger = logging.getLogger(__name__)
+
+TEmbeds = tuple[torch.Tensor, ...]
+
+
+def model_file_id(path: Path) -> str:
+    """Cheap identity of a model file, changes when the file is replaced. Directories are taken by path."""
+    path = Path(path)
+    if path.is_file():
+        stat = path.stat()
+        return f"{path.name}:{stat.st_size}:{stat.st_mtime_ns}"
+    return str(path)
+
+
+def get_text_encoder_key(pipe) -> str | None:
+    """Identity of the text encoder weights of pipe: checkpoint, merged loras, TI tokens and dtype.
+
+    None when it can't be told, the cache is bypassed then. That is the case for pipelines built without a
+    text_encoder_source, and for region loras, which hook the text encoder with a per-frame scale.
+    """
+    source = getattr(pipe, "text_encoder_source", None)
+    if source is None or getattr(pipe, "lora_map", None) is not None:
+        return None
+    lora_state = getattr(pipe, "lora_state", None)
+    loras = sorted((model_file_id(p), scale) for p, (_, scale) in lora_state.merged.items()) if lora_state else []
+    tokens = sorted(pipe.tokenizer.get_added_vocab())
+    identity = [source, loras, tokens, str(pipe.text_encoder.dtype)]
+    return hashlib.sha1(json.dumps(identity).encode()).hexdigest()
+
+
+def image_hash(image: Image.Image) -> str:
+    """Hash of the pixels of image, whatever file it came from."""
+    h = hashlib.sha1(f"{image.mode}:{image.size}".encode())
+    h.update(image.tobytes())
+    return h.hexdigest()
+
+
+class EmbeddingCache:
+
+    """LRU cache of encoder outputs on the cpu, shared by the sd15 and sdxl pipelines.
+
+    Keys are (encoder key, mode, input), mode covering whatever else changes the result (weighting,
+    clip_skip, padded length), input being a prompt or an image hash. Values are tuples of tensors.
+    With spill_to_disk, entries evicted from memory are saved under cache_dir and read back on a later hit.
+    """
+
+    def __init__(self, cache_dir: Path, config: TextEmbeddingCacheConfig):
+        self.cache_dir = Path(cache_dir)
+        self.config = config
+        self.entries: OrderedDict[str, TEmbeds] = OrderedDict()
+        self.nbytes = 0
+        self.disk_nbytes: int | None = None
+
+    @staticmethod
+    def make_key(encoder_key: str, mode: str, text: str) -> str:
+        return hashlib.sha1(json.dumps([encoder_key, mode, text]).encode()).hexdigest()
+
+    @staticmethod
+    def _nbytes(value: TEmbeds) -> int:
+        return sum(t.numel() * t.element_size() for t in value)
+
+    def _disk_path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.safetensors"
+
+    def get(self, key: str) -> TEmbeds | None:
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        if not self.config.spill_to_disk:
+            return None
+        path = self._disk_path(key)
+        if not path.is_file():
+            return None
+        tensors = load_file(path)
+        # disk entries are evicted oldest mtime first
+        os.utime(path)
+        value = tuple(tensors[str(i)] for i in range(len(tensors)))
+        self.put(key, value)
+        return value
+
+    def put(self, key: str, value: TEmbeds):
+        value = tuple(t.detach().to("cpu", copy=True) for t in value)
+        if key in self.entries:
+            self.nbytes -= self._nbytes(self.entries[key])
+        self.entries[key] = value
+        self.nbytes += self._nbytes(value)
+        self.evict()
+
+    def evict(self):
+        max_bytes = self.config.max_mb * 1024**2
+        while len(self.entries) > 1 and self.nbytes > max_bytes:
+            key, value = self.entries.popitem(last=False)
+            self.nbytes -= self._nbytes(value)
+            if self.config.spill_to_disk:
+                self._spill(key, value)
+
+    def _spill(self, key: str, value: TEmbeds):
+        path = self._disk_path(key)
+        if path.is_file():
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        save_file({str(i): t.contiguous() for i, t in enumerate(value)}, tmp)
+        os.replace(tmp, path)
+
+        if self.disk_nbytes is None:
+            self.disk_nbytes = sum(f.stat().st_size for f in self.cache_dir.glob("*/*.safetensors"))
+        else:
+            self.disk_nbytes += path.stat().st_size
+        if self.disk_nbytes > self.config.max_disk_gb * 1024**3:
+            self.evict_disk()
+
+    def evict_disk(self):
+        files = sorted(self.cache_dir.glob("*/*.safetensors"), key=lambda f: f.stat().st_mtime)
+        total = sum(f.stat().st_size for f in files)
+        # leave some room, so the next spills don't rescan the dir right away
+        max_bytes = self.config.max_disk_gb * 1024**3 * 0.9
+        for f in files:
+            if total <= max_bytes:
+                break
+            total -= f.stat().st_size
+            f.unlink(missing_ok=True)
+        logger.debug(f"Embedding cache: {total / 1024**2:.1f}MB left in {self.cache_dir}")
+        self.disk_nbytes = total
+
+    def get_or_encode(
+        self,
+        encoder_key: str | None,
+        mode: str,
+        texts: list[str],
+        encode: Callable[[list[str]], list[TEmbeds]],
+    ) -> list[TEmbeds]:
+        """Values for texts, encode() is called once with the distinct texts that are not cached yet.
+
+        Cached values are on the cpu, newly encoded ones are returned as encode() made them, so callers move
+        them to their device before combining.
+        """
+        if encoder_key is None or not self.config.enabled:
+            return encode(texts)
+
+        keys = [self.make_key(encoder_key, mode, text) for text in texts]
+        found = {}
+        for key in dict.fromkeys(keys):
+            value = self.get(key)
+            if value is not None:
+                found[key] = value
+
+        missing = list(dict.fromkeys(text for text, key in zip(texts, keys) if key not in found))
+        logger.debug(f"Embedding cache: {len(found)} of {len(found) + len(missing)} distinct inputs cached")
+        if missing:
+            for text, value in zip(missing, encode(missing)):
+                key = self.make_key(encoder_key, mode, text)
+                found[key] = value
+                self.put(key, value)
+        return [found[key] for key in keys]
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+
+text_embedding_cache = EmbeddingCache(CACHE_DIR / "text_embeddings", TextEmbeddingCacheConfig())
+image_embedding_cache = EmbeddingCache(CACHE_DIR / "image_embeddings", ImageEmbeddingCacheConfig())
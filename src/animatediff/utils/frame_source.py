@@ -0,0 +1,163 @@
+import logging
+import threading
+from pathlib import Path
+from typing import Iterator
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class FrameSource:
+
+    """Frames of a video decoded by ffmpeg into (h w 3) uint8 arrays.
+
+    The fps change, trim, scale and crop all run inside ffmpeg, frames come out of a rawvideo pipe without
+    ever being written to disk. size=(width, height) adds a final resize after the crop.
+    """
+
+    def __init__(
+        self,
+        movie_file_path: Path,
+        fps: float,
+        aspect_ratio: float = -1,
+        duration: float = -1,
+        offset: float = 0,
+        size_of_short_edge: int = -1,
+        low_vram_mode: bool = False,
+        size: tuple[int, int] | None = None,
+    ):
+        import ffmpeg
+
+        self.movie_file_path = Path(movie_file_path)
+        self.fps = fps
+        self.duration = duration
+        self.offset = offset
+
+        probe = ffmpeg.probe(str(self.movie_file_path))
+        video = next((stream for stream in probe["streams"] if stream["codec_type"] == "video"), None)
+        width = int(video["width"])
+        height = int(video["height"])
+
+        self.scale = None
+        if size_of_short_edge != -1:
+            if width < height:
+                r = height / width
+                width = size_of_short_edge
+                height = int((size_of_short_edge * r) // 8 * 8)
+            else:
+                r = width / height
+                height = size_of_short_edge
+                width = int((size_of_short_edge * r) // 8 * 8)
+            self.scale = (width, height)
+
+        if low_vram_mode:
+            if aspect_ratio == -1:
+                aspect_ratio = width / height
+                logger.info(f"low {aspect_ratio=}")
+                aspect_ratio = max(min(aspect_ratio, 1.5), 0.6666)
+                logger.info(f"low {aspect_ratio=}")
+
+        self.crop = None
+        if aspect_ratio > 0:
+            # aspect ratio (width / height)
+            ww = round(height * aspect_ratio)
+            if ww < width:
+                x = (width - ww) // 2
+                y = 0
+                w = ww
+                h = height
+            else:
+                hh = round(width / aspect_ratio)
+                x = 0
+                y = (height - hh) // 2
+                w = width
+                h = hh
+            w = int(w // 8 * 8)
+            h = int(h // 8 * 8)
+            logger.info(f"crop to {w=},{h=}")
+            self.crop = (x, y, w, h)
+            width, height = w, h
+
+        self.size = size
+        self.width, self.height = size or (width, height)
+
+    def node(self, start: int = 0, count: int | None = None):
+        """Build the ffmpeg filter graph for count frames from frame number start."""
+        import ffmpeg
+
+        start_time = self.offset + start / self.fps
+        end_time = self.offset + self.duration if self.duration > 0 else None
+        if count is not None:
+            end_time = min(end_time or np.inf, start_time + count / self.fps)
+
+        # seeking on the input lets ffmpeg jump to the keyframe before start_time instead of decoding from 0,
+        # timestamps then start at 0 so only the end point is left for trim
+        input_args = {"ss": start_time} if start_time > 0 else {}
+        node = ffmpeg.input(str(self.movie_file_path.resolve()), **input_args)
+        node = node.filter("fps", fps=self.fps)
+        if end_time is not None:
+            node = node.trim(end=end_time - start_time).setpts("PTS-STARTPTS")
+
+        if self.scale:
+            node = node.filter("scale", *self.scale)
+        if self.crop:
+            node = node.crop(*self.crop)
+        if self.size:
+            node = node.filter("scale", *self.size, flags="lanczos")
+        return node
+
+    def frames(self, start: int = 0, count: int | None = None) -> Iterator[np.ndarray]:
+        """Decode count frames (all of them if None) from frame number start."""
+        process = (
+            self.node(start, count)
+            .output("pipe:", format="rawvideo", pix_fmt="rgb24")
+            .global_args("-loglevel", "error")
+            .run_async(pipe_stdout=True, pipe_stderr=True)
+        )
+        # drained on the side, so a chatty ffmpeg can't block on a full stderr pipe while we read stdout
+        stderr = []
+        stderr_reader = threading.Thread(target=lambda: stderr.append(process.stderr.read()), daemon=True)
+        stderr_reader.start()
+
+        frame_bytes = self.width * self.height * 3
+        eof = False
+        try:
+            while True:
+                buf = process.stdout.read(frame_bytes)
+                if len(buf) < frame_bytes:
+                    eof = True
+                    break
+                yield np.frombuffer(buf, np.uint8).reshape(self.height, self.width, 3)
+        finally:
+            # the consumer may stop early, don't leave ffmpeg blocked on a full pipe
+            process.stdout.close()
+            if not eof and process.poll() is None:
+                process.kill()
+            process.wait()
+            stderr_reader.join()
+            process.stderr.close()
+
+        if process.returncode != 0:
+            message = b"".join(stderr).decode(errors="replace").strip()
+            raise RuntimeError(f"ffmpeg failed to decode {self.movie_file_path} ({process.returncode}): {message}")
+
+    def chunks(self, chunk_size: int, start: int = 0, count: int | None = None) -> Iterator[np.ndarray]:
+        """Yield the frames stacked into (n h w 3) arrays of up to chunk_size frames."""
+        chunk = []
+        for frame in self.frames(start, count):
+            chunk.append(frame)
+            if len(chunk) == chunk_size:
+                yield np.stack(chunk)
+                chunk = []
+        if chunk:
+            yield np.stack(chunk)
+
+    def __iter__(self) -> Iterator[np.ndarray]:
+        """Decode every frame."""
+        return self.frames()
+
+    def save_pngs(self, out_dir: Path, start_number: int = 0):
+        """Let ffmpeg write every frame to out_dir/%08d.png."""
+        node = self.node().output(str(Path(out_dir).resolve().joinpath("%08d.png")), start_number=start_number)
+        node.run(quiet=True, overwrite_output=True)
@@ -0,0 +1,86 @@
+import hashlib
+import logging
+import os
+import shutil
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+FRAME_STORE_DIR_NAME = ".frame_store"
+
+
+def link_file(src: Path, dst: Path):
+    """Put src at dst as a hardlink, or a copy where links are not supported.
+
+    An existing dst is replaced rather than written to, so other links to its old contents are left untouched.
+    """
+    dst = Path(dst)
+    tmp = dst.with_name(f".{dst.name}.{os.getpid()}.tmp")
+    tmp.unlink(missing_ok=True)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copy2(src, tmp)
+    os.replace(tmp, dst)
+
+
+class FrameStore:
+
+    """Content addressed frame files of a project, exposed to the controlnet and img2img dirs as hardlinks.
+
+    Every distinct frame is written once under store_dir, the input dirs only hold links to it, which the
+    preprocessors read like any other file. Edit a linked frame by replacing the file (as an image editor's
+    "save as" does), writing into it in place changes it in every dir that links it.
+    """
+
+    def __init__(self, store_dir: Path):
+        self.store_dir = Path(store_dir)
+
+    def add(self, path: Path) -> Path:
+        """Store a copy of path unless the same content is already stored, return the stored file."""
+        path = Path(path)
+        h = hashlib.sha1()
+        with open(path, "rb") as f:
+            while chunk := f.read(1024**2):
+                h.update(chunk)
+        digest = h.hexdigest()
+
+        stored = self.store_dir / digest[:2] / f"{digest}{path.suffix}"
+        if not stored.is_file():
+            stored.parent.mkdir(parents=True, exist_ok=True)
+            tmp = stored.with_name(f".{stored.name}.{os.getpid()}.tmp")
+            # a copy, not a link: the source may be overwritten in place later (e.g. by ffmpeg)
+            shutil.copyfile(path, tmp)
+            os.replace(tmp, stored)
+        return stored
+
+    def link_tree(self, src_dir: Path, dst_dir: Path) -> int:
+        """Stand-in for shutil.copytree(src_dir, dst_dir, dirs_exist_ok=True), return the number of files linked."""
+        src_dir = Path(src_dir)
+        dst_dir = Path(dst_dir)
+        n = 0
+        for src in sorted(src_dir.rglob("*")):
+            if not src.is_file():
+                continue
+            dst = dst_dir / src.relative_to(src_dir)
+            dst.parent.mkdir(parents=True, exist_ok=True)
+            link_file(self.add(src), dst)
+            n += 1
+        logger.debug(f"linked {n} frames from {src_dir} to {dst_dir}")
+        return n
+
+    def prune(self) -> int:
+        """Remove stored frames no dir links to anymore, return the number removed."""
+        if not self.store_dir.is_dir():
+            return 0
+        removed = 0
+        for stored in self.store_dir.glob("*/*"):
+            # where links are not supported every dir holds a copy, and nothing in the store is referenced
+            if stored.is_file() and stored.stat().st_nlink == 1:
+                stored.unlink()
+                removed += 1
+        return removed
+
+
+def get_frame_store(project_dir: Path) -> FrameStore:
+    return FrameStore(Path(project_dir) / FRAME_STORE_DIR_NAME)
@@ -19,6 +19,8 @@ from diffusers.utils.torch_utils import randn_tensor
 from packaging import version
 from transformers import CLIPImageProcessor, CLIPTextModel, CLIPTokenizer
 
+from animatediff.utils.embedding_cache import get_text_encoder_key, text_embedding_cache
+
 # ------------------------------------------------------------------------------
 
 logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
@@ -241,6 +243,7 @@ def get_weighted_text_embeddings(
     skip_parsing: Optional[bool] = False,
     skip_weighting: Optional[bool] = False,
     clip_skip: int = 1,
+    min_embeddings_multiples: int = 1,
 ):
     r"""Prompts can be assigned with local weights using brackets. For example,
     prompt 'A (very beautiful) masterpiece' highlights the words 'very beautiful',
@@ -266,6 +269,8 @@ def get_weighted_text_embeddings(
             Skip the parsing of brackets.
         skip_weighting (`bool`, *optional*, defaults to `False`):
             Skip the weighting. When the parsing is skipped, it is forced True.
+        min_embeddings_multiples (`int`, *optional*, defaults to `1`):
+            Pad the prompt embeddings to at least this multiple of the max output length of text encoder.
     """
     max_length = (pipe.tokenizer.model_max_length - 2) * max_embeddings_multiples + 2
     if isinstance(prompt, str):
@@ -299,7 +304,7 @@ def get_weighted_text_embeddings(
         max_embeddings_multiples,
         (max_length - 1) // (pipe.tokenizer.model_max_length - 2) + 1,
     )
-    max_embeddings_multiples = max(1, max_embeddings_multiples)
+    max_embeddings_multiples = max(min_embeddings_multiples, max_embeddings_multiples)
     max_length = (pipe.tokenizer.model_max_length - 2) * max_embeddings_multiples + 2
 
     # pad the length of tokens and weights
@@ -359,6 +364,54 @@ def get_weighted_text_embeddings(
     return text_embeddings, None
 
 
+def get_embeddings_multiples(pipe: DiffusionPipeline, prompt: List[str], max_embeddings_multiples: int = 3) -> int:
+    r"""Return the number of text encoder chunks get_weighted_text_embeddings pads the prompts to."""
+    chunk_length = pipe.tokenizer.model_max_length - 2
+    tokens, _ = get_prompts_with_weights(pipe, prompt, chunk_length * max_embeddings_multiples)
+    max_length = max([len(token) for token in tokens])
+    return max(1, min(max_embeddings_multiples, (max_length - 1) // chunk_length + 1))
+
+
+def get_cached_weighted_text_embeddings(
+    pipe: DiffusionPipeline,
+    prompt: Union[str, List[str]],
+    uncond_prompt: Optional[Union[str, List[str]]] = None,
+    max_embeddings_multiples: Optional[int] = 3,
+    clip_skip: int = 1,
+):
+    r"""get_weighted_text_embeddings through text_embedding_cache, only prompts not seen before are encoded.
+
+    Every prompt is padded to the chunks the whole batch needs, which is part of the cache key, so the result
+    is the same as encoding the batch at once.
+    """
+    if isinstance(prompt, str):
+        prompt = [prompt]
+    if isinstance(uncond_prompt, str):
+        uncond_prompt = [uncond_prompt]
+    texts = prompt + (uncond_prompt or [])
+    multiples = get_embeddings_multiples(pipe, texts, max_embeddings_multiples)
+
+    def encode(texts):
+        text_embeddings, _ = get_weighted_text_embeddings(
+            pipe=pipe,
+            prompt=texts,
+            max_embeddings_multiples=multiples,
+            clip_skip=clip_skip,
+            min_embeddings_multiples=multiples,
+        )
+        return [(e,) for e in text_embeddings]
+
+    values = text_embedding_cache.get_or_encode(
+        get_text_encoder_key(pipe), f"lpw:clip_skip={clip_skip}:chunks={multiples}", texts, encode
+    )
+    # cache hits come back on the cpu, newly encoded prompts on the device
+    text_embeddings = torch.stack([e.to(pipe.device) for e, in values])
+
+    if uncond_prompt is not None:
+        return text_embeddings[: len(prompt)], text_embeddings[len(prompt) :]
+    return text_embeddings, None
+
+
 def lpw_encode_prompt(
     pipe: DiffusionPipeline,
     prompt: str,
@@ -390,7 +443,7 @@ def lpw_encode_prompt(
         if do_classifier_free_guidance:
             negative_prompt = pipe.maybe_convert_prompt(negative_prompt, pipe.tokenizer)
 
-    prompt_embeds1, negative_prompt_embeds1 = get_weighted_text_embeddings(
+    prompt_embeds1, negative_prompt_embeds1 = get_cached_weighted_text_embeddings(
         pipe=pipe,
         prompt=prompt,
         uncond_prompt=negative_prompt if do_classifier_free_guidance else None,
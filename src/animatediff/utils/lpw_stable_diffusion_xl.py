@@ -35,6 +35,8 @@ from diffusers.utils import (
 from diffusers.utils.torch_utils import randn_tensor
 from transformers import CLIPTextModel, CLIPTextModelWithProjection, CLIPTokenizer
 
+from animatediff.utils.embedding_cache import get_text_encoder_key, text_embedding_cache
+
 if is_invisible_watermark_available():
     from diffusers.pipelines.stable_diffusion_xl.watermark import StableDiffusionXLWatermarker
 
@@ -388,6 +390,51 @@ def get_weighted_text_embeddings_sdxl(
     return prompt_embeds, negative_prompt_embeds, pooled_prompt_embeds, negative_pooled_prompt_embeds
 
 
+def get_token_embeddings_sdxl(
+    pipe: StableDiffusionXLPipeline, tokens: list, weights: list, tokens_2: list, weights_2: list
+):
+    """Weighted embeddings and pooled embeddings of one tokenized prompt, 77 tokens per group of 75.
+
+    Returns
+    -------
+        embeds (torch.Tensor) of shape (1, groups * 77, dim)
+        pooled_embeds (torch.Tensor) of shape (1, pooled dim), from the last group
+
+    """
+    embeds = []
+
+    token_groups, weight_groups = group_tokens_and_weights(tokens.copy(), weights.copy(), True)
+    token_groups_2, _ = group_tokens_and_weights(tokens_2.copy(), weights_2.copy(), True)
+
+    # get prompt embeddings one by one is not working.
+    for i in range(len(token_groups)):
+        token_tensor = torch.tensor([token_groups[i]], dtype=torch.long, device=pipe.device)
+        weight_tensor = torch.tensor(weight_groups[i], dtype=torch.float16, device=pipe.device)
+
+        token_tensor_2 = torch.tensor([token_groups_2[i]], dtype=torch.long, device=pipe.device)
+
+        # use first text encoder
+        prompt_embeds_1 = pipe.text_encoder(token_tensor.to(pipe.device), output_hidden_states=True)
+        prompt_embeds_1_hidden_states = prompt_embeds_1.hidden_states[-2]
+
+        # use second text encoder
+        prompt_embeds_2 = pipe.text_encoder_2(token_tensor_2.to(pipe.device), output_hidden_states=True)
+        prompt_embeds_2_hidden_states = prompt_embeds_2.hidden_states[-2]
+        pooled_prompt_embeds = prompt_embeds_2[0]
+
+        prompt_embeds_list = [prompt_embeds_1_hidden_states, prompt_embeds_2_hidden_states]
+        token_embedding = torch.concat(prompt_embeds_list, dim=-1).squeeze(0)
+
+        for j in range(len(weight_tensor)):
+            if weight_tensor[j] != 1.0:
+                token_embedding[j] = token_embedding[-1] + (token_embedding[j] - token_embedding[-1]) * weight_tensor[j]
+
+        token_embedding = token_embedding.unsqueeze(0)
+        embeds.append(token_embedding)
+
+    return torch.cat(embeds, dim=1), pooled_prompt_embeds
+
+
 def get_weighted_text_embeddings_sdxl2(
     pipe: StableDiffusionXLPipeline,
     prompt_list: List[str] = [],
@@ -471,84 +518,13 @@ def get_weighted_text_embeddings_sdxl2(
         neg_prompt_tokens_2,
         neg_prompt_weights_2,
     ):
-        embeds = []
-        neg_embeds = []
-
-        prompt_token_groups, prompt_weight_groups = group_tokens_and_weights(
-            prompt_tokens.copy(), prompt_weights.copy(), True
-        )
-
-        neg_prompt_token_groups, neg_prompt_weight_groups = group_tokens_and_weights(
-            neg_prompt_tokens.copy(), neg_prompt_weights.copy(), True
+        prompt_embeds, pooled_prompt_embeds = get_token_embeddings_sdxl(
+            pipe, prompt_tokens, prompt_weights, prompt_tokens_2, prompt_weights_2
         )
-
-        prompt_token_groups_2, prompt_weight_groups_2 = group_tokens_and_weights(
-            prompt_tokens_2.copy(), prompt_weights_2.copy(), True
-        )
-
-        neg_prompt_token_groups_2, neg_prompt_weight_groups_2 = group_tokens_and_weights(
-            neg_prompt_tokens_2.copy(), neg_prompt_weights_2.copy(), True
+        negative_prompt_embeds, negative_pooled_prompt_embeds = get_token_embeddings_sdxl(
+            pipe, neg_prompt_tokens, neg_prompt_weights, neg_prompt_tokens_2, neg_prompt_weights_2
         )
 
-        # get prompt embeddings one by one is not working.
-        for i in range(len(prompt_token_groups)):
-            # get positive prompt embeddings with weights
-            token_tensor = torch.tensor([prompt_token_groups[i]], dtype=torch.long, device=pipe.device)
-            weight_tensor = torch.tensor(prompt_weight_groups[i], dtype=torch.float16, device=pipe.device)
-
-            token_tensor_2 = torch.tensor([prompt_token_groups_2[i]], dtype=torch.long, device=pipe.device)
-
-            # use first text encoder
-            prompt_embeds_1 = pipe.text_encoder(token_tensor.to(pipe.device), output_hidden_states=True)
-            prompt_embeds_1_hidden_states = prompt_embeds_1.hidden_states[-2]
-
-            # use second text encoder
-            prompt_embeds_2 = pipe.text_encoder_2(token_tensor_2.to(pipe.device), output_hidden_states=True)
-            prompt_embeds_2_hidden_states = prompt_embeds_2.hidden_states[-2]
-            pooled_prompt_embeds = prompt_embeds_2[0]
-
-            prompt_embeds_list = [prompt_embeds_1_hidden_states, prompt_embeds_2_hidden_states]
-            token_embedding = torch.concat(prompt_embeds_list, dim=-1).squeeze(0)
-
-            for j in range(len(weight_tensor)):
-                if weight_tensor[j] != 1.0:
-                    token_embedding[j] = (
-                        token_embedding[-1] + (token_embedding[j] - token_embedding[-1]) * weight_tensor[j]
-                    )
-
-            token_embedding = token_embedding.unsqueeze(0)
-            embeds.append(token_embedding)
-
-            # get negative prompt embeddings with weights
-            neg_token_tensor = torch.tensor([neg_prompt_token_groups[i]], dtype=torch.long, device=pipe.device)
-            neg_token_tensor_2 = torch.tensor([neg_prompt_token_groups_2[i]], dtype=torch.long, device=pipe.device)
-            neg_weight_tensor = torch.tensor(neg_prompt_weight_groups[i], dtype=torch.float16, device=pipe.device)
-
-            # use first text encoder
-            neg_prompt_embeds_1 = pipe.text_encoder(neg_token_tensor.to(pipe.device), output_hidden_states=True)
-            neg_prompt_embeds_1_hidden_states = neg_prompt_embeds_1.hidden_states[-2]
-
-            # use second text encoder
-            neg_prompt_embeds_2 = pipe.text_encoder_2(neg_token_tensor_2.to(pipe.device), output_hidden_states=True)
-            neg_prompt_embeds_2_hidden_states = neg_prompt_embeds_2.hidden_states[-2]
-            negative_pooled_prompt_embeds = neg_prompt_embeds_2[0]
-
-            neg_prompt_embeds_list = [neg_prompt_embeds_1_hidden_states, neg_prompt_embeds_2_hidden_states]
-            neg_token_embedding = torch.concat(neg_prompt_embeds_list, dim=-1).squeeze(0)
-
-            for z in range(len(neg_weight_tensor)):
-                if neg_weight_tensor[z] != 1.0:
-                    neg_token_embedding[z] = (
-                        neg_token_embedding[-1]
-                        + (neg_token_embedding[z] - neg_token_embedding[-1]) * neg_weight_tensor[z]
-                    )
-
-            neg_token_embedding = neg_token_embedding.unsqueeze(0)
-            neg_embeds.append(neg_token_embedding)
-
-        prompt_embeds = torch.cat(embeds, dim=1)
-        negative_prompt_embeds = torch.cat(neg_embeds, dim=1)
-
         return (
             prompt_embeds.to(device),
             negative_prompt_embeds.to(device),
@@ -577,6 +553,53 @@ def get_weighted_text_embeddings_sdxl2(
     return p_list, n_list, pp_list, np_list
 
 
+def get_cached_text_embeddings_sdxl2(
+    pipe: StableDiffusionXLPipeline,
+    prompt_list: List[str] = [],
+    neg_prompt_list: List[str] = [],
+    device: str = "",
+):
+    """get_weighted_text_embeddings_sdxl2 through text_embedding_cache, only prompts not seen before are encoded.
+
+    get_weighted_text_embeddings_sdxl2 pads every prompt to the longest one, which only decides the number of
+    77 token groups. That number is part of the cache key, so the result is the same as encoding them at once.
+    """
+    if len(neg_prompt_list) == 1:
+        neg_prompt_list = neg_prompt_list * len(prompt_list)
+
+    eos = pipe.tokenizer.eos_token_id
+    texts = prompt_list + neg_prompt_list
+    tokens = {text: get_prompts_tokens_with_weights(pipe.tokenizer, text) for text in dict.fromkeys(texts)}
+    tokens_2 = {text: get_prompts_tokens_with_weights(pipe.tokenizer_2, text) for text in dict.fromkeys(texts)}
+
+    max_length = max(len(t) for t, _ in list(tokens.values()) + list(tokens_2.values()))
+    groups = (max_length + 74) // 75
+    length = groups * 75
+
+    def encode(texts):
+        values = []
+        for text in texts:
+            prompt_tokens, prompt_weights = tokens[text]
+            prompt_tokens_2, prompt_weights_2 = tokens_2[text]
+            values.append(
+                get_token_embeddings_sdxl(
+                    pipe,
+                    prompt_tokens + [eos] * (length - len(prompt_tokens)),
+                    prompt_weights + [1.0] * (length - len(prompt_weights)),
+                    prompt_tokens_2 + [eos] * (length - len(prompt_tokens_2)),
+                    prompt_weights_2 + [1.0] * (length - len(prompt_weights_2)),
+                )
+            )
+        return values
+
+    values = text_embedding_cache.get_or_encode(get_text_encoder_key(pipe), f"sdxl:groups={groups}", texts, encode)
+    embeds = [e.to(device) for e, _ in values]
+    pooled = [p.to(device) for _, p in values]
+
+    n = len(prompt_list)
+    return embeds[:n], embeds[n:], pooled[:n], pooled[n:]
+
+
 # -------------------------------------------------------------------------------------------------------------------------------
 # reuse the backbone code from StableDiffusionXLPipeline
 # -------------------------------------------------------------------------------------------------------------------------------
@@ -1,7 +1,9 @@
 import glob
 import logging
 import os
+from itertools import islice
 from pathlib import Path
+from typing import Iterable, Iterator
 
 import cv2
 import numpy as np
@@ -110,7 +112,8 @@ class MaskPredictor:
 
         return boxes_filt, pred_phrases
 
-    def __call__(self, image_pil: Image, text_prompt):
+    def detect_boxes(self, image_pil: Image, text_prompt) -> torch.Tensor:
+        """Boxes of text_prompt in the image, (n, 4) xyxy in pixels."""
         if self.groundingdino_model is None:
             self.load_groundingdino_model()
             self.load_sam_predictor()
@@ -120,43 +123,172 @@ class MaskPredictor:
         # run grounding dino model
         boxes_filt, pred_phrases = self.get_grounding_output(transformed_img, text_prompt)
 
-        if boxes_filt.shape[0] == 0:
-            logger.info("object not found")
-            w, h = image_pil.size
-            return np.zeros(shape=(1, h, w), dtype=bool)
-
-        img_array = np.array(image_pil)
-        self.sam_predictor.set_image(img_array)
-
-        size = image_pil.size
-        H, W = size[1], size[0]
-        for i in range(boxes_filt.size(0)):
-            boxes_filt[i] = boxes_filt[i] * torch.Tensor([W, H, W, H])
-            boxes_filt[i][:2] -= boxes_filt[i][2:] / 2
-            boxes_filt[i][2:] += boxes_filt[i][:2]
-
-        boxes_filt = boxes_filt.cpu()
-        transformed_boxes = self.sam_predictor.transform.apply_boxes_torch(boxes_filt, img_array.shape[:2]).to(
+        W, H = image_pil.size
+        boxes_filt = boxes_filt * torch.Tensor([W, H, W, H])
+        boxes_filt[:, :2] -= boxes_filt[:, 2:] / 2
+        boxes_filt[:, 2:] += boxes_filt[:, :2]
+        return boxes_filt
+
+    def encode_images(self, img_arrays: list[np.ndarray]) -> list[tuple]:
+        """Sam image embeddings of same sized images, computed in one batch."""
+        model = self.sam_predictor.model
+        inputs = []
+        for img_array in img_arrays:
+            if model.image_format != "RGB":
+                img_array = img_array[..., ::-1]
+            input_image = self.sam_predictor.transform.apply_image(img_array)
+            inputs.append(torch.as_tensor(input_image, device=self.device).permute(2, 0, 1).contiguous())
+        input_size = tuple(inputs[0].shape[-2:])
+
+        features = model.image_encoder(model.preprocess(torch.stack(inputs)))
+        interm_features = None
+        if isinstance(features, tuple):
+            # sam-hq also returns the intermediate vit embeddings
+            features, interm_features = features
+
+        return [
+            (
+                img_array.shape[:2],
+                input_size,
+                features[i : i + 1],
+                None if interm_features is None else [f[i : i + 1] for f in interm_features],
+            )
+            for i, img_array in enumerate(img_arrays)
+        ]
+
+    def set_image_features(self, image_features: tuple):
+        """Set the sam predictor's image from encode_images output, like sam_predictor.set_image."""
+        original_size, input_size, features, interm_features = image_features
+        self.sam_predictor.reset_image()
+        self.sam_predictor.original_size = original_size
+        self.sam_predictor.input_size = input_size
+        self.sam_predictor.features = features
+        if interm_features is not None:
+            self.sam_predictor.interm_features = interm_features
+        self.sam_predictor.is_image_set = True
+
+    def predict_masks(self, boxes_filt: torch.Tensor, image_size) -> torch.Tensor:
+        """One (1, h, w) mask per box, for the image currently set on the sam predictor."""
+        transformed_boxes = self.sam_predictor.transform.apply_boxes_torch(boxes_filt.cpu(), image_size).to(
             self.device
         )
 
         masks, _, _ = self.sam_predictor.predict_torch(
             point_coords=None,
             point_labels=None,
-            boxes=transformed_boxes.to(self.device),
+            boxes=transformed_boxes,
             multimask_output=False,
         )
+        return masks
 
-        result = None
-        for m in masks:
-            if result is None:
-                result = m
-            else:
-                result |= m
+    def __call__(self, image_pil: Image, text_prompt):
+        boxes_filt = self.detect_boxes(image_pil, text_prompt)
 
-        result = result.cpu().detach().numpy().copy()
+        if boxes_filt.shape[0] == 0:
+            logger.info("object not found")
+            w, h = image_pil.size
+            return np.zeros(shape=(1, h, w), dtype=bool)
 
-        return result
+        img_array = np.array(image_pil)
+        self.sam_predictor.set_image(img_array)
+
+        masks = self.predict_masks(boxes_filt, img_array.shape[:2])
+
+        return masks.any(dim=0).cpu().numpy()
+
+    def track(
+        self,
+        images: Iterable[Image.Image],
+        text_prompt,
+        keyframe_interval: int = 8,
+        change_threshold: float = 0.1,
+        batch_size: int = 4,
+        box_margin: float = 0.1,
+    ) -> Iterator[np.ndarray]:
+        """Yield a (1, h, w) mask per image, running grounding dino on keyframes only.
+
+        Between keyframes every object is prompted to sam with the bounding box of its mask in the previous frame,
+        grown by box_margin. A frame becomes a keyframe every keyframe_interval frames, when its mean difference
+        from the last keyframe exceeds change_threshold, or when a tracked object is lost.
+        Sam image embeddings are computed batch_size frames at a time.
+        """
+        if self.groundingdino_model is None:
+            self.load_groundingdino_model()
+            self.load_sam_predictor()
+
+        images = iter(images)
+        boxes = None
+        key_thumb = None
+        since_key = 0
+
+        def detect(image_pil, thumb):
+            nonlocal key_thumb, since_key
+            key_thumb = thumb
+            since_key = 0
+            found = self.detect_boxes(image_pil, text_prompt)
+            if found.shape[0] == 0:
+                logger.info("object not found")
+            return found
+
+        while batch := list(islice(images, batch_size)):
+            img_arrays = [np.array(image_pil) for image_pil in batch]
+            image_features = self.encode_images(img_arrays)
+
+            for image_pil, img_array, features in zip(batch, img_arrays, image_features):
+                thumb = np.asarray(image_pil.convert("L").resize((64, 64)), dtype=np.float32) / 255
+                is_keyframe = (
+                    boxes is None
+                    or since_key >= keyframe_interval
+                    or np.abs(thumb - key_thumb).mean() > change_threshold
+                )
+                if is_keyframe:
+                    boxes = detect(image_pil, thumb)
+                since_key += 1
+
+                if boxes.shape[0] == 0:
+                    yield np.zeros(shape=(1, *img_array.shape[:2]), dtype=bool)
+                    continue
+
+                self.set_image_features(features)
+                masks = self.predict_masks(boxes, img_array.shape[:2])
+
+                if not is_keyframe and not masks.flatten(1).any(dim=1).all():
+                    boxes = detect(image_pil, thumb)
+                    since_key += 1
+                    if boxes.shape[0] == 0:
+                        yield np.zeros(shape=(1, *img_array.shape[:2]), dtype=bool)
+                        continue
+                    masks = self.predict_masks(boxes, img_array.shape[:2])
+
+                yield masks.any(dim=0).cpu().numpy()
+                boxes = get_mask_boxes(masks, boxes, box_margin)
+
+
+def get_mask_boxes(masks: torch.Tensor, boxes: torch.Tensor, margin: float = 0.1) -> torch.Tensor:
+    """Bounding boxes (xyxy) of (n, 1, h, w) masks grown by margin, empty masks keep their box."""
+    masks = masks[:, 0]
+    H, W = masks.shape[-2:]
+    rows, cols = masks.any(dim=2), masks.any(dim=1)
+    ys = torch.arange(H, device=masks.device)
+    xs = torch.arange(W, device=masks.device)
+
+    new_boxes = torch.stack(
+        [
+            torch.where(cols, xs, W).min(dim=1).values,
+            torch.where(rows, ys, H).min(dim=1).values,
+            torch.where(cols, xs, -1).max(dim=1).values + 1,
+            torch.where(rows, ys, -1).max(dim=1).values + 1,
+        ],
+        dim=1,
+    ).float().cpu()
+
+    size = new_boxes[:, 2:] - new_boxes[:, :2]
+    new_boxes[:, :2] -= size * margin
+    new_boxes[:, 2:] += size * margin
+    new_boxes[:, 0::2] = new_boxes[:, 0::2].clamp(0, W)
+    new_boxes[:, 1::2] = new_boxes[:, 1::2].clamp(0, H)
+
+    return torch.where(rows.any(dim=1).cpu()[:, None], new_boxes, boxes.cpu())
 
 
 def load_mask_list(mask_dir, masked_area_list, mask_padding):
@@ -361,7 +493,11 @@ def create_fg(
     groundingdino_checkpoint=path_mgr.grounding_dino / "groundingdino_swinb_cogcoor.pth",
     sam_checkpoint=path_mgr.grounding_dino / "sam_hq_vit_l.pth",
     device="cuda",
+    keyframe_interval=1,
+    keyframe_change_threshold=0.1,
+    sam_batch_size=4,
 ):
+    """keyframe_interval > 1 runs grounding dino on keyframes only and tracks the boxes in between."""
     frame_list = sorted(glob.glob(os.path.join(frame_dir, "[0-9]*.png"), recursive=False))
     device = get_torch_device()
 
@@ -379,15 +515,24 @@ def create_fg(
             kernel = np.ones((abs(mask_padding), abs(mask_padding)), np.uint8)
         kernel2 = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3))
 
-        for i, frame in tqdm(enumerate(frame_list), total=len(frame_list), desc=f"creating mask from {mask_token=}"):
-            frame = Path(frame)
+        frame_list = [Path(frame) for frame in frame_list]
+        mask_iter = predictor.track(
+            (Image.open(frame) for frame in frame_list),
+            mask_token,
+            keyframe_interval=keyframe_interval,
+            change_threshold=keyframe_change_threshold,
+            batch_size=sam_batch_size,
+        )
+
+        for frame, mask_array in tqdm(
+            zip(frame_list, mask_iter), total=len(frame_list), desc=f"creating mask from {mask_token=}"
+        ):
             file_name = frame.name
 
             cur_frame_no = int(frame.stem)
 
             img = Image.open(frame)
 
-            mask_array = predictor(img, mask_token)
             mask_array = mask_array[0].astype(np.uint8) * 255
 
             if mask_padding < 0:
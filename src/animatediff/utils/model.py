@@ -162,22 +162,37 @@ def checkpoint_to_pipeline_sdxl(
 
 
 def get_checkpoint_weights(checkpoint: Path):
-    temp_pipeline: StableDiffusionPipeline
-    temp_pipeline, _ = checkpoint_to_pipeline(checkpoint, save=False)
-    unet_state_dict = temp_pipeline.unet.state_dict()
-    tenc_state_dict = temp_pipeline.text_encoder.state_dict()
-    vae_state_dict = temp_pipeline.vae.state_dict()
-    return unet_state_dict, tenc_state_dict, vae_state_dict
+    from animatediff.utils.conversion_cache import conversion_cache
+
+    def convert():
+        temp_pipeline: StableDiffusionPipeline
+        temp_pipeline, _ = checkpoint_to_pipeline(checkpoint, save=False)
+        return {
+            "unet": temp_pipeline.unet.state_dict(),
+            "text_encoder": temp_pipeline.text_encoder.state_dict(),
+            "vae": temp_pipeline.vae.state_dict(),
+        }
+
+    state_dicts = conversion_cache.get_state_dicts(checkpoint, ["unet", "text_encoder", "vae"], convert)
+    return state_dicts["unet"], state_dicts["text_encoder"], state_dicts["vae"]
 
 
 def get_checkpoint_weights_sdxl(checkpoint: Path):
-    temp_pipeline: StableDiffusionXLPipeline
-    temp_pipeline, _ = checkpoint_to_pipeline_sdxl(checkpoint, save=False)
-    unet_state_dict = temp_pipeline.unet.state_dict()
-    tenc_state_dict = temp_pipeline.text_encoder.state_dict()
-    tenc2_state_dict = temp_pipeline.text_encoder_2.state_dict()
-    vae_state_dict = temp_pipeline.vae.state_dict()
-    return unet_state_dict, tenc_state_dict, tenc2_state_dict, vae_state_dict
+    from animatediff.utils.conversion_cache import conversion_cache
+
+    def convert():
+        temp_pipeline: StableDiffusionXLPipeline
+        temp_pipeline, _ = checkpoint_to_pipeline_sdxl(checkpoint, save=False)
+        return {
+            "unet": temp_pipeline.unet.state_dict(),
+            "text_encoder": temp_pipeline.text_encoder.state_dict(),
+            "text_encoder_2": temp_pipeline.text_encoder_2.state_dict(),
+            "vae": temp_pipeline.vae.state_dict(),
+        }
+
+    components = ["unet", "text_encoder", "text_encoder_2", "vae"]
+    state_dicts = conversion_cache.get_state_dicts(checkpoint, components, convert)
+    return tuple(state_dicts[c] for c in components)
 
 
 def ensure_motion_modules(
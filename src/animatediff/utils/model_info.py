@@ -0,0 +1,247 @@
+import collections
+import hashlib
+import json
+import logging
+import os
+import pickle
+import struct
+import zipfile
+from pathlib import Path
+
+from pydantic import BaseModel
+
+from animatediff.consts import path_mgr
+
+logger = logging.getLogger(__name__)
+
+SDXL_KEYS = ("conditioner.embedders.0.model.ln_final.weight", "conditioner.embedders.1.model.ln_final.weight")
+SD2_KEYS = ("cond_stage_model.model.ln_final.weight",)
+MOTION_V2_KEYS = ("mid_block.motion_modules.0.temporal_transformer.norm.bias",)
+
+# bump when the fields or the detection rules change, older entries are re-read
+INDEX_VERSION = 1
+
+# torch storage / dtype names -> safetensors dtype names
+DTYPE_NAMES = {
+    "Half": "F16",
+    "float16": "F16",
+    "Float": "F32",
+    "float32": "F32",
+    "BFloat16": "BF16",
+    "bfloat16": "BF16",
+    "Double": "F64",
+    "float64": "F64",
+    "Long": "I64",
+    "int64": "I64",
+    "Int": "I32",
+    "int32": "I32",
+    "Byte": "U8",
+    "uint8": "U8",
+    "Bool": "BOOL",
+    "bool": "BOOL",
+}
+
+
+class ModelInfo(BaseModel):
+    path: str
+    size: int
+    mtime: float
+    format: str
+    architecture: str
+    dtype: str
+    parameter_count: int
+    # same as the legacy a1111 model hash: sha256 of 64KiB at offset 1MiB
+    hash: str
+    # full file sha256, only computed on request
+    sha256: str | None = None
+
+
+def get_architecture(keys: set[str]) -> str:
+    if any(k in keys for k in SDXL_KEYS):
+        return "sdxl"
+    if any(k in keys for k in SD2_KEYS):
+        return "sd2"
+    if any(k in keys for k in MOTION_V2_KEYS):
+        return "motion_v2"
+    if any("motion_modules." in k for k in keys):
+        return "motion_v1"
+    if any(k.startswith("model.diffusion_model.") for k in keys):
+        return "sd15"
+    return "unknown"
+
+
+def get_short_hash(path: Path) -> str:
+    with open(path, "rb") as f:
+        f.seek(0x100000)
+        return hashlib.sha256(f.read(0x10000)).hexdigest()[:8]
+
+
+def read_safetensors_header(path: Path) -> dict[str, tuple[str, list[int]]]:
+    """{name: (dtype, shape)} from the json header, without touching the tensor data."""
+    with open(path, "rb") as f:
+        (header_len,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_len))
+    header.pop("__metadata__", None)
+    return {k: (v["dtype"], v["shape"]) for k, v in header.items()}
+
+
+class _TensorStub:
+    def __init__(self, dtype: str, shape: tuple):
+        self.dtype = dtype
+        self.shape = shape
+
+
+class _Dummy:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __setstate__(self, state):
+        pass
+
+
+def _rebuild_tensor(storage, storage_offset, size, stride, *args, **kwargs):
+    return _TensorStub(storage, tuple(size))
+
+
+def _rebuild_parameter(data, *args, **kwargs):
+    return data
+
+
+class _HeaderUnpickler(pickle.Unpickler):
+
+    """Unpickle a torch zip checkpoint's data.pkl into tensor stubs, storages are never loaded."""
+
+    def find_class(self, module, name):
+        if name == "_rebuild_tensor_v2":
+            return _rebuild_tensor
+        if name == "_rebuild_parameter":
+            return _rebuild_parameter
+        if module == "collections" and name == "OrderedDict":
+            return collections.OrderedDict
+        if module == "torch" and name.endswith("Storage"):
+            return DTYPE_NAMES.get(name[: -len("Storage")], name)
+        return _Dummy
+
+    def persistent_load(self, pid):
+        # ("storage", storage type, key, location, numel)
+        return pid[1]
+
+
+def read_ckpt_header(path: Path) -> dict[str, tuple[str, list[int]]]:
+    with zipfile.ZipFile(path) as zf:
+        pkl = next(n for n in zf.namelist() if n.endswith("data.pkl"))
+        with zf.open(pkl) as f:
+            state_dict = _HeaderUnpickler(f).load()
+    if isinstance(state_dict, dict) and isinstance(state_dict.get("state_dict"), dict):
+        state_dict = state_dict["state_dict"]
+    return {k: (v.dtype, list(v.shape)) for k, v in state_dict.items() if isinstance(v, _TensorStub)}
+
+
+def read_tensor_header(path: Path) -> tuple[str, dict[str, tuple[str, list[int]]]]:
+    if path.suffix == ".safetensors":
+        return "safetensors", read_safetensors_header(path)
+    if zipfile.is_zipfile(path):
+        try:
+            return "ckpt", read_ckpt_header(path)
+        except Exception as e:
+            logger.warning(f"could not read the header of {path.name}, loading it instead: {e}")
+
+    # legacy (non zip) torch serialization has no directory to read, load it once
+    import torch
+
+    loaded = torch.load(path, "cpu")
+    if isinstance(loaded.get("state_dict"), dict):
+        loaded = loaded["state_dict"]
+    return "ckpt", {
+        k: (DTYPE_NAMES.get(str(v.dtype).replace("torch.", ""), str(v.dtype)), list(v.shape))
+        for k, v in loaded.items()
+        if isinstance(v, torch.Tensor)
+    }
+
+
+def _parameter_count(shape: list[int]) -> int:
+    n = 1
+    for s in shape:
+        n *= s
+    return n
+
+
+class ModelIndex:
+
+    """Small on-disk index of model file metadata, keyed by path, size and mtime."""
+
+    def __init__(self, index_path: Path = path_mgr.model_index):
+        self.index_path = Path(index_path)
+        self.entries: dict[str, dict] | None = None
+
+    def load(self) -> dict[str, dict]:
+        if self.entries is None:
+            self.entries = {}
+            if self.index_path.is_file():
+                try:
+                    index = json.loads(self.index_path.read_text(encoding="utf-8"))
+                    if index.get("version") == INDEX_VERSION:
+                        self.entries = index["models"]
+                except (OSError, ValueError, KeyError) as e:
+                    logger.warning(f"ignoring broken model index {self.index_path}: {e}")
+        return self.entries
+
+    def save(self):
+        self.index_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.index_path.with_suffix(f".{os.getpid()}.tmp")
+        tmp.write_text(json.dumps({"version": INDEX_VERSION, "models": self.entries}, indent=1), encoding="utf-8")
+        os.replace(tmp, self.index_path)
+
+    def get(self, path: Path) -> ModelInfo:
+        path = Path(path).absolute()
+        stat = path.stat()
+        entries = self.load()
+
+        entry = entries.get(str(path))
+        if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+            return ModelInfo(**entry)
+
+        fmt, tensors = read_tensor_header(path)
+        dtypes = collections.Counter()
+        for dtype, shape in tensors.values():
+            dtypes[dtype] += _parameter_count(shape)
+
+        info = ModelInfo(
+            path=str(path),
+            size=stat.st_size,
+            mtime=stat.st_mtime,
+            format=fmt,
+            architecture=get_architecture(set(tensors)),
+            dtype=dtypes.most_common(1)[0][0] if dtypes else "unknown",
+            parameter_count=sum(dtypes.values()),
+            hash=get_short_hash(path),
+        )
+        logger.info(f"indexed {path.name}: {info.architecture} {info.dtype} {info.parameter_count / 1e6:.0f}M params")
+
+        self.put(info)
+        return info
+
+    def put(self, info: ModelInfo):
+        # another worker may have indexed other models in the meantime
+        self.entries = None
+        self.load()[info.path] = info.model_dump()
+        self.save()
+
+    def get_sha256(self, path: Path) -> str:
+        info = self.get(path)
+        if info.sha256 is None:
+            logger.info(f"hashing {Path(path).name}")
+            h = hashlib.sha256()
+            with open(info.path, "rb") as f:
+                while chunk := f.read(16 * 1024**2):
+                    h.update(chunk)
+            info.sha256 = h.hexdigest()
+            self.put(info)
+        return info.sha256
+
+
+model_index = ModelIndex()
+
+
+def get_model_info(path: Path) -> ModelInfo:
+    return model_index.get(path)
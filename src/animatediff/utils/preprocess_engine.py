@@ -0,0 +1,171 @@
+import hashlib
+import json
+import logging
+import math
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Callable
+
+from PIL import Image
+
+from animatediff.settings import PreprocessCacheConfig
+from animatediff.utils.cpu_preprocessor import run_in_worker
+from animatediff.utils.util import get_resized_image2
+
+logger = logging.getLogger(__name__)
+
+# detectors that run on the cpu without a model worth sharing, these are fanned out over a process pool
+CPU_PREPROCESSORS = {"canny", "shuffle", "blur", "tile_resample", "mediapipe_face"}
+
+# shared by every engine for the lifetime of the process, workers cost seconds to start
+_process_pool: ProcessPoolExecutor | None = None
+_process_pool_size = 0
+
+
+def get_preprocess_cache_key(img_path: str | Path, pre_type: str, params: dict[str, Any], size: int) -> str:
+    """Hash of the source image bytes and everything that changes the detector output."""
+    h = hashlib.sha1(Path(img_path).read_bytes())
+    h.update(json.dumps([pre_type, params, size], sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+def get_process_pool(num_workers: int) -> ProcessPoolExecutor:
+    global _process_pool, _process_pool_size
+    if _process_pool is None or _process_pool_size != num_workers:
+        if _process_pool is not None:
+            _process_pool.shutdown(wait=False, cancel_futures=True)
+        # spawned, forking would copy the cuda context and the threads of the calling process
+        _process_pool = ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context("spawn"))
+        _process_pool_size = num_workers
+    return _process_pool
+
+
+class PreprocessEngine:
+
+    """Run a controlnet detector over many frames, with a content addressed cache in front of it.
+
+    Detectors with a process_batch(images, **params) method get frames in batches of batch_size, cpu bound
+    detectors are spread over num_workers processes once there are parallel_min_frames frames to process,
+    everything else runs one frame at a time. Cached frames are evicted least recently used first once
+    cache_dir grows past max_gb.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Path,
+        num_workers: int = 4,
+        batch_size: int = 8,
+        parallel_min_frames: int = 64,
+        config: PreprocessCacheConfig | None = None,
+    ):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.num_workers = num_workers
+        self.batch_size = max(batch_size, 1)
+        self.parallel_min_frames = parallel_min_frames
+        self.config = config or PreprocessCacheConfig()
+        # counted on the first write
+        self.nbytes: int | None = None
+
+    def cache_path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.png"
+
+    def _save(self, key: str, img: Image.Image):
+        path = self.cache_path(key)
+        img.save(path)
+        if self.nbytes is None:
+            self.nbytes = sum(f.stat().st_size for f in self.cache_dir.glob("*.png"))
+        else:
+            self.nbytes += path.stat().st_size
+
+    def evict(self):
+        files = sorted(self.cache_dir.glob("*.png"), key=lambda f: f.stat().st_mtime)
+        total = sum(f.stat().st_size for f in files)
+        # leave some room, so the next runs don't rescan the dir right away
+        max_bytes = self.config.max_gb * 1024**3 * 0.9
+        for f in files:
+            if total <= max_bytes:
+                break
+            total -= f.stat().st_size
+            f.unlink(missing_ok=True)
+        logger.debug(f"Preprocess cache: {total / 1024**2:.1f}MB left in {self.cache_dir}")
+        self.nbytes = total
+
+    def _detect(
+        self,
+        pre_type: str,
+        create_preprocessor: Callable[[], Any],
+        images: list[Image.Image],
+        params: dict[str, Any],
+    ) -> list[Image.Image]:
+        if pre_type == "none":
+            return images
+
+        if pre_type in CPU_PREPROCESSORS and self.num_workers > 1 and len(images) >= self.parallel_min_frames:
+            logger.info(f"preprocessing {len(images)} frames with {pre_type} on {self.num_workers} processes")
+            # a few chunks per worker, each frame crosses the process boundary once in each direction
+            chunk = math.ceil(len(images) / (self.num_workers * 2))
+            executor = get_process_pool(self.num_workers)
+            futures = [
+                executor.submit(run_in_worker, pre_type, images[i : i + chunk], params)
+                for i in range(0, len(images), chunk)
+            ]
+            return [img for future in futures for img in future.result()]
+
+        preprocessor = create_preprocessor()
+        if hasattr(preprocessor, "process_batch"):
+            results = []
+            for i in range(0, len(images), self.batch_size):
+                results += preprocessor.process_batch(images[i : i + self.batch_size], **params)
+            return results
+        return [preprocessor(img, **params) for img in images]
+
+    def run(
+        self,
+        pre_type: str,
+        create_preprocessor: Callable[[], Any],
+        frames: dict[int, str],
+        params: dict[str, Any],
+        size: int = 512,
+    ) -> tuple[dict[int, Image.Image], bool]:
+        """Return ({frame_no: detected image}, whether any frame had to be processed)."""
+        results = {}
+        keys = {}
+        for frame_no, img_path in frames.items():
+            key = get_preprocess_cache_key(img_path, pre_type, params, size)
+            cache_path = self.cache_path(key)
+            if cache_path.exists():
+                now = time.time()
+                os.utime(cache_path, (now, now))
+                results[frame_no] = Image.open(cache_path)
+            else:
+                keys[frame_no] = key
+
+        if not keys:
+            return results, False
+
+        logger.info(f"{pre_type}: {len(results)} cached, {len(keys)} to process")
+        frame_nos = sorted(keys)
+        images = [get_resized_image2(frames[frame_no], size) for frame_no in frame_nos]
+        for frame_no, img in zip(frame_nos, self._detect(pre_type, create_preprocessor, images, params)):
+            self._save(keys[frame_no], img)
+            results[frame_no] = img
+        if self.nbytes > self.config.max_gb * 1024**3:
+            self.evict()
+        return results, True
+
+    def run_images(
+        self,
+        pre_type: str,
+        create_preprocessor: Callable[[], Any],
+        images: dict[int, Image.Image],
+        params: dict[str, Any],
+        size: int = 512,
+    ) -> dict[int, Image.Image]:
+        """run() for frames already in memory, which are not cached."""
+        frame_nos = sorted(images)
+        resized = [get_resized_image2(images[frame_no], size) for frame_no in frame_nos]
+        return dict(zip(frame_nos, self._detect(pre_type, create_preprocessor, resized, params)))
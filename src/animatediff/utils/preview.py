@@ -0,0 +1,55 @@
+import io
+from typing import List
+
+import numpy as np
+import torch
+from PIL import Image
+
+# linear approximations of the vae decoder, latent channel -> rgb in [-1, 1]
+SD15_LATENT_RGB_FACTORS = [
+    [0.3512, 0.2297, 0.3227],
+    [0.3250, 0.4974, 0.2350],
+    [-0.2829, 0.1762, 0.2721],
+    [-0.2120, -0.2616, -0.7177],
+]
+SD15_LATENT_RGB_BIAS = [0.0, 0.0, 0.0]
+
+SDXL_LATENT_RGB_FACTORS = [
+    [0.3920, 0.4054, 0.4549],
+    [-0.2634, -0.0196, 0.0653],
+    [0.0568, 0.1687, -0.0755],
+    [-0.3112, -0.2359, -0.2076],
+]
+SDXL_LATENT_RGB_BIAS = [0.1084, -0.0175, -0.0011]
+
+
+@torch.no_grad()
+def latents_to_rgb(latents: torch.Tensor, is_sdxl: bool = False, scale: int = 2) -> np.ndarray:
+    """Approximate the frames of the first video in (b c f h w) latents as (f h w 3) uint8, without the vae."""
+    factors = SDXL_LATENT_RGB_FACTORS if is_sdxl else SD15_LATENT_RGB_FACTORS
+    bias = SDXL_LATENT_RGB_BIAS if is_sdxl else SD15_LATENT_RGB_BIAS
+    factors = torch.tensor(factors, device=latents.device, dtype=torch.float32)
+    bias = torch.tensor(bias, device=latents.device, dtype=torch.float32)
+
+    rgb = torch.einsum("cfhw,cr->frhw", latents[0].float(), factors) + bias[None, :, None, None]
+    if scale > 1:
+        rgb = torch.nn.functional.interpolate(rgb, scale_factor=scale, mode="nearest")
+    rgb = ((rgb + 1) / 2).clamp(0, 1).mul(255).to(torch.uint8)
+    return rgb.permute(0, 2, 3, 1).cpu().numpy()
+
+
+def encode_webp(frames: np.ndarray | List[Image.Image], fps: int, quality: int = 60) -> bytes:
+    """Encode frames into an animated webp in memory."""
+    imgs = [Image.fromarray(f) if isinstance(f, np.ndarray) else f for f in frames]
+    buf = io.BytesIO()
+    imgs[0].save(
+        buf,
+        format="WEBP",
+        save_all=True,
+        append_images=imgs[1:],
+        duration=int(1000 / max(fps, 1)),
+        loop=0,
+        quality=quality,
+        method=0,
+    )
+    return buf.getvalue()
@@ -0,0 +1,76 @@
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Iterator
+
+from PIL import Image
+from torch import Tensor
+
+from animatediff.utils.util import iter_rgb_frames
+
+logger = logging.getLogger(__name__)
+
+
+class StageHandoff:
+
+    """Frames of one in-process generate() pass, kept in memory for the pass after it.
+
+    Writing a pass's pngs and video is queued on a background thread (run in submission order), so the next pass
+    starts as soon as the frames are decoded. Frames are only kept while keep_frames is set, for a pass whose output
+    another pass reads. inputs names the controlnet dirs (and "img2img") that the next pass takes from these frames
+    instead of reading them back from disk, release() drops them once its preprocessing has them.
+    """
+
+    def __init__(self):
+        self.frames: dict[int, Image.Image] | None = None
+        self.inputs: set[str] = set()
+        self.keep_frames = False
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending: list[Future] = []
+
+    def put(self, video: Tensor):
+        if not self.keep_frames:
+            return
+        # same rounding as the saved pngs, so the next pass sees exactly what it would have read
+        self.frames = {i: Image.fromarray(frame) for i, frame in enumerate(iter_rgb_frames(video))}
+
+    def release(self):
+        self.frames = None
+        self.inputs = set()
+
+    def get(self, name: str) -> dict[int, Image.Image] | None:
+        if self.frames is None or name not in self.inputs:
+            return None
+        return self.frames
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        future = self.executor.submit(fn, *args, **kwargs)
+        self.pending.append(future)
+        return future
+
+    def wait(self):
+        """Block until every queued write is done, re-raising the first error."""
+        pending, self.pending = self.pending, []
+        for future in pending:
+            future.result()
+
+
+_active_handoff: StageHandoff | None = None
+
+
+def get_active_handoff() -> StageHandoff | None:
+    return _active_handoff
+
+
+@contextmanager
+def staged_passes() -> Iterator[StageHandoff]:
+    """generate() calls inside the block hand their frames over in memory and save in the background."""
+    global _active_handoff
+    handoff = StageHandoff()
+    _active_handoff = handoff
+    try:
+        yield handoff
+        handoff.wait()
+    finally:
+        _active_handoff = None
+        handoff.executor.shutdown(wait=True)
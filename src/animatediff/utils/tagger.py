@@ -3,6 +3,7 @@
 import glob
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2
 import numpy as np
@@ -50,11 +51,20 @@ class Tagger:
         self.model = onnxruntime.InferenceSession(
             path_mgr.wd14_tagger / "model.onnx", providers=get_execution_providers()
         )
+        model_input = self.model.get_inputs()[0]
+        self.input_name = model_input.name
+        self.label_name = self.model.get_outputs()[0].name
+        self.batch_size, self.height, self.width, _ = model_input.shape
+        if not isinstance(self.batch_size, int) or self.batch_size < 1:
+            # dynamic batch axis
+            self.batch_size = None
+
         df = pd.read_csv(path_mgr.wd14_tagger / "selected_tags.csv")
-        self.tag_names = df["name"].tolist()
-        self.rating_indexes = list(np.where(df["category"] == 9)[0])
-        self.general_indexes = list(np.where(df["category"] == 0)[0])
-        self.character_indexes = list(np.where(df["category"] == 4)[0])
+        self.tag_names = np.array(df["name"].tolist(), dtype=object)
+        ignored = np.isin(self.tag_names, list(ignore_tokens))
+        self.rating_indexes = np.where(df["category"] == 9)[0]
+        self.general_indexes = np.where((df["category"] == 0) & ~ignored)[0]
+        self.character_indexes = np.where((df["category"] == 4) & ~ignored)[0]
 
         self.general_threshold = general_threshold
         self.character_threshold = character_threshold
@@ -62,12 +72,7 @@ class Tagger:
         self.with_confidence = with_confidence
         self.is_danbooru_format = is_danbooru_format
 
-    def __call__(
-        self,
-        image: Image,
-    ):
-        _, height, width, _ = self.model.get_inputs()[0].shape
-
+    def preprocess(self, image: Image) -> np.ndarray:
         # Alpha to white
         image = image.convert("RGBA")
         new_image = Image.new("RGBA", image.size, "WHITE")
@@ -78,54 +83,62 @@ class Tagger:
         # PIL RGB to OpenCV BGR
         image = image[:, :, ::-1]
 
-        image = make_square(image, height)
-        image = smart_resize(image, height)
-        image = image.astype(np.float32)
-        image = np.expand_dims(image, 0)
-
-        input_name = self.model.get_inputs()[0].name
-        label_name = self.model.get_outputs()[0].name
-        probs = self.model.run([label_name], {input_name: image})[0]
-
-        labels = list(zip(self.tag_names, probs[0].astype(float)))
-
-        # First 4 labels are actually ratings: pick one with argmax
-        ratings_names = [labels[i] for i in self.rating_indexes]
-        rating = dict(ratings_names)
-
-        # Then we have general tags: pick any where prediction confidence > threshold
-        general_names = [labels[i] for i in self.general_indexes]
-        general_res = [x for x in general_names if x[1] > self.general_threshold]
-        general_res = dict(general_res)
-
-        # Everything else is characters: pick any where prediction confidence > threshold
-        character_names = [labels[i] for i in self.character_indexes]
-        character_res = [x for x in character_names if x[1] > self.character_threshold]
-        character_res = dict(character_res)
-
-        # logger.info(f"{rating=}")
-        # logger.info(f"{general_res=}")
-        # logger.info(f"{character_res=}")
-
-        general_res = {k: general_res[k] for k in (general_res.keys() - set(self.ignore_tokens))}
-        character_res = {k: character_res[k] for k in (character_res.keys() - set(self.ignore_tokens))}
-
-        prompt = ""
+        image = make_square(image, self.height)
+        image = smart_resize(image, self.height)
+        return image.astype(np.float32)
+
+    def run(self, images: np.ndarray) -> np.ndarray:
+        if self.batch_size is None:
+            return self.model.run([self.label_name], {self.input_name: images})[0]
+        # fixed batch size, run in slices and pad the last one
+        probs = []
+        for i in range(0, len(images), self.batch_size):
+            batch = images[i : i + self.batch_size]
+            n = len(batch)
+            if n < self.batch_size:
+                batch = np.concatenate([batch, np.zeros((self.batch_size - n, *batch.shape[1:]), dtype=batch.dtype)])
+            probs.append(self.model.run([self.label_name], {self.input_name: batch})[0][:n])
+        return np.concatenate(probs)
+
+    def predict(self, images: np.ndarray) -> list[str]:
+        """Prompts for a stack of preprocessed images."""
+        probs = self.run(images).astype(float)
+
+        # General tags: pick any where prediction confidence > threshold
+        general_probs = probs[:, self.general_indexes]
+        general_hits = general_probs > self.general_threshold
+
+        # Characters: pick any where prediction confidence > threshold
+        character_probs = probs[:, self.character_indexes]
+        character_hits = character_probs > self.character_threshold
+
+        prompts = []
+        for i in range(len(probs)):
+            names = np.concatenate(
+                [
+                    self.tag_names[self.character_indexes[character_hits[i]]],
+                    self.tag_names[self.general_indexes[general_hits[i]]],
+                ]
+            )
+            if self.with_confidence:
+                confidences = np.concatenate([character_probs[i][character_hits[i]], general_probs[i][general_hits[i]]])
+                prompt = [f"({n}:{c:.2f})" for n, c in zip(names, confidences)]
+            else:
+                prompt = list(names)
 
-        if self.with_confidence:
-            prompt = [f"({i}:{character_res[i]:.2f})" for i in (character_res.keys())]
-            prompt += [f"({i}:{general_res[i]:.2f})" for i in (general_res.keys())]
-        else:
-            prompt = [i for i in (character_res.keys())]
-            prompt += [i for i in (general_res.keys())]
+            prompt = ",".join(prompt)
 
-        prompt = ",".join(prompt)
+            if not self.is_danbooru_format:
+                prompt = prompt.replace("_", " ")
+            prompts.append(prompt)
 
-        if not self.is_danbooru_format:
-            prompt = prompt.replace("_", " ")
+        return prompts
 
-        # logger.info(f"{prompt=}")
-        return prompt
+    def __call__(
+        self,
+        image: Image,
+    ):
+        return self.predict(self.preprocess(image)[None])[0]
 
 
 def get_labels(
@@ -137,6 +150,8 @@ def get_labels(
     with_confidence,
     is_danbooru_format,
     is_cpu=False,
+    batch_size=16,
+    num_workers=4,
 ):
     import torch
 
@@ -154,12 +169,22 @@ def get_labels(
                 general_threshold, character_threshold, ignore_tokens, with_confidence, is_danbooru_format, is_cpu
             )
 
-            for i in tqdm(range(0, len(png_list), interval), desc="WD14tagger"):
-                path = png_map[i]
+            def load(i):
+                return tagger.preprocess(Image.open(png_map[i]))
+
+            frame_nos = list(range(0, len(png_list), interval))
+            batches = [frame_nos[i : i + batch_size] for i in range(0, len(frame_nos), batch_size)]
 
-                # logger.info(f"{path=}")
+            # decode the next batch while the model runs on the current one
+            with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                pending = [executor.submit(load, i) for i in batches[0]] if batches else []
+                for b, batch in enumerate(tqdm(batches, desc="WD14tagger")):
+                    images = np.stack([f.result() for f in pending])
+                    if b + 1 < len(batches):
+                        pending = [executor.submit(load, i) for i in batches[b + 1]]
 
-                result[str(i)] = tagger(image=Image.open(path))
+                    for i, prompt in zip(batch, tagger.predict(images)):
+                        result[str(i)] = prompt
 
             tagger = None
 
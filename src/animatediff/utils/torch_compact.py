@@ -34,3 +34,15 @@ def get_torch_device():
     if torch.cuda.is_available():
         return "cuda"
     return "cpu"
+
+
+def is_oom(e: Exception) -> bool:
+    return isinstance(e, torch.cuda.OutOfMemoryError) or "out of memory" in str(e)
+
+
+def get_free_device_memory(device: torch.device) -> int:
+    """Return the bytes a cuda device can still allocate."""
+    free, _ = torch.cuda.mem_get_info(device)
+    # memory held by the caching allocator is reusable as well
+    free += torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
+    return free
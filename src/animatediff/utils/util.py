@@ -3,8 +3,9 @@ import logging
 import os
 from os import PathLike
 from pathlib import Path, PurePosixPath
-from typing import List
+from typing import Iterator, List
 
+import numpy as np
 import torch
 import torch.distributed as dist
 from einops import rearrange
@@ -45,6 +46,16 @@ def save_imgs(imgs: List[Image.Image], frames_dir: PathLike):
         img.save(frames_dir.joinpath(f"{idx:08d}.png"))
 
 
+def iter_rgb_frames(video: Tensor | List[Image.Image]) -> Iterator[np.ndarray]:
+    """Yield HxWx3 uint8 frames of a single video, rounded the same way save_image does."""
+    if isinstance(video, list):
+        for img in video:
+            yield np.asarray(img.convert("RGB"))
+        return
+    for frame in rearrange(video[0], "c t h w -> t h w c"):
+        yield frame.mul(255).add_(0.5).clamp_(0, 255).to(torch.uint8).numpy()
+
+
 def save_video(video: Tensor, save_path: PathLike, fps: int = 8):
     save_path = Path(save_path)
     save_path.parent.mkdir(parents=True, exist_ok=True)
@@ -93,8 +104,8 @@ def get_resized_images(org_images_path: list[Path], us_width: int, us_height: in
     return [resize_for_condition_image(img, us_width, us_height) for img in images]
 
 
-def get_resized_image(org_image_path: str, us_width: int, us_height: int):
-    image = Image.open(org_image_path)
+def get_resized_image(org_image_path: str | Image.Image, us_width: int, us_height: int):
+    image = org_image_path if isinstance(org_image_path, Image.Image) else Image.open(org_image_path)
 
     W, H = image.size
 
@@ -106,8 +117,8 @@ def get_resized_image(org_image_path: str, us_width: int, us_height: int):
     return resize_for_condition_image(image, us_width, us_height)
 
 
-def get_resized_image2(org_image_path: str, size: int):
-    image = Image.open(org_image_path)
+def get_resized_image2(org_image_path: str | Image.Image, size: int):
+    image = org_image_path if isinstance(org_image_path, Image.Image) else Image.open(org_image_path)
 
     W, H = image.size
 
@@ -365,80 +376,17 @@ def prepare_softsplat():
 def extract_frames(
     movie_file_path, fps, out_dir, aspect_ratio, duration, offset, size_of_short_edge=-1, low_vram_mode=False
 ):
-    import ffmpeg
+    from animatediff.utils.frame_source import FrameSource
 
     print(movie_file_path)
-    probe = ffmpeg.probe(movie_file_path)
-    video = next((stream for stream in probe["streams"] if stream["codec_type"] == "video"), None)
-    width = int(video["width"])
-    height = int(video["height"])
-
-    node = ffmpeg.input(str(movie_file_path.resolve()))
-
-    node = node.filter("fps", fps=fps)
-
-    if duration > 0:
-        node = node.trim(start=offset, end=offset + duration).setpts("PTS-STARTPTS")
-    elif offset > 0:
-        node = node.trim(start=offset).setpts("PTS-STARTPTS")
-
-    if size_of_short_edge != -1:
-        if width < height:
-            r = height / width
-            width = size_of_short_edge
-            height = int((size_of_short_edge * r) // 8 * 8)
-            node = node.filter("scale", size_of_short_edge, height)
-        else:
-            r = width / height
-            height = size_of_short_edge
-            width = int((size_of_short_edge * r) // 8 * 8)
-            node = node.filter("scale", width, size_of_short_edge)
-
-    if low_vram_mode:
-        if aspect_ratio == -1:
-            aspect_ratio = width / height
-            logger.info(f"low {aspect_ratio=}")
-            aspect_ratio = max(min(aspect_ratio, 1.5), 0.6666)
-            logger.info(f"low {aspect_ratio=}")
-
-    if aspect_ratio > 0:
-        # aspect ratio (width / height)
-        ww = round(height * aspect_ratio)
-        if ww < width:
-            x = (width - ww) // 2
-            y = 0
-            w = ww
-            h = height
-        else:
-            hh = round(width / aspect_ratio)
-            x = 0
-            y = (height - hh) // 2
-            w = width
-            h = hh
-        w = int(w // 8 * 8)
-        h = int(h // 8 * 8)
-        logger.info(f"crop to {w=},{h=}")
-        node = node.crop(x, y, w, h)
-
-    node = node.output(str(out_dir.resolve().joinpath("%08d.png")), start_number=0)
-
-    node.run(quiet=True, overwrite_output=True)
+    source = FrameSource(movie_file_path, fps, aspect_ratio, duration, offset, size_of_short_edge, low_vram_mode)
+    source.save_pngs(out_dir)
 
 
 def is_v2_motion_module(motion_module_path: Path):
-    if motion_module_path.suffix == ".safetensors":
-        from safetensors.torch import load_file
-
-        loaded = load_file(motion_module_path, "cpu")
-    else:
-        from torch import load
-
-        loaded = load(motion_module_path, "cpu")
-
-    is_v2 = "mid_block.motion_modules.0.temporal_transformer.norm.bias" in loaded
+    from animatediff.utils.model_info import get_model_info
 
-    loaded = None
-    torch.cuda.empty_cache()
+    is_v2 = get_model_info(motion_module_path).architecture == "motion_v2"
 
     logger.info(f"{is_v2=}")
 
@@ -446,24 +394,9 @@ def is_v2_motion_module(motion_module_path: Path):
 
 
 def is_sdxl_checkpoint(checkpoint_path: Path):
-    if checkpoint_path.suffix == ".safetensors":
-        from safetensors.torch import load_file
-
-        loaded = load_file(checkpoint_path, "cpu")
-    else:
-        from torch import load
-
-        loaded = load(checkpoint_path, "cpu")
-
-    is_sdxl = False
-
-    if "conditioner.embedders.1.model.ln_final.weight" in loaded:
-        is_sdxl = True
-    if "conditioner.embedders.0.model.ln_final.weight" in loaded:
-        is_sdxl = True
+    from animatediff.utils.model_info import get_model_info
 
-    loaded = None
-    torch.cuda.empty_cache()
+    is_sdxl = get_model_info(checkpoint_path).architecture == "sdxl"
 
     logger.info(f"{is_sdxl=}")
     return is_sdxl
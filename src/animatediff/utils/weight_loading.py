@@ -0,0 +1,81 @@
+import logging
+import zipfile
+from pathlib import Path
+from typing import Iterator, Mapping
+
+import torch
+from safetensors import safe_open
+from torch import Tensor, nn
+
+logger = logging.getLogger(__name__)
+
+
+class SafetensorsWeights(Mapping):
+
+    """Read-only mapping over a safetensors file, tensors are mapped from the file on access."""
+
+    def __init__(self, path: Path):
+        self.handle = safe_open(path, framework="pt", device="cpu")
+        self.names = set(self.handle.keys())
+
+    def __getitem__(self, key: str) -> Tensor:
+        """Map the tensor named key from the file."""
+        if key not in self.names:
+            raise KeyError(key)
+        return self.handle.get_tensor(key)
+
+    def __contains__(self, key) -> bool:
+        """Check the names in the header, without mapping the tensor."""
+        return key in self.names
+
+    def __iter__(self) -> Iterator[str]:
+        """Iterate over the tensor names."""
+        return iter(self.names)
+
+    def __len__(self) -> int:
+        """Count the tensors in the file."""
+        return len(self.names)
+
+
+def open_weights(path: Path) -> Mapping[str, Tensor]:
+    """Lazily mapped weights of a safetensors file or a torch checkpoint."""
+    path = Path(path)
+    if path.suffix.lower() == ".safetensors":
+        return SafetensorsWeights(path)
+    # only the zip serialization can be mapped
+    state_dict = torch.load(path, map_location="cpu", weights_only=True, mmap=zipfile.is_zipfile(path))
+    if "state_dict" in state_dict:
+        state_dict = state_dict["state_dict"]
+    return state_dict
+
+
+def gather_weights(
+    model: nn.Module,
+    sources: list[Mapping[str, Tensor]],
+    weight_deltas: Mapping[str, Tensor] | None = None,
+    device: torch.device | str | None = None,
+) -> tuple[dict[str, Tensor], list[str]]:
+    """Pick every parameter and buffer of model from sources, later sources win.
+
+    Tensors are cast to the dtype of the model's own tensor and moved to device, which are no-ops (and so keep
+    the file mapping) when they already match. Returns (state dict, keys found in no source).
+    """
+    weight_deltas = weight_deltas or {}
+    state_dict = {}
+    missing = []
+    for key, ref in model.state_dict(keep_vars=True).items():
+        source = next((s for s in reversed(sources) if key in s), None)
+        if source is None:
+            missing.append(key)
+            continue
+        tensor = source[key]
+        dtype = ref.dtype if tensor.is_floating_point() else tensor.dtype
+        tensor = tensor.to(device=device or "cpu", dtype=dtype)
+        if key in weight_deltas:
+            tensor = tensor + weight_deltas[key].to(tensor)
+        state_dict[key] = tensor
+
+    unused = set(weight_deltas) - set(state_dict)
+    if unused:
+        logger.info(f"{len(unused)} weight deltas have no matching parameter: {sorted(unused)[:4]}")
+    return state_dict, missing
@@ -0,0 +1,44 @@
+import pytest
+
+from animatediff.pipelines.context import CONTEXT_SCHEDULERS, estimate_context_cost, get_total_steps, uniform
+
+
+# uniform keeps its original stride levels, which can wrap a window onto the same frame
+@pytest.mark.parametrize("name", [name for name in CONTEXT_SCHEDULERS if name != "uniform"])
+@pytest.mark.parametrize("num_frames", [16, 20, 33, 48, 64, 100])
+@pytest.mark.parametrize("closed_loop", [True, False])
+def test_windows_hold_unique_frames(name, num_frames, closed_loop):
+    scheduler = CONTEXT_SCHEDULERS[name]
+    num_steps = 4
+    windows = 0
+    for step in range(num_steps):
+        for context in scheduler(step, num_steps, num_frames, 16, 3, 4, closed_loop):
+            assert len(set(context)) == len(context)
+            assert all(0 <= i < num_frames for i in context)
+            windows += 1
+
+    cost, coverage = estimate_context_cost(name, num_steps, num_frames, 16, 3, 4, closed_loop)
+    assert cost * num_steps == windows
+    assert get_total_steps(scheduler, range(num_steps), num_steps, num_frames, 16, 3, 4, closed_loop) == windows
+
+
+@pytest.mark.parametrize(
+    "num_frames, closed_loop, num_windows",
+    [(20, True, 3), (20, False, 3), (48, True, 7), (48, False, 7), (100, True, 16), (100, False, 15)],
+)
+def test_uniform_window_count(num_frames, closed_loop, num_windows):
+    for step in range(4):
+        assert len(list(uniform(step, 4, num_frames, 16, 4, 4, closed_loop))) == num_windows
+
+
+def test_uniform_windows():
+    assert list(uniform(0, 4, 20, 16, 4, 4, True)) == [
+        list(range(16)),
+        [12, 13, 14, 15, 16, 17, 18, 19, 0, 1, 2, 3, 4, 5, 6, 7],
+        [0, 2, 4, 6, 8, 10, 12, 14, 16, 18, 0, 2, 4, 6, 8, 10],
+    ]
+    assert list(uniform(1, 4, 20, 16, 4, 4, True)) == [
+        [10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 0, 1, 2, 3, 4, 5],
+        list(range(2, 18)),
+        [11, 13, 15, 17, 19, 1, 3, 5, 7, 9, 11, 13, 15, 17, 19, 1],
+    ]
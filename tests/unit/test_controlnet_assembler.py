@@ -0,0 +1,46 @@
+import torch
+
+from animatediff.pipelines.animation import ControlnetResidualAssembler
+
+
+def assemble_per_residual(controlnet_result, controlnet_scale_map, context):
+    """Assemble the residuals with the per-residual loop ControlnetResidualAssembler replaced."""
+    first_down, first_mid = list(list(controlnet_result.values())[0].values())[0]
+    down = [torch.zeros((*d.shape[:2], len(context), *d.shape[3:])) for d in first_down]
+    mid = torch.zeros((*first_mid.shape[:2], len(context), *first_mid.shape[3:]))
+    for fr in controlnet_result:
+        for type_str, (cur_down, cur_mid) in controlnet_result[fr].items():
+            m = controlnet_scale_map[str(fr) + "_" + type_str]
+            loc = list(set(context) & set(m["frames"]))
+            scales = [m["scales"][m["frames"].index(o)] for o in loc]
+            loc_index = [context.index(o) for o in loc]
+            mod = torch.tensor(scales)
+            mid[:, :, loc_index] = mid[:, :, loc_index] + cur_mid * mod[None, None, :, None, None]
+            for ii in range(len(cur_down)):
+                down[ii][:, :, loc_index] = down[ii][:, :, loc_index] + cur_down[ii] * mod[None, None, :, None, None]
+    return down, mid
+
+
+def test_matches_per_residual_loop_on_repeated_frames():
+    torch.manual_seed(0)
+    num_frames = 20
+    controlnet_scale_map = {}
+    controlnet_result = {}
+    for fr in [0, 4, 10]:
+        frames = [i % num_frames for i in range(fr - 2, fr + 3)]
+        controlnet_scale_map[f"{fr}_controlnet_canny"] = {"frames": frames, "scales": [0.5, 0.75, 1.0, 0.75, 0.5]}
+        controlnet_result[fr] = {
+            "controlnet_canny": ([torch.randn(2, 3, 1, 4, 4), torch.randn(2, 5, 1, 2, 2)], torch.randn(2, 5, 1, 2, 2))
+        }
+    # a uniform window at stride 2 that wraps onto frames 0 to 10 again
+    context = list(range(0, 20, 2)) + list(range(0, 12, 2))
+
+    assembler = ControlnetResidualAssembler(controlnet_scale_map, torch.device("cpu"))
+    down, mid = assembler(controlnet_result, context)
+    expected_down, expected_mid = assemble_per_residual(controlnet_result, controlnet_scale_map, context)
+
+    assert torch.allclose(mid, expected_mid)
+    for d, e in zip(down, expected_down):
+        assert torch.allclose(d, e)
+    # the repeated copies of frames 0 to 10 get nothing
+    assert not mid[:, :, 10:].any()
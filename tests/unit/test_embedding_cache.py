@@ -0,0 +1,59 @@
+import torch
+
+from animatediff.settings import TextEmbeddingCacheConfig
+from animatediff.utils.embedding_cache import EmbeddingCache
+
+
+def make_cache(tmp_path, **kwargs) -> EmbeddingCache:
+    return EmbeddingCache(tmp_path / "embeddings", TextEmbeddingCacheConfig(**kwargs))
+
+
+def encoder(calls: list):
+    def encode(texts):
+        calls.append(list(texts))
+        return [(torch.full((4,), float(len(text))),) for text in texts]
+
+    return encode
+
+
+def test_partial_hit_encodes_only_new_texts(tmp_path):
+    cache = make_cache(tmp_path)
+    calls = []
+    cache.get_or_encode("enc", "mode", ["negative", "a cat"], encoder(calls))
+    values = cache.get_or_encode("enc", "mode", ["negative", "a dog", "a dog"], encoder(calls))
+
+    assert calls == [["negative", "a cat"], ["a dog"]]
+    assert [v[0][0].item() for v in values] == [8.0, 5.0, 5.0]
+    # hits and misses can be stacked once moved to one device
+    assert torch.stack([e.to("cpu") for e, in values]).shape == (3, 4)
+
+
+def test_mode_and_encoder_are_part_of_the_key(tmp_path):
+    cache = make_cache(tmp_path)
+    calls = []
+    cache.get_or_encode("enc", "mode", ["a cat"], encoder(calls))
+    cache.get_or_encode("enc", "other", ["a cat"], encoder(calls))
+    cache.get_or_encode("enc2", "mode", ["a cat"], encoder(calls))
+    cache.get_or_encode(None, "mode", ["a cat"], encoder(calls))
+
+    assert len(calls) == 4
+
+
+def test_lru_eviction_and_spill(tmp_path):
+    # one entry is 16 bytes, room for two
+    max_mb = 32 / 1024**2
+    cache = make_cache(tmp_path, max_mb=max_mb)
+    calls = []
+    for text in ["a", "bb", "ccc"]:
+        cache.get_or_encode("enc", "mode", [text], encoder(calls))
+    assert len(cache.entries) == 2 and cache.nbytes == 32
+
+    cache.get_or_encode("enc", "mode", ["a"], encoder(calls))
+    assert calls[-1] == ["a"]
+
+    spilling = make_cache(tmp_path, max_mb=max_mb, spill_to_disk=True)
+    calls = []
+    for text in ["a", "bb", "ccc", "a"]:
+        spilling.get_or_encode("enc", "mode", [text], encoder(calls))
+    assert calls == [["a"], ["bb"], ["ccc"]]
+    assert len(list(spilling.cache_dir.glob("*/*.safetensors"))) == 2
@@ -0,0 +1,35 @@
+import os
+
+from animatediff.utils.frame_store import get_frame_store
+
+
+def test_dirs_share_one_stored_frame(tmp_path):
+    src = tmp_path / "frames"
+    src.mkdir()
+    (src / "00000000.png").write_bytes(b"a")
+    (src / "00000001.png").write_bytes(b"a")
+
+    store = get_frame_store(tmp_path)
+    store.link_tree(src, tmp_path / "tile")
+    store.link_tree(src, tmp_path / "ip2p")
+
+    # identical frames are stored once, and every dir links to that file
+    assert len([p for p in store.store_dir.rglob("*") if p.is_file()]) == 1
+    assert os.stat(tmp_path / "ip2p" / "00000001.png").st_nlink == 5
+
+
+def test_relinking_does_not_write_through(tmp_path):
+    src = tmp_path / "frames"
+    src.mkdir()
+    (src / "00000000.png").write_bytes(b"a")
+
+    store = get_frame_store(tmp_path)
+    store.link_tree(src, tmp_path / "tile")
+    store.link_tree(src, tmp_path / "ip2p")
+
+    (src / "00000000.png").write_bytes(b"b")
+    store.link_tree(src, tmp_path / "tile")
+
+    assert (tmp_path / "tile" / "00000000.png").read_bytes() == b"b"
+    assert (tmp_path / "ip2p" / "00000000.png").read_bytes() == b"a"
+    assert store.prune() == 0
@@ -0,0 +1,79 @@
+from animatediff.adw.jobs import JobQueue
+from animatediff.adw.schema import TStatusEnum
+
+
+def test_claim_in_submission_order(tmp_path):
+    queue = JobQueue(tmp_path / "jobs.sqlite3")
+    first = queue.enqueue({"project": "a"})
+    second = queue.enqueue({"project": "b"})
+
+    assert queue.claim("w0") == (first, {"project": "a"})
+    assert queue.claim("w1") == (second, {"project": "b"})
+    assert queue.claim("w0") is None
+    assert queue.get(first).status == TStatusEnum.RUNNING
+
+
+def test_orphans_are_requeued(tmp_path):
+    queue = JobQueue(tmp_path / "jobs.sqlite3")
+    pid = queue.enqueue({"project": "a"})
+    queue.claim("w0")
+
+    # a worker restarting under the same name leaves a job alone while it is still reported on
+    queue = JobQueue(tmp_path / "jobs.sqlite3")
+    assert queue.requeue_orphans() == 0
+    queue.update_progress(pid, 10, [])
+    assert queue.requeue_orphans(lease=5) == 0
+    assert queue.get(pid).status == TStatusEnum.RUNNING
+
+    # the one a crashed worker held goes back in the queue once its lease runs out
+    assert queue.requeue_orphans(lease=-1) == 1
+    assert queue.claim("w0") == (pid, {"project": "a"})
+
+
+def test_interrupt(tmp_path):
+    queue = JobQueue(tmp_path / "jobs.sqlite3")
+    running = queue.enqueue({})
+    pending = queue.enqueue({})
+    queue.claim("w0")
+
+    assert queue.request_interrupt(running)
+    assert queue.is_interrupt_requested(running)
+    queue.finish(running, TStatusEnum.ERROR)
+    assert not queue.request_interrupt(running)
+    assert queue.get(running).processing_interrupted
+
+    # jobs that never started are cancelled right away
+    assert queue.request_interrupt(pending)
+    assert queue.get(pending).status == TStatusEnum.ERROR
+    assert queue.claim("w0") is None
+
+
+def test_preview(tmp_path):
+    queue = JobQueue(tmp_path / "jobs.sqlite3")
+    pid = queue.enqueue({})
+    assert queue.get_preview(pid) is None
+    assert queue.get(pid).preview_step == -1
+
+    queue.update_preview(pid, 10, b"RIFF")
+    assert queue.get_preview(pid) == b"RIFF"
+    assert queue.get(pid).preview_step == 10
+
+
+def test_failing_job_does_not_stop_the_worker(tmp_path, monkeypatch):
+    from animatediff.adw import worker
+
+    def sub_render_video(data, pid):
+        raise RuntimeError("broken project")
+
+    queue = JobQueue(tmp_path / "jobs.sqlite3")
+    monkeypatch.setattr(worker, "get_job_queue", lambda: queue)
+    monkeypatch.setattr(worker, "sub_render_video", sub_render_video)
+    first = queue.enqueue({"project": "a"})
+    second = queue.enqueue({"project": "b"})
+
+    worker.run_worker("w0", once=True)
+
+    assert queue.get(first).status == TStatusEnum.ERROR
+    assert queue.get(second).status == TStatusEnum.ERROR
+    assert not queue.get(first).processing_interrupted
+    assert queue.claim("w0") is None
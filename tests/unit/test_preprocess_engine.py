@@ -0,0 +1,40 @@
+from PIL import Image
+
+from animatediff.settings import PreprocessCacheConfig
+from animatediff.utils.cpu_preprocessor import BlurPreProcessor
+from animatediff.utils.preprocess_engine import PreprocessEngine
+
+
+def make_frames(tmp_path, count: int) -> dict[int, str]:
+    frames = {}
+    for i in range(count):
+        path = tmp_path / f"{i:08d}.png"
+        Image.new("RGB", (64, 64), (i * 40, 0, 0)).save(path)
+        frames[i] = str(path)
+    return frames
+
+
+def test_small_runs_stay_in_process(tmp_path):
+    engine = PreprocessEngine(tmp_path / "cache", num_workers=4, parallel_min_frames=64)
+    created = []
+
+    def create():
+        created.append(1)
+        return BlurPreProcessor()
+
+    detected, processed = engine.run("blur", create, make_frames(tmp_path, 3), {}, size=64)
+    assert processed and sorted(detected) == [0, 1, 2] and created == [1]
+
+    _, processed = engine.run("blur", create, make_frames(tmp_path, 3), {}, size=64)
+    assert not processed and created == [1]
+
+
+def test_cache_eviction(tmp_path):
+    frames = make_frames(tmp_path, 4)
+    engine = PreprocessEngine(tmp_path / "cache", config=PreprocessCacheConfig(max_gb=0))
+    engine.run("none", lambda: None, frames, {}, size=64)
+    assert engine.nbytes == 0 and not list(engine.cache_dir.glob("*.png"))
+
+    engine = PreprocessEngine(tmp_path / "cache2")
+    engine.run("none", lambda: None, frames, {}, size=64)
+    assert len(list(engine.cache_dir.glob("*.png"))) == 4